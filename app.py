@@ -1,87 +1,1329 @@
 # encoding: utf-8
 import os
+import re
+import sys
 import time
-from multiprocessing import Pool, cpu_count
+import socket
+import calendar
+import shutil
+import tempfile
+import threading
+import fire
+from datetime import datetime
+from xml.sax.saxutils import escape
+from multiprocessing import Pool, TimeoutError, cpu_count
+from multiprocessing.pool import ThreadPool
 from selenium import webdriver
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.common.exceptions import TimeoutException
+from evernote.edam.type.ttypes import Notebook
 from enote.util import get_note, get_notebook, get_notebooks, \
-    create_resource, create_note, create_notebook, update_note
-from github.util import get_user_name, get_all_gists
-from web.util import fullpage_screenshot, get_gist_hash, create_chrome_driver
-from settings import NOTEBOOK_TO_SYNC
-from db import get_db
+    create_resource, create_note, create_notebook, update_note, \
+    get_notes_metadata, get_note_content, delete_notes, get_upload_allowance, get_resource_hexhash, \
+    is_rate_limited, build_resource, build_note_title, build_note_content, check_note
+from github.util import get_all_gists, get_gists_by_ids, poll_gists, get_gist_files, get_file_content
+from web.util import get_gist_hash, match_gist_hash, DriverPool, \
+    get_gist_file_names, isolate_gist_file, capture_fullpage, capture_fitted, capture_preview, encode_image, \
+    get_encode_pool, reset_encode_pool, exclusive, stabilize_page, fit_image, DEVICE_SCALES, DEFAULT_DEVICE_SCALE
+from settings import CAPTURE_MODE, TEXT_MODE_EXTENSIONS, TEXT_MODE_MIN_BYTES, TEXT_MODE_MIN_LINES, \
+    TEXT_MODE_PREVIEW, IMAGE_ONLY_LANGUAGES, CHROME_PROFILE_DIR, CHROME_CACHE_BYTES, DETERMINISTIC_CAPTURE, \
+    ADAPTIVE_CONCURRENCY, MAX_CONCURRENT_UPLOADS, GIST_LISTING, DEADLINES
+from db import RETRY_MAX_ATTEMPTS
+from jobs import get_queue, Heartbeat, JOBS_FILE, LEASE_SECONDS
+from tenants import get_default_tenant, load_tenants, TENANTS_FILE
+from plan import make_plan, save_plan, load_plan, format_summary, get_calibration, estimate_cost, PLAN_FILE
+from enex import EnexWriter, ENEX_DIR, ENEX_MAX_BYTES
+from concurrency import AdaptiveLimit, DeadlineExceeded, limited, get_watchdog
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 GIST_BASE_URL = 'https://gist.github.com'
+GIST_URL_PATTERN = re.compile(r'https?://gist\.github\.com/(?:[\w-]+/)?([0-9a-zA-Z]+)')
+GIST_LINK_TEXT = 'Gist on Github'  # anchor put by `format_note_body` after the description
+GIST_LINK_PATTERN = re.compile(r'<a\s[^>]*href="([^"]*)"[^>]*>' + GIST_LINK_TEXT + '</a>')
 
-notebook = None
-github_user = get_user_name() # get current login github user for fetching gist content
-db = get_db()  # database to store synchronization info
+DEFAULT_RENDER_SECONDS = 15
+PART_NAME_FORMAT = u'{} ({}/{})'  # file names of gists cannot contain "/", so part names are unambiguous
+PART_NAME_PATTERN = re.compile(r'^(.+) \((\d+)/(\d+)\)$')
+SHRINK_MARGIN = 0.95  # target a bit below the limit, as downscaled images do not shrink exactly by ratio
 
+_allowance_lock = threading.Lock()
+_sync_pool = None  # (size, pool), see `get_sync_pool`
+_sync_pool_lock = threading.Lock()
 
-def app():
+
+class BudgetExceeded(Exception):
+    """Raised when a synchronization run has used up its time or upload budget"""
+
+
+class SyncBudget(object):
+    """Time and upload quota a synchronization run is allowed to use.
+
+    Parameters
+    ----------
+    max_seconds : int, optional
+        Wall-clock seconds the run may take. Unlimited if not set.
+
+    max_upload_bytes : int, optional
+        Bytes the run may upload to Evernote. Unlimited if not set.
+
+    """
+
+    def __init__(self, max_seconds=None, max_upload_bytes=None):
+        self.deadline = time.time() + max_seconds if max_seconds else None
+        self.max_upload_bytes = max_upload_bytes
+        self.uploaded_bytes = 0
+        self.lock = threading.Lock()
+
+    def can_start(self, estimated_seconds=0):
+        """Indicate whether a gist estimated to take `estimated_seconds` fits in the budget"""
+        if self.deadline and time.time() + estimated_seconds > self.deadline:
+            return False
+        return self.max_upload_bytes is None or self.uploaded_bytes < self.max_upload_bytes
+
+    def reserve_upload(self, num_bytes):
+        """Account `num_bytes` to be uploaded, raise BudgetExceeded if not allowed"""
+        with self.lock:
+            if self.max_upload_bytes is not None and self.uploaded_bytes + num_bytes > self.max_upload_bytes:
+                raise BudgetExceeded('Upload of {} bytes exceeds the budget'.format(num_bytes))
+            self.uploaded_bytes += num_bytes
+
+
+def app(reconcile=False, prune=False, expunge=False, max_seconds=None, max_upload_bytes=None, drivers=1, tabs=1,
+        gist=None, listing=GIST_LISTING):
+    """Synchronize gists to the Evernote notebook.
+
+    Parameters
+    ----------
+    reconcile : bool, optional
+        Rebuild the local index from notes already in the notebook before
+        synchronization, e.g. after `db.json` was lost. Gists whose note is
+        found and up-to-date will not be rendered again.
+
+    prune : bool, optional
+        Remove notes of gists that were deleted on Github.
+        Require listing all gists even in warm-start mode.
+
+    expunge : bool, optional
+        Permanently remove the pruned notes instead of moving them to the trash.
+
+    max_seconds : int, optional
+        Stop starting new gists once the run would take longer than this.
+
+    max_upload_bytes : int, optional
+        Stop before uploading more than this to Evernote. The remaining
+        upload allowance of the Evernote account is always respected.
+
+    drivers : int, optional
+        Number of Chrome drivers rendering gists in parallel
+
+    tabs : int, optional
+        Number of tabs of each Chrome driver loading gists in parallel
+
+    gist : str or list of str, optional
+        Only synchronize these gists, given by id, name or url and separated
+        by commas, see `sync_given_gists`. Other options except `drivers`
+        and `tabs` are ignored.
+
+    listing : str, optional
+        "graphql" or "rest" to list gists, see `github.util.get_all_gists`
+
+    Notes
+    -----
+    With either budget set, gists are ordered by priority and those left
+    when the budget is used up are checkpointed for the next run.
+
+    """
+    if gist:
+        sync_given_gists(gist, drivers=drivers, tabs=tabs)
+        return
+
+    start = time.time()
+    tenant = get_default_tenant()
+    get_sync_notebook(tenant)
+
+    gists, failed_ids = collect_gists(tenant, reconcile=reconcile, prune=prune, expunge=expunge, listing=listing)
+
+    budget = None
+    if max_seconds or max_upload_bytes:
+        allowance = get_upload_allowance(token=tenant.evernote_token)
+        print("Remaining Evernote upload allowance: {} bytes".format(allowance))
+        budget = SyncBudget(max_seconds, min(max_upload_bytes or allowance, allowance))
+        gists = prioritize(tenant, gists, failed_ids=failed_ids)
+    else:
+        gists = schedule_longest_first(tenant, gists)
+
+    print("Total number of gists to be synchronized: %d" % len(gists))
+
+    # headless mode to reduce overhead and distraction
+    driver_pool = create_driver_pool(drivers, tabs=tabs)
+    failed, pending = sync_gists([(tenant, g) for g in gists], driver_pool, budget=budget)
+    driver_pool.quit()
+
+    finish_sync(tenant, len(failed), [g for _, g in pending], gists)
+    print("Synchronization took {:.0f} seconds.".format(time.time() - start))
+
+
+def sync_given_gists(refs, drivers=1, tabs=1):
+    """Synchronize only the given gists right away, e.g. a gist just edited.
+
+    Metadata of the gists is fetched in one request instead of listing all
+    gists, and the notebook guid saved by a previous run is used without
+    asking Evernote. The last synchronization time is left untouched, so
+    that the next normal run still picks up all gists pushed since then.
+
+    Parameters
+    ----------
+    refs : str or list of str
+        Gists given by GraphQL id, name or url, separated by commas
+
+    drivers : int, optional
+        Number of Chrome drivers rendering gists in parallel
+
+    tabs : int, optional
+        Number of tabs of each Chrome driver loading gists in parallel
+
+    """
     start = time.time()
-    global notebook
+    tenant = get_default_tenant()
+    get_sync_notebook(tenant, cached=True)
+    gists = find_gists(tenant, refs)
+    if not gists:
+        return
+
+    driver_pool = create_driver_pool(min(drivers, len(gists)), tabs=tabs)
+    failed, _ = sync_gists([(tenant, g) for g in gists], driver_pool)
+    driver_pool.quit()
+
+    if failed:
+        print("{} gists failed and will be retried in next run.".format(len(failed)))
+    print("Synchronization of {} gists took {:.1f} seconds.".format(len(gists), time.time() - start))
+
+
+def find_gists(tenant, refs):
+    """Fetch metadata of gists given by id, name or url in one request.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    refs : str or list of str
+        Gists given by GraphQL id, name or url, separated by commas or spaces
+
+    Returns
+    -------
+    gists : list of dict
+        Gists found, in the format of `github.util.get_gists`
+
+    """
+    if isinstance(refs, (list, tuple)):
+        refs = ','.join(str(r) for r in refs)
+    ids, names = [], []
+    for ref in re.split(r'[,\s]+', str(refs).strip()):
+        match = GIST_URL_PATTERN.search(ref)
+        if match:
+            names.append(match.group(1))
+        elif tenant.db.has_gist(ref):
+            ids.append(ref)
+        elif re.match(r'^[0-9a-f]+$', ref):
+            names.append(ref)
+        elif ref:
+            ids.append(ref)
+
+    gists = unique_gists(get_gists_by_ids(ids, names, token=tenant.github_token))
+    found = set(g['id'] for g in gists) | set(g['name'] for g in gists)
+    for ref in ids + names:
+        if ref not in found:
+            print("Gist {} not found.".format(ref))
+    return gists
+
+
+def sync_tenants(config=TENANTS_FILE, drivers=2, tabs=1):
+    """Synchronize gists of all accounts listed in `config` in one process.
+
+    Each tenant keeps its own database, while Chrome drivers and HTTP
+    connections are shared. Gists of different tenants are interleaved,
+    so that a tenant with many gists does not starve the others, and
+    gists of each tenant are synced longest first.
+
+    Parameters
+    ----------
+    config : str, optional
+        Path of the JSON file listing the accounts, see `tenants.load_tenants`
+
+    drivers : int, optional
+        Number of Chrome drivers shared by all tenants
+
+    tabs : int, optional
+        Number of tabs of each Chrome driver loading gists in parallel
+
+    """
+    start = time.time()
+    tenants = load_tenants(config)
+
+    gists_per_tenant = []
+    for tenant in tenants:
+        # problem of an account should not stop the others
+        try:
+            get_sync_notebook(tenant)
+            gists, _ = collect_gists(tenant)
+        except Exception as e:
+            print("Failed to list gists of tenant {}: {!r}".format(tenant.name, e))
+            continue
+        print("Number of gists to be synchronized for {}: {}".format(tenant.name, len(gists)))
+        gists_per_tenant.append([(tenant, g) for g in schedule_longest_first(tenant, gists)])
+
+    driver_pool = create_driver_pool(drivers, tabs=tabs)
+    failed, pending = sync_gists(interleave(gists_per_tenant), driver_pool)
+    driver_pool.quit()
+
+    for items in gists_per_tenant:
+        if not items:
+            continue
+        tenant = items[0][0]
+        finish_sync(tenant, sum(1 for t, _ in failed if t is tenant),
+                    [g for t, g in pending if t is tenant], [g for _, g in items])
+    print("Synchronization of {} tenants took {:.0f} seconds.".format(len(tenants), time.time() - start))
+
+
+def create_driver_pool(drivers, tabs=1):
+    """Create a pool of headless Chrome drivers with profiles kept across runs.
+
+    Parameters
+    ----------
+    drivers : int
+        Number of Chrome drivers
+
+    tabs : int, optional
+        Number of tabs of each Chrome driver
+
+    Returns
+    -------
+    driver_pool : web.util.DriverPool
+
+    """
+    return DriverPool(drivers, tabs=tabs, profile_root=CHROME_PROFILE_DIR, cache_bytes=CHROME_CACHE_BYTES,
+                      deterministic=DETERMINISTIC_CAPTURE, page_load_seconds=DEADLINES['page_load'])
+
+
+def apply_deadlines(deadlines=DEADLINES):
+    """Bound calls to Github and Evernote by `deadlines`, see `settings.DEADLINES`.
+
+    Github requests time out after the listing / hash deadline. Evernote API
+    calls and WebDriver commands, which have no timeout of their own, time out
+    after the upload deadline, so that a hung connection fails its gist.
+
+    Parameters
+    ----------
+    deadlines : dict, optional
+
+    """
+    import github.util
+    import web.util
+    github.util.REQUEST_TIMEOUT = deadlines['listing']
+    web.util.REQUEST_TIMEOUT = deadlines['hash']
+    socket.setdefaulttimeout(deadlines['upload'])
+
+
+def interleave(lists):
+    """Merge lists by taking one item from each list in turn.
+
+    Parameters
+    ----------
+    lists : list of list
+
+    Returns
+    -------
+    items : list
+
+    """
+    items = []
+    for i in range(max(len(l) for l in lists) if lists else 0):
+        items.extend(l[i] for l in lists if i < len(l))
+    return items
+
+
+def daemon(min_interval=60, max_interval=1800):
+    """Keep running and synchronize gists whenever some of them changed.
+
+    Github is polled with conditional requests, so polls without any change
+    cost almost nothing. The Evernote clients and Chrome driver are kept warm
+    between synchronizations, see `get_sync_pool`. The polling interval halves after a change and
+    grows when nothing changed, within [`min_interval`, `max_interval`].
+
+    Parameters
+    ----------
+    min_interval : int, optional
+        Minimum seconds between two polls
+
+    max_interval : int, optional
+        Maximum seconds between two polls
+
+    """
+    tenant = get_default_tenant()
+    db = tenant.db
+    get_sync_notebook(tenant)
+    driver_pool = create_driver_pool(1)
+    etag = None
+    interval = min_interval
+
+    try:
+        while True:
+            since = datetime.strftime(db.get_last_sync(), DATE_FORMAT)
+            try:
+                changed, etag = poll_gists(since=None if db.is_cold_start() else since, etag=etag,
+                                           token=tenant.github_token)
+            except Exception as e:
+                # keep the daemon alive on network problems, try again later
+                print("Failed to poll gists: {!r}".format(e))
+                changed = False
+
+            if changed or db.get_retry_gists() or db.get_pending_gists():
+                gists = schedule_longest_first(tenant, collect_gists(tenant)[0])
+                print("Total number of gists to be synchronized: %d" % len(gists))
+                failed, pending = sync_gists([(tenant, g) for g in gists], driver_pool)
+                finish_sync(tenant, len(failed), [g for _, g in pending], gists)
+                interval = max(min_interval, interval // 2)
+            else:
+                interval = min(max_interval, int(interval * 1.5))
+
+            print("Next poll in {} seconds.".format(interval))
+            time.sleep(interval)
+    finally:
+        driver_pool.quit()
+
+
+def coordinate(queue=JOBS_FILE, interval=60, once=False):
+    """List gists to be synchronized and enqueue them as jobs for workers.
+
+    Results reported by workers are saved into database in the next cycle,
+    failed jobs go to the retry queue of database. Gists whose job is still
+    running or not collected yet are checkpointed and enqueued in the next cycle.
+
+    Parameters
+    ----------
+    queue : str, optional
+        Location of the job queue shared with workers, see `jobs.get_queue`
+
+    interval : int, optional
+        Seconds between two cycles of listing gists and collecting results
+
+    once : bool, optional
+        Run a single cycle and exit
+
+    """
+    tenant = get_default_tenant()
+    db = tenant.db
+    get_sync_notebook(tenant)
+    job_queue = get_queue(queue)
+
+    while True:
+        collect_job_results(tenant, job_queue)
+        gists = schedule_longest_first(tenant, collect_gists(tenant)[0])
+        busy = [gist for gist in gists if not job_queue.put(gist['id'], {
+            'gist': gist,
+            'note_guid': db.get_note_guid_by_id(gist['id']),
+            'hash': db.get_hash_by_id(gist['id']),
+            'file_hashes': db.get_file_hashes(gist['id'])})]
+        finish_sync(tenant, 0, busy, gists)
+        print("Jobs in queue: {}".format(job_queue.count()))
+
+        if once:
+            break
+        time.sleep(interval)
+
+
+def collect_job_results(tenant, job_queue):
+    """Save results of jobs finished by workers into database and search index.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    job_queue : jobs.JobQueue
+
+    """
+    db = tenant.db
+    for job in job_queue.pop_finished():
+        gist = job['payload']['gist']
+        if job['state'] == 'failed':
+            attempts = db.add_retry(gist, job['error'])
+            print("Failed to sync gist {} (attempt {}): {}".format(gist['name'], attempts, job['error']))
+            warn_given_up(gist, attempts)
+            continue
+
+        result = job['result']
+        gist.update(result.get('metrics', {}))
+        if result.get('file_hashes'):
+            gist['file_hashes'] = result['file_hashes']
+        if db.has_gist(gist['id']):
+            db.update_gist(gist, result['note_guid'], result['hash'], sync_time=False)
+        else:
+            db.save_gist(gist, result['note_guid'], result['hash'], sync_time=False)
+        db.remove_retry(gist['id'])
+        if 'contents' in result:
+            tenant.index.update_gist(gist, result['note_guid'], result['contents'])
+
+
+def work(queue=JOBS_FILE, lease_seconds=LEASE_SECONDS, idle_seconds=10, once=False):
+    """Lease jobs enqueued by the coordinator, render and upload the gists.
+
+    Workers never touch the local database. Start as many of them as needed,
+    on any machine that can reach the job queue.
+
+    Parameters
+    ----------
+    queue : str, optional
+        Location of the job queue shared with the coordinator
+
+    lease_seconds : int, optional
+        Seconds before a job is given to another worker if no heartbeat is received
+
+    idle_seconds : int, optional
+        Seconds to wait before asking for a job again when the queue is empty
+
+    once : bool, optional
+        Exit when the queue is empty
+
+    """
+    tenant = get_default_tenant()
+    get_sync_notebook(tenant)
+    job_queue = get_queue(queue)
+    worker = '{}-{}'.format(socket.gethostname(), os.getpid())
+    driver_pool = create_driver_pool(1)
+    # start processes before threads, forking a multi-threaded process is not safe
+    get_encode_pool()
+    get_watchdog()
+
+    try:
+        while True:
+            job = job_queue.lease(worker, lease_seconds)
+            if not job:
+                # read the upload allowance again for the next jobs, it is reset monthly
+                tenant.refresh_account_limits()
+                if once:
+                    break
+                time.sleep(idle_seconds)
+                continue
+
+            heartbeat = Heartbeat(job_queue, job, lease_seconds)
+            heartbeat.start()
+            try:
+                result = process_job(tenant, job, driver_pool, heartbeat)
+            except Exception as e:
+                print("Failed to process job {}: {!r}".format(job['id'], e))
+                job_queue.fail(job, e)
+            else:
+                if not job_queue.ack(job, result):
+                    print("Lease of job {} was lost, result discarded".format(job['id']))
+            finally:
+                heartbeat.stop()
+    finally:
+        driver_pool.quit()
+
+
+def process_job(tenant, job, driver_pool, heartbeat):
+    """Sync the gist of a leased job without using the local database.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    job : dict
+        Job returned by `jobs.JobQueue.lease`, its payload holds the gist
+        and the note guid / hash known by the coordinator
+
+    driver_pool : web.util.DriverPool
+
+    heartbeat : jobs.Heartbeat
+        Used to save the guid of a newly created note before acknowledgement,
+        so the note is updated rather than duplicated if the job is leased again
+
+    Returns
+    -------
+    result : dict
+        {'note_guid': str, 'hash': str, 'file_hashes': dict, 'contents': list, 'metrics': dict}
+
+    """
+    payload = job['payload']
+    gist = payload['gist']
+    note_guid, prev_hash = payload.get('note_guid'), payload.get('hash')
+    files = get_gist_files(gist['name'], token=tenant.github_token)
+    file_hashes = dict((f['filename'], f['hash']) for f in files)
+    matched, gist_hash = match_gist_files(tenant, gist, files, payload.get('file_hashes'), prev_hash)
+    if matched and note_guid:
+        return {'note_guid': note_guid, 'hash': gist_hash, 'file_hashes': file_hashes}
+
+    image_names, text_files = split_text_files(files)
+    note_title, capture = capture_with_deadline(gist, driver_pool, image_names,
+                                                languages=dict((f['filename'], f['language']) for f in files),
+                                                previews=[f['filename'] for f in text_files])
+    resources = encode_gist(gist, capture)
+    text_blocks = [(f['filename'], get_file_content(f, token=tenant.github_token)) for f in text_files]
+    resources = preflight_note(tenant, gist, note_title, resources, text_blocks)
+    gist['upload_bytes'] = sum(r.data.size for r in resources)
+    note = upload_gist(tenant, gist, note_title, resources, note_guid, text_blocks=text_blocks)
+    if not note_guid:
+        heartbeat.set_progress({'note_guid': note.guid})
+
+    # indexed by the coordinator as `sync_gist` does
+    contents = dict((f['filename'], f['content']) for f in files)
+    contents.update(text_blocks)
+    return {'note_guid': note.guid, 'hash': gist_hash, 'file_hashes': file_hashes,
+            'contents': [(f['filename'], contents[f['filename']]) for f in files],
+            'metrics': {'render_seconds': gist['render_seconds'], 'upload_bytes': gist['upload_bytes'],
+                        'source_bytes': sum(f['size'] for f in files)}}
+
+
+def collect_gists(tenant, reconcile=False, prune=False, expunge=False, listing=GIST_LISTING):
+    """List gists to be synchronized in this run.
+
+    Gists failed or left in previous runs come first, followed by gists
+    pushed after last synchronization (or all gists in cold-start mode).
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    reconcile : bool, optional
+        Rebuild the local index from the notebook and skip up-to-date gists
+
+    prune : bool, optional
+        Remove notes of gists that were deleted on Github
+
+    expunge : bool, optional
+        Permanently remove the pruned notes
+
+    listing : str, optional
+        "graphql" or "rest" to list gists, see `github.util.get_all_gists`
+
+    Returns
+    -------
+    gists : list of dict
+
+    failed_ids : set of str
+        Ids of gists failed in previous runs
+
+    """
+    db = tenant.db
+    token = tenant.github_token
+
+    # initialize, get all available gists
+    all_gists = None
+    if reconcile:
+        all_gists = get_all_gists(token=token, with_files=True, listing=listing)
+        synced_ids = rebuild_index(tenant, all_gists)
+        gists = [g for g in all_gists if g['id'] not in synced_ids]
+    elif db.is_empty() or db.is_cold_start():
+        gists = all_gists = get_all_gists(token=token, with_files=True, listing=listing)
+    # sync only gists that were pushed after last synchronization
+    else:
+        last_sync_date = db.get_last_sync()
+        print("Find gists that are updated after last sync (UTC): {}".format(last_sync_date))
+        if prune:
+            all_gists = get_all_gists(token=token, with_files=True, listing=listing)
+            gists = [g for g in all_gists
+                     if datetime.strptime(g['pushedAt'], DATE_FORMAT) > last_sync_date]
+        else:
+            gists = get_all_gists(after_date=last_sync_date, token=token, with_files=True, listing=listing)
+
+    if prune:
+        prune_deleted_gists(tenant, all_gists, expunge=expunge)
+
+    # drain gists failed or left in previous runs first, prefer the fresher listed version
+    listed = dict((g['id'], g) for g in gists)
+    retry_gists = [listed.get(g['id'], g) for g in db.get_retry_gists()]
+    pending_gists = [listed.get(g['id'], g) for g in db.get_pending_gists()]
+    if retry_gists or pending_gists:
+        print("Number of gists to be retried / resumed: %d / %d" % (len(retry_gists), len(pending_gists)))
+    return unique_gists(retry_gists + pending_gists + gists), set(g['id'] for g in retry_gists)
+
+
+def finish_sync(tenant, num_failed, pending, gists=()):
+    """Checkpoint the result of a synchronization run.
+
+    The last synchronization time only moves here, once every gist of the
+    run is synced, queued for retry or pending, so that an interrupted run
+    never skips gists in the next one.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    num_failed : int
+        Number of gists failed and put into the retry queue
+
+    pending : list of dict
+        Gists left, e.g. because the budget was used up, synced first in next run
+
+    gists : list of dict, optional
+        Gists of the run, the last synchronization time moves to the latest `pushedAt` of them
+
+    """
+    db = tenant.db
+    db.set_pending(pending)
+    if gists:
+        db.update_sync_time(max(g['pushedAt'] for g in gists))
+
+    # all gists synced or queued for retry, set to warm-start mode
+    if db.is_cold_start():
+        db.toggle_cold_start()
+
+    if num_failed:
+        print("{} gists failed and will be retried in next run.".format(num_failed))
+    if pending:
+        print("{} gists left will be synchronized first in next run.".format(len(pending)))
+
+
+def status(config=None):
+    """Show the state of synchronization without contacting Github or Evernote.
+
+    Print the last synchronization time, the number of gists waiting for
+    a retry or left by a budget, and gists given up after too many failures
+    along with their last error.
+
+    Parameters
+    ----------
+    config : str, optional
+        Path of the JSON file listing the accounts, see `tenants.load_tenants`.
+        The account of `settings.py` by default.
+
+    """
+    tenants = load_tenants(config) if config else [get_default_tenant()]
+    for tenant in tenants:
+        db = tenant.db
+        if len(tenants) > 1:
+            print("Tenant {}:".format(tenant.name))
+        print("Last synchronization (UTC): {}{}".format(
+            db.get_last_sync(), ' (cold start not finished)' if db.is_cold_start() else ''))
+        print("Gists to be retried: {} ({} due)".format(
+            len(db.get_retry_gists(due_only=False)), len(db.get_retry_gists())))
+        print("Gists left by a budget: {}".format(len(db.get_pending_gists())))
+
+        dead = db.get_dead_gists()
+        print("Gists given up: {}".format(len(dead)))
+        for entry in dead:
+            print("  {}/{} failed {} times, last at {}: {}".format(
+                GIST_BASE_URL, entry['gist']['name'], entry['attempts'], entry['failed_at'], entry['error']))
+        if dead:
+            print("Synchronize them again with `python app.py sync --gist <url>`.")
+
+
+def plan_sync(output=None):
+    """Show what the next synchronization would do and cost, without rendering anything.
+
+    Gists are classified as new / changed / unchanged / deleted using only
+    the listing from Github and the database. Render time and upload size
+    are estimated from metrics of past runs, or from file types and sizes.
+
+    Parameters
+    ----------
+    output : str, optional
+        Save the plan to this file for a later `apply`
+
+    """
+    tenant = get_default_tenant()
+    gists = get_all_gists(token=tenant.github_token, with_files=True)
+    sync_plan = make_plan(tenant.db, gists)
+    print(format_summary(sync_plan))
+    if output:
+        save_plan(sync_plan, output)
+        print("Plan saved to {}".format(output))
+
+
+def apply_plan(plan=PLAN_FILE, drivers=1, tabs=1, expunge=False):
+    """Synchronize the gists of a plan saved by `plan --output`.
+
+    New and changed gists are synced, notes of deleted gists are removed,
+    the difference is not computed again.
+
+    Parameters
+    ----------
+    plan : str, optional
+        Path of the saved plan
+
+    drivers : int, optional
+        Number of Chrome drivers rendering gists in parallel
+
+    tabs : int, optional
+        Number of tabs of each Chrome driver loading gists in parallel
+
+    expunge : bool, optional
+        Permanently remove notes of deleted gists instead of moving them to the trash
+
+    """
+    start = time.time()
+    tenant = get_default_tenant()
+    sync_plan = load_plan(plan)
+    print("Applying plan created at {} (UTC):".format(sync_plan['created_at']))
+    print(format_summary(sync_plan))
+    get_sync_notebook(tenant)
+
+    deleted_ids = [item['gist']['id'] for item in sync_plan['items'] if item['action'] == 'deleted']
+    if deleted_ids:
+        remove_gists(tenant, deleted_ids, expunge=expunge)
+
+    gists = [item['gist'] for item in sync_plan['items'] if item['action'] in ('new', 'changed')]
+    gists = schedule_longest_first(tenant, gists)
+    driver_pool = create_driver_pool(drivers, tabs=tabs)
+    failed, pending = sync_gists([(tenant, g) for g in gists], driver_pool)
+    driver_pool.quit()
+
+    finish_sync(tenant, len(failed), [g for _, g in pending], gists)
+    print("Synchronization took {:.0f} seconds.".format(time.time() - start))
+
+
+def search_gists(query, limit=10):
+    """Search synced gists by file names, descriptions and content, offline.
+
+    Parameters
+    ----------
+    query : str
+        Words to search, or a SQLite full-text query like '"exact phrase"' or 'merge NOT pandas'
+
+    limit : int, optional
+        Maximum number of gists shown
+
+    """
+    start = time.time()
+    tenant = get_default_tenant()
+    results = tenant.index.search(query, limit=limit)
+    for i, result in enumerate(results, 1):
+        print(u"{}. {} ({})".format(i, result['description'] or result['file_name'], result['file_name']))
+        print(u"   {}".format(' '.join(result['snippet'].split())))
+        print(u"   Gist: {}".format(result['gist_url']))
+        if result['note_url']:
+            print(u"   Note: {}".format(result['note_url']))
+    print("{} gists found in {:.0f} ms.".format(len(results), (time.time() - start) * 1e3))
+
+
+def rebuild_search_index():
+    """Index content of all gists in database, e.g. gists synced before search was available."""
+    tenant = get_default_tenant()
+    db = tenant.db
+    gist_ids = db.get_gist_ids()
+    for i, gist_id in enumerate(sorted(gist_ids), 1):
+        gist = db.get_gist(gist_id)
+        try:
+            files = get_gist_files(gist['name'], token=tenant.github_token)
+            contents = [(f['filename'], get_file_content(f, token=tenant.github_token)) for f in files]
+        except Exception as e:
+            print("Failed to index gist {}: {!r}".format(gist['name'], e))
+            continue
+        tenant.index.update_gist(gist, gist.get('note_guid'), contents)
+        print("Indexed {}/{} gists".format(i, len(gist_ids)))
+
+
+def export_gists(output_dir=ENEX_DIR, max_file_bytes=ENEX_MAX_BYTES, drivers=1, tabs=1, listing=GIST_LISTING):
+    """Render gists without a note into `.enex` files instead of creating notes one by one.
+
+    Meant for the first synchronization of many gists, which is otherwise
+    bound by Evernote API calls and rate limits. Import the files into the
+    sync notebook with an Evernote desktop client, then run
+    `python app.py reconcile` to link the imported notes to their gists.
+
+    Parameters
+    ----------
+    output_dir : str, optional
+        Directory to write the `.enex` files
+
+    max_file_bytes : int, optional
+        Approximate maximum size of each `.enex` file
+
+    drivers : int, optional
+        Number of Chrome drivers rendering gists in parallel
+
+    tabs : int, optional
+        Number of tabs of each Chrome driver loading gists in parallel
+
+    listing : str, optional
+        "graphql" or "rest" to list gists, see `github.util.get_all_gists`
+
+    """
+    start = time.time()
+    tenant = get_default_tenant()
+    gists = [g for g in get_all_gists(token=tenant.github_token, listing=listing) if not tenant.db.get_note_guid_by_id(g['id'])]
+    print("Total number of gists to be exported: %d" % len(gists))
+    if not gists:
+        return
+
+    def run(gist):
+        try:
+            export_gist(tenant, gist, driver_pool, writer)
+        except Exception as e:
+            print("Failed to export gist {}: {!r}".format(gist['name'], e))
+            return False
+        return True
+
+    # start processes before threads, forking a multi-threaded process is not safe
+    get_encode_pool()
+    driver_pool = create_driver_pool(drivers, tabs=tabs)
+    pool = ThreadPool(min(2 * driver_pool.capacity, len(gists)))
+    with EnexWriter(output_dir, max_bytes=max_file_bytes) as writer:
+        try:
+            exported = pool.map(run, gists, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            driver_pool.quit()
+
+    print("Exported {} gists into {} in {:.0f} seconds, {} failed.".format(
+        writer.num_notes, ', '.join(writer.files), time.time() - start, exported.count(False)))
+    print("Import the files into notebook '{}', then run `python app.py reconcile`.".format(tenant.notebook_name))
+
+
+def export_gist(tenant, gist, driver_pool, writer):
+    """Render the gist as `sync_gist` does and write the note with `writer` instead of uploading it.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gist : dict
+
+    driver_pool : web.util.DriverPool
+
+    writer : enex.EnexWriter
+
+    """
+    gist_url = '/'.join((GIST_BASE_URL, gist['name']))
+    files = get_gist_files(gist['name'], token=tenant.github_token)
+    image_names, text_files = split_text_files(files)
+    if image_names:
+        note_title, capture = capture_with_deadline(gist, driver_pool, image_names,
+                                                    languages=dict((f['filename'], f['language']) for f in files),
+                                                    previews=[f['filename'] for f in text_files])
+        resources = encode_gist(gist, capture)
+    else:
+        first_file = files[0]['filename'] if files else gist['name']
+        note_title = gist['description'] if gist['description'] else first_file
+        resources = []
+    text_blocks = [(f['filename'], get_file_content(f, token=tenant.github_token)) for f in text_files]
+    writer.write_note(note_title, format_note_body(gist), resources, source_url=gist_url, text_blocks=text_blocks)
+    print("Exported gist {}".format(gist_url))
+
+
+def reconcile():
+    """Rebuild the gist -> note index from the notebook without rendering any gist.
+
+    Run `python app.py sync` afterward to render only gists without a note.
+    Those gists are checkpointed as pending, so that the next run needs not
+    list all gists again, e.g. after importing notes exported by `export`.
+
+    """
+    tenant = get_default_tenant()
+    get_sync_notebook(tenant)
+    gists = get_all_gists(token=tenant.github_token)
+    synced_ids = rebuild_index(tenant, gists)
+    finish_sync(tenant, 0, [g for g in gists if g['id'] not in synced_ids], gists)
+
+
+def unique_gists(gists):
+    """Drop repeated gists by `id`, keep the first occurrence and the order.
+
+    Parameters
+    ----------
+    gists : list of dict
+
+    Returns
+    -------
+    gists : list of dict
+
+    """
+    seen = set()
+    unique = []
+    for gist in gists:
+        if gist['id'] not in seen:
+            seen.add(gist['id'])
+            unique.append(gist)
+    return unique
+
+
+def prioritize(tenant, gists, failed_ids=()):
+    """Order gists so that a budgeted run syncs the most valuable ones first.
+
+    Previously failed gists come first, then gists pushed more recently
+    (by day), then gists estimated to be cheaper to render.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gists : list of dict
+
+    failed_ids : set of str, optional
+        Ids of gists failed in previous runs
+
+    Returns
+    -------
+    gists : list of dict
+
+    """
+    gists = sorted(gists, key=lambda g: estimate_render_seconds(tenant, g))
+    gists = sorted(gists, key=lambda g: g['pushedAt'][:10], reverse=True)
+    return sorted(gists, key=lambda g: g['id'] not in failed_ids)
+
+
+def estimate_render_seconds(tenant, gist, calibration=None):
+    """Estimate seconds needed to render the gist.
+
+    Seconds taken by the previous synchronization are used if known,
+    otherwise they are estimated from types and sizes of files listed
+    with the gist, see `plan.estimate_cost`.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gist : dict
+
+    calibration : dict, optional
+        Returned by `plan.get_calibration`
+
+    Returns
+    -------
+    seconds : float
+
+    """
+    seconds = tenant.db.get_render_seconds(gist['id'])
+    if seconds:
+        return seconds
+    if gist.get('files'):
+        return estimate_cost(tenant.db, gist, calibration)[0]
+    return DEFAULT_RENDER_SECONDS
+
+
+def schedule_longest_first(tenant, gists):
+    """Order gists of a tenant by estimated render time, longest first.
+
+    Threads of `sync_gists` take the next gist as soon as a tab is free,
+    so starting with the longest gists is the LPT rule: a giant notebook
+    does not start last while the other tabs sit idle, and the total time
+    stays within 4/3 of the optimum. Gists failed or left in previous runs
+    stay in front, as put by `collect_gists`.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gists : list of dict
+
+    Returns
+    -------
+    gists : list of dict
+
+    """
+    db = tenant.db
+    drained = set(g['id'] for g in db.get_retry_gists() + db.get_pending_gists())
+    calibration = get_calibration(db)
+    costs = dict((g['id'], estimate_render_seconds(tenant, g, calibration)) for g in gists)
+    head = [g for g in gists if g['id'] in drained]
+    rest = sorted((g for g in gists if g['id'] not in drained), key=lambda g: costs[g['id']], reverse=True)
+    if costs:
+        print("Estimated render time of {} gists: {:.0f} seconds in total, longest gist {:.0f} seconds".format(
+            len(gists), sum(costs.values()), max(costs.values())))
+    return head + rest
+
+
+def prune_deleted_gists(tenant, gists, expunge=False):
+    """Remove notes and database entries of gists that no longer exist on Github.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gists : list of dict
+        Complete listing of gists available in the Github account
+
+    expunge : bool, optional
+        Permanently remove the notes instead of moving them to the trash
+
+    Returns
+    -------
+    deleted_ids : set of str
+        Ids of gists removed from database
+
+    """
+    db = tenant.db
+    deleted_ids = db.get_gist_ids() - set(g['id'] for g in gists)
+    if not deleted_ids:
+        return deleted_ids
+
+    # an empty listing is more likely a Github hiccup than deleting every gist
+    if not gists:
+        print("No gist listed, skip removing {} notes.".format(len(deleted_ids)))
+        return set()
+
+    remove_gists(tenant, deleted_ids, expunge=expunge)
+    return deleted_ids
+
+
+def remove_gists(tenant, gist_ids, expunge=False):
+    """Remove notes and database entries of given gists.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gist_ids : iterable of str
+
+    expunge : bool, optional
+        Permanently remove the notes instead of moving them to the trash
 
-    # find notebook to put new notes
-    notebooks = get_notebooks()
-    for n in notebooks:
-        if n.name == NOTEBOOK_TO_SYNC:
-            notebook = get_notebook(n.guid)
+    """
+    db = tenant.db
+    note_guids = [db.get_note_guid_by_id(gist_id) for gist_id in gist_ids]
+    num_removed = delete_notes([guid for guid in note_guids if guid], expunge=expunge,
+                               token=tenant.evernote_token)
+    db.remove_gists(gist_ids)
+    tenant.index.remove_gists(gist_ids)
+    print("Removed {} notes of {} deleted gists.".format(num_removed, len(note_guids)))
 
-    # create notebook with the specified name if not found
-    if not notebook:
-        notebook = create_notebook(NOTEBOOK_TO_SYNC)
-    print('Using notebook: %s' % notebook.name)
 
-    # initialize, get all available gists
-    if db.is_empty() or db.is_cold_start():
-        gists = get_all_gists()
-    # sync only gists that were pushed after last synchronization
+def get_sync_notebook(tenant, cached=False):
+    """Return the notebook of tenant to put notes in, create it if not exist yet.
+
+    The notebook is also saved as `tenant.notebook`, and its guid into database.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    cached : bool, optional
+        Use the notebook guid saved by a previous run without asking Evernote.
+        The returned notebook only has `guid` and `name` then.
+
+    Returns
+    -------
+    notebook : evernote.edam.type.ttypes.Notebook
+
+    """
+    guid = tenant.db.get_notebook_guid(tenant.notebook_name) if cached else None
+    if guid:
+        tenant.notebook = Notebook(guid=guid, name=tenant.notebook_name)
+        return tenant.notebook
+
+    token = tenant.evernote_token
+
+    # find notebook to put new notes
+    for n in get_notebooks(token=token):
+        if n.name == tenant.notebook_name:
+            nb = get_notebook(n.guid, token=token)
+            break
+    # create notebook with the specified name if not found
     else:
-        last_sync_date = db.get_last_sync()
-        print("Find gists that are updated after last sync (UTC): {}".format(last_sync_date))
-        gists = get_all_gists(after_date=last_sync_date)
+        nb = create_notebook(tenant.notebook_name, token=token)
+    print('Using notebook: %s' % nb.name)
+    tenant.notebook = nb
+    tenant.db.set_notebook_guid(tenant.notebook_name, nb.guid)
+    return nb
 
-    print("Total number of gists to be synchronized: %d" % len(gists))
 
-    # headless mode to reduce overhead and distraction
-    driver = create_chrome_driver() if gists else None
-    for gist in gists:
-        _ = sync_gist(gist, driver=driver)
-    if driver:
-        driver.quit()
-
-    # TODO multi-processes + mysql
-    # setup multiple selenium drivers to speed up if multiple cpu available
-    # num_processes = min(4, cpu_count() - 1) if cpu_count() > 1 else 1
-    # print("Number of %d processes being created" % num_processes)
-    # pool = Pool(num_processes)
-    #
-    # notes = pool.map(sync_gist, gists)
-    #
-    # pool.terminate()
-    # pool.close()
-    # pool.join()
-
-    # sync all gists successfully, set to warm-start mode
-    if db.is_cold_start():
-        db.toggle_cold_start()
+def rebuild_index(tenant, gists):
+    """Match notes in the sync notebook to `gists` and save the links into database.
 
-    print("Synchronization took {:.0f} seconds.".format(time.time() - start))
+    Notes are matched by their `sourceURL` attribute, or by the gist url embedded
+    by `format_note_body` for notes created before the attribute was set.
+    A note is considered up-to-date if it was updated after the gist was pushed,
+    otherwise only the link is saved so the note will be updated instead of duplicated.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gists : list of dict
+        All gists available in the Github account
+
+    Returns
+    -------
+    synced_ids : set of str
+        Ids of gists whose note is found and up-to-date
+
+    """
+    db = tenant.db
+    gists_by_name = dict((g['name'], g) for g in gists)
+    synced_ids = set()
+    notes = get_notes_metadata(tenant.notebook.guid, token=tenant.evernote_token)
+    print("Reconciling {} notes with {} gists".format(len(notes), len(gists)))
+
+    for note in notes:
+        gist_name = get_gist_name_of_note(tenant, note)
+        gist = gists_by_name.get(gist_name)
+        if not gist:
+            continue
+        if db.get_note_guid_by_id(gist['id']) not in ('', note.guid):
+            print("Duplicate note {} for gist {}, ignore.".format(note.guid, gist_name))
+            continue
+
+        # only trust the note content if it was updated after the gist
+        pushed_at = calendar.timegm(datetime.strptime(gist['pushedAt'], DATE_FORMAT).timetuple()) * 1e3
+        if note.updated and note.updated >= pushed_at:
+            gist_hash = get_gist_hash(tenant.github_user, gist_name)
+            # so that the next run tells unchanged gists of several files, see `match_gist_files`
+            files = get_gist_files(gist_name, token=tenant.github_token)
+            gist['file_hashes'] = dict((f['filename'], f['hash']) for f in files)
+            synced_ids.add(gist['id'])
+        else:
+            gist_hash = ''
+
+        if db.has_gist(gist['id']):
+            db.update_gist(gist, note.guid, gist_hash, sync_time=False)
+        else:
+            db.save_gist(gist, note.guid, gist_hash, sync_time=False)
+
+    print("Linked {} notes, {} of them are up-to-date.".format(
+        sum(1 for g in gists if db.get_note_guid_by_id(g['id'])), len(synced_ids)))
+    return synced_ids
+
+
+def get_gist_name_of_note(tenant, note):
+    """Return name of the gist which the note was created from.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    note : evernote.edam.notestore.ttypes.NoteMetadata
+
+    Returns
+    -------
+    gist_name : str
+        None if the note does not refer to any gist
+
+    """
+    source_url = note.attributes.sourceURL if note.attributes else None
+    if not source_url:
+        # notes created before `sourceURL` was set only embed the url in content,
+        # after the description which may link to other gists
+        content = get_note_content(note.guid, token=tenant.evernote_token) or ''
+        links = GIST_LINK_PATTERN.findall(content) or [m.group(0) for m in GIST_URL_PATTERN.finditer(content)]
+        source_url = links[-1] if links else None
+
+    match = GIST_URL_PATTERN.search(source_url or '')
+    return match.group(1) if match else None
+
+
+def sync_gists(items, driver_pool, budget=None):
+    """Sync gists in parallel, failure of a gist does not stop the others.
+
+    Each gist is synced by a thread borrowing a tab from `driver_pool`
+    only while capturing, so that the driver moves on to the next gist while
+    images are encoded and uploaded.
+    Failed gists are put into the retry queue of tenant's database with backoff,
+    succeeded ones are removed from the queue.
+    With `ADAPTIVE_CONCURRENCY`, the number of gists rendered and uploaded at
+    the same time is adjusted from feedback, see `concurrency.AdaptiveLimit`.
+
+    Parameters
+    ----------
+    items : list of (tenants.Tenant, dict)
+        Gists to be synced along with their tenant, synced in order,
+        see `prioritize` and `schedule_longest_first`
+
+    driver_pool : web.util.DriverPool
+        The web drivers used to access gist url
+
+    budget : SyncBudget, optional
+        Stop once the budget is used up
+
+    Returns
+    -------
+    failed : list of (tenants.Tenant, dict)
+
+    pending : list of (tenants.Tenant, dict)
+        Gists not synchronized because the budget was used up
 
+    """
+    budget_used_up = threading.Event()
+
+    def run(item):
+        tenant, gist = item
+        if budget_used_up.is_set() or \
+                (budget and not budget.can_start(estimate_render_seconds(tenant, gist))):
+            budget_used_up.set()
+            return 'pending'
+        try:
+            sync_gist(tenant, gist, driver_pool, budget=budget, render_limit=render_limit,
+                      upload_limit=upload_limit)
+        except BudgetExceeded:
+            budget_used_up.set()
+            return 'pending'
+        except Exception as e:
+            attempts = tenant.db.add_retry(gist, e)
+            print("Failed to sync gist {} (attempt {}): {!r}".format(gist['name'], attempts, e))
+            warn_given_up(gist, attempts)
+            return 'failed'
+        tenant.db.remove_retry(gist['id'])
+        return 'done'
+
+    if not items:
+        return [], []
+    # the upload allowance is reset monthly, read it once per run
+    for tenant in set(tenant for tenant, _ in items):
+        tenant.refresh_account_limits()
+    render_limit = upload_limit = None
+    if ADAPTIVE_CONCURRENCY:
+        render_limit = AdaptiveLimit('render', driver_pool.capacity)
+        upload_limit = AdaptiveLimit('upload', MAX_CONCURRENT_UPLOADS, is_throttle=is_rate_limited)
+
+    # start processes before threads, forking a multi-threaded process is not safe
+    get_encode_pool()
+    get_watchdog()
+    states = get_sync_pool(2 * driver_pool.capacity).map(run, items, chunksize=1)
+
+    failed = [item for item, state in zip(items, states) if state == 'failed']
+    pending = [item for item, state in zip(items, states) if state == 'pending']
+    return failed, pending
+
+
+def warn_given_up(gist, attempts):
+    """Tell the user how to sync a gist again once the retry queue has given it up"""
+    if attempts >= RETRY_MAX_ATTEMPTS:
+        print("Gist {} is given up after {} attempts, it is listed by `python app.py status`. "
+              "Run `python app.py sync --gist {}` once the problem is fixed.".format(
+                  gist['name'], attempts, gist['name']))
+
+
+def get_sync_pool(size):
+    """Return the thread pool of `sync_gists`, kept for the whole process.
+
+    Evernote clients are cached per thread, see `enote.util.get_note_store`,
+    so reusing the same threads keeps them warm across runs, e.g. of `daemon`,
+    instead of looking up the NoteStore url again every run.
+
+    Parameters
+    ----------
+    size : int
+        Minimum number of threads, the pool is replaced by a larger one if needed
+
+    Returns
+    -------
+    pool : multiprocessing.pool.ThreadPool
 
-def sync_gist(gist, driver):
+    """
+    global _sync_pool
+    with _sync_pool_lock:
+        if _sync_pool is None or _sync_pool[0] < size:
+            if _sync_pool is not None:
+                _sync_pool[1].close()
+            _sync_pool = (size, ThreadPool(size))
+        return _sync_pool[1]
+
+
+def sync_gist(tenant, gist, driver_pool, budget=None, render_limit=None, upload_limit=None):
     """Sync the Github gist to the corresponding Evernote note.
 
     Create a new Evernote note if there is no corresponding one with the gist.
-    Overwrite existing note's content if gist has been changed.
+    Overwrite existing note's content if gist has been changed: each file
+    of the gist is a resource of the note, only files changed since last
+    synchronization are rendered and swapped in.
 
     Parameters
     ----------
+    tenant : tenants.Tenant
+        The account the gist belongs to
+
     gist : dict
         A Gist acquired by Github GraphQL API with format like:
             {
@@ -92,8 +1334,17 @@ def sync_gist(gist, driver):
 
             }
 
-    driver : selenium.webdriver
-        The web driver used to access gist url
+    driver_pool : web.util.DriverPool
+        The web drivers used to access gist url
+
+    budget : SyncBudget, optional
+        Raise BudgetExceeded instead of uploading beyond the budget
+
+    render_limit : concurrency.AdaptiveLimit, optional
+        Limit of gists captured at the same time
+
+    upload_limit : concurrency.AdaptiveLimit, optional
+        Limit of notes uploaded at the same time
 
     Returns
     -------
@@ -101,22 +1352,151 @@ def sync_gist(gist, driver):
         None if no new note created or updated
 
     """
-    note_exist = False
+    db = tenant.db
     gist_url = '/'.join((GIST_BASE_URL, gist['name']))
 
-    # check existing gist hash before fetch if available
+    # compare hash of each file before rendering anything
     prev_hash = db.get_hash_by_id(gist['id'])
     note_guid = db.get_note_guid_by_id(gist['id'])
-    if prev_hash and note_guid:
-        note_exist = True
-        cur_hash = get_gist_hash(github_user, gist['name'])
-        if prev_hash == cur_hash:
-            print('Gist {} remain the same, ignore.'.format(gist_url))
-            db.update_gist(gist, note_guid, cur_hash)
-            return None
+    files = get_gist_files(gist['name'], token=tenant.github_token)
+    prev_file_hashes = db.get_file_hashes(gist['id'])
+    matched, gist_hash = match_gist_files(tenant, gist, files, prev_file_hashes, prev_hash)
+    if matched and note_guid:
+        print('Gist {} remain the same, ignore.'.format(gist_url))
+        gist['file_hashes'] = dict((f['filename'], f['hash']) for f in files)
+        db.update_gist(gist, note_guid, gist_hash, sync_time=False)
+        return None
+
+    # keep resources of files unchanged since last synchronization
+    image_names, text_files = split_text_files(files)
+    existing, kept = {}, {}
+    if note_guid:
+        note = get_note(note_guid, token=tenant.evernote_token)
+        existing = dict((r.attributes.fileName, r) for r in note.resources or []
+                        if r.attributes and r.attributes.fileName)
+    if prev_file_hashes:
+        # images split to fit Evernote limits are kept with all their parts
+        parts = group_resource_parts(existing.values())
+        kept = dict((f['filename'], parts[f['filename']]) for f in files
+                    if f['filename'] in parts and prev_file_hashes.get(f['filename']) == f['hash'])
+
+    to_render = [name for name in image_names if name not in kept]
+    if to_render:
+        note_title, capture = capture_with_deadline(gist, driver_pool, to_render,
+                                                    languages=dict((f['filename'], f['language']) for f in files),
+                                                    previews=[f['filename'] for f in text_files],
+                                                    render_limit=render_limit)
+        rendered = encode_gist(gist, capture)
+        if kept:
+            # only rendering every file tells the cost of the gist, keep the one recorded before
+            gist.pop('render_seconds', None)
+    else:
+        # nothing to capture, e.g. text-only gists, no need to load the page
+        first_file = files[0]['filename'] if files else gist['name']
+        note_title = gist['description'] if gist['description'] else first_file
+        rendered = []
+        gist.pop('render_seconds', None)
+        gist['upload_bytes'] = 0
+    text_blocks = [(f['filename'], get_file_content(f, token=tenant.github_token)) for f in text_files]
+    rendered = dict((r.attributes.fileName, r) for r in rendered)
+    resources = []
+    for name in image_names:
+        resources += kept.get(name) or [rendered[name]]
+    # parts of split images are compared once split again
+    resources = reuse_unchanged(resources, existing)
+    resources = reuse_unchanged(preflight_note(tenant, gist, note_title, resources, text_blocks), existing)
+    gist['upload_bytes'] = sum(r.data.size for r in resources if r.data.body is not None)
+    if budget:
+        budget.reserve_upload(gist['upload_bytes'] + sum(len(text.encode('utf-8')) for _, text in text_blocks))
+    print("Gist {}: {} of {} files rendered, {} as text".format(
+        gist_url, len(rendered), len(files), len(text_blocks)))
+
+    # save gist info with hash of raw gist content checked before rendering to database
+    gist['file_hashes'] = dict((f['filename'], f['hash']) for f in files)
+    gist['source_bytes'] = sum(f['size'] for f in files)
+
+    # create new note / update existing note
+    with limited(upload_limit):
+        note = upload_gist(tenant, gist, note_title, resources, note_guid, text_blocks=text_blocks)
+    if not note_guid:
+        db.save_gist(gist, note.guid, gist_hash, sync_time=False)
+    else:
+        db.update_gist(gist, note_guid, gist_hash, sync_time=False)
+
+    # text files were fetched in full, others are indexed as listed by the API
+    contents = dict((f['filename'], f['content']) for f in files)
+    contents.update(text_blocks)
+    tenant.index.update_gist(gist, note_guid or note.guid, [(f['filename'], contents[f['filename']]) for f in files])
+
+    print("Finish creating note for gist {}".format(gist_url))
+    return note
+
+
+def capture_with_deadline(gist, driver_pool, file_names=None, languages=None, previews=(), render_limit=None):
+    """Run `capture_gist` with a driver of the pool, which is quit if the capture fails or runs past its deadline.
+
+    A stuck driver is quit by the watchdog so the capture fails rather than
+    hanging, and a driver that failed is never handed to the next gist.
+
+    Parameters
+    ----------
+    gist : dict
+
+    driver_pool : web.util.DriverPool
+
+    file_names, languages, previews
+        See `capture_gist`
+
+    render_limit : concurrency.AdaptiveLimit, optional
+        Slot held while rendering
+
+    Returns
+    -------
+    See `capture_gist`
+
+    """
+    gist_url = '/'.join((GIST_BASE_URL, gist['name']))
+    with limited(render_limit), driver_pool.driver() as driver, \
+            get_watchdog().deadline('capture', DEADLINES['capture'], lambda: driver_pool.discard(driver), gist_url):
+        try:
+            return capture_gist(gist, driver, file_names, languages=languages, previews=previews)
+        except Exception:
+            driver_pool.discard(driver)
+            raise
+
+
+def capture_gist(gist, driver, file_names=None, languages=None, previews=()):
+    """Capture files of the gist with `driver`, images are encoded by the encode pool meanwhile.
+
+    The driver is free to render the next gist once this function returns,
+    call `encode_gist` to wait for the images.
+
+    Parameters
+    ----------
+    gist : dict
+
+    driver : selenium.webdriver
+        The web driver used to access gist url
+
+    file_names : list of str, optional
+        Files to be captured, all files on the page by default
+
+    languages : dict, optional
+        File name -> Github language, used to choose the device scale of the capture
 
+    previews : list of str, optional
+        Files of which only the first screenful is captured
 
+    Returns
+    -------
+    note_title : str
 
+    capture : dict
+        Pending encoding of each file, to be passed to `encode_gist`
+
+    """
+    gist_url = '/'.join((GIST_BASE_URL, gist['name']))
+    render_start = time.time()
     driver.get(gist_url)
     # wait at most x seconds for Github rendering gist context
     delay_seconds = 10
@@ -124,33 +1504,343 @@ def sync_gist(gist, driver):
         WebDriverWait(driver, delay_seconds).until(EC.presence_of_element_located((By.CLASS_NAME, 'is-render-ready')))
     except TimeoutException:
         print("Take longer than {} seconds to load page.".format(delay_seconds))
+    if DETERMINISTIC_CAPTURE:
+        stabilize_page(driver)
 
-    # get first file name as default note title
-    gist_title = driver.find_element(By.CLASS_NAME, 'gist-header-title>a').text
+    # get first file name as default note title, fall back to gist name if missing
+    title_elements = driver.find_elements(By.CSS_SELECTOR, '.gist-header-title>a')
+    gist_title = title_elements[0].text if title_elements else gist['name']
+    note_title = gist['description'] if gist['description'] else gist_title
 
-    # take screen shot for the gist and save it temporally
-    image_path = 'images/{}.png'.format(gist['name'])
-    fullpage_screenshot(driver, image_path)
+    if file_names is None:
+        file_names = get_gist_file_names(driver)
 
-    # build skeleton for note (including screenshot)
-    resource, _ = create_resource(image_path)
-    note_title = gist['description'] if gist['description'] else gist_title
+    # take screen shot for each file and save it temporally
+    encode_pool = get_encode_pool()
+    image_dir = tempfile.mkdtemp(prefix='gist-evernote-')
+    capture = {'dir': image_dir, 'start': render_start, 'pool': encode_pool, 'encodings': []}
+    try:
+        # other tabs of the browser wait while screenshots of this one are taken
+        with exclusive(driver):
+            for i, file_name in enumerate(file_names):
+                assert isolate_gist_file(driver, file_name), 'File {} not found in gist {}'.format(
+                    file_name, gist_url)
+                image_path = os.path.join(image_dir, '{}_{}.png'.format(gist['name'], i))
+                if file_name in previews:
+                    job = capture_preview(driver, image_path, '.gist-evernote-capture')
+                elif CAPTURE_MODE == 'fitted':
+                    scale = DEVICE_SCALES.get((languages or {}).get(file_name), DEFAULT_DEVICE_SCALE)
+                    job = capture_fitted(driver, image_path, '.gist-evernote-capture', scale=scale)
+                else:
+                    job = capture_fullpage(driver, image_path)
+
+                # encode the image in another process while capturing next file
+                capture['encodings'].append((file_name, encode_pool.apply_async(encode_image, (job,))))
+    except Exception:
+        shutil.rmtree(image_dir, ignore_errors=True)
+        raise
+    return note_title, capture
+
+
+def encode_gist(gist, capture):
+    """Wait for images captured by `capture_gist` and build note resources from them.
+
+    Seconds taken and bytes to upload are recorded into `gist` as
+    `render_seconds` and `upload_bytes` for scheduling later runs.
+
+    Parameters
+    ----------
+    gist : dict
+
+    capture : dict
+        Returned by `capture_gist`
+
+    Returns
+    -------
+    resources : list of evernote.edam.type.ttypes.Resource
+        One resource per file with the file name as attribute `fileName`
+
+    """
+    resources = []
+    try:
+        for file_name, encoding in capture['encodings']:
+            try:
+                result = encoding.get(DEADLINES['encode'])
+            except TimeoutError:
+                # the stuck process would hold its slot forever, start a fresh pool
+                reset_encode_pool(capture['pool'])
+                raise DeadlineExceeded('encode of {} took longer than {} seconds'.format(
+                    file_name, DEADLINES['encode']))
+
+            # build skeleton for note (including screenshot)
+            resource, _ = create_resource(result['file'], file_name=file_name, hexhash=result['hexhash'])
+            resources.append(resource)
+    finally:
+        shutil.rmtree(capture['dir'], ignore_errors=True)
+
+    # record cost of the gist for scheduling later runs
+    gist['render_seconds'] = round(time.time() - capture['start'], 1)
+    gist['upload_bytes'] = sum(r.data.size for r in resources)
+    return resources
+
+
+def split_text_files(files):
+    """Decide which files of a gist are put into the note as text instead of images.
+
+    Files with an extension of `TEXT_MODE_EXTENSIONS`, or larger than
+    `TEXT_MODE_MIN_BYTES` / `TEXT_MODE_MIN_LINES` are put as text, with an
+    image of their first screenful if `TEXT_MODE_PREVIEW` is set.
+
+    Parameters
+    ----------
+    files : list of dict
+        Returned by `github.util.get_gist_files`
+
+    Returns
+    -------
+    image_names : list of str
+        Files to be captured as images, including previews of text files
+
+    text_files : list of dict
+
+    """
+    image_names, text_files = [], []
+    for f in files:
+        extension = os.path.splitext(f['filename'])[1].lower()
+        as_text = f['language'] not in IMAGE_ONLY_LANGUAGES and (
+            extension in TEXT_MODE_EXTENSIONS or f['size'] >= TEXT_MODE_MIN_BYTES
+            or f['truncated'] or f['content'].count('\n') + 1 >= TEXT_MODE_MIN_LINES)
+        if as_text:
+            text_files.append(f)
+        if not as_text or TEXT_MODE_PREVIEW:
+            image_names.append(f['filename'])
+    return image_names, text_files
+
+
+def match_gist_files(tenant, gist, files, prev_file_hashes, prev_hash=None):
+    """Check whether files of the gist are the same as in last synchronization.
+
+    Each file is compared by the hash returned by `get_gist_files`, as
+    the raw url of a gist only serves its first file. Gists synced before
+    hashes of files were saved are compared by the hash of raw content,
+    which only tells for gists with a single file.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gist : dict
+
+    files : list of dict
+        Returned by `github.util.get_gist_files`
+
+    prev_file_hashes : dict
+        File name -> hash saved in last synchronization, see `db.Database.get_file_hashes`
+
+    prev_hash : str, optional
+        Hash of raw content saved in last synchronization
+
+    Returns
+    -------
+    matched : bool
+
+    hash : str
+        Hash of raw content to save, see `web.util.match_gist_hash`
+
+    """
+    if prev_file_hashes:
+        if prev_file_hashes == dict((f['filename'], f['hash']) for f in files) and prev_hash:
+            return True, prev_hash
+        return False, get_gist_hash(tenant.github_user, gist['name'])
+
+    # hashes of older schemes are replaced by the current one if content remains the same
+    matched, gist_hash = match_gist_hash(tenant.github_user, gist['name'], prev_hash)
+    return matched and len(files) == 1, gist_hash
+
+
+def reuse_unchanged(resources, existing):
+    """Replace rendered resources identical to the ones already in the note, which need no upload.
+
+    Renders are deterministic, so a file rendered again often gives the same image.
+
+    Parameters
+    ----------
+    resources : list of evernote.edam.type.ttypes.Resource
+
+    existing : dict
+        File name -> resource of the note, without data
+
+    Returns
+    -------
+    resources : list of evernote.edam.type.ttypes.Resource
+
+    """
+    reused = []
+    for resource in resources:
+        previous = existing.get(resource.attributes.fileName) if resource.data.body is not None else None
+        if previous is not None and get_resource_hexhash(previous) == resource.data.bodyHash:
+            resource = previous
+        reused.append(resource)
+    return reused
+
+
+def group_resource_parts(resources):
+    """Group resources of a note by the gist file they were rendered from.
+
+    An image split by `shrink_resource` is made of resources named like
+    "<file name> (1/3)". Files missing some of their parts are left out,
+    so that they are rendered again.
+
+    Parameters
+    ----------
+    resources : list of evernote.edam.type.ttypes.Resource
+
+    Returns
+    -------
+    parts : dict
+        File name -> list of resources, from top to bottom
+
+    """
+    groups = {}
+    for resource in resources:
+        match = PART_NAME_PATTERN.match(resource.attributes.fileName)
+        if match:
+            name, index, count = match.group(1), int(match.group(2)), int(match.group(3))
+        else:
+            name, index, count = resource.attributes.fileName, 1, 1
+        groups.setdefault((name, count), {})[index] = resource
+
+    parts = {}
+    for (name, count), group in groups.items():
+        if sorted(group) == list(range(1, count + 1)):
+            parts[name] = [group[i] for i in sorted(group)]
+    return parts
+
+
+def shrink_resource(resource, max_bytes, split=True):
+    """Re-encode a rendered resource into resources of at most `max_bytes`, see `web.util.fit_image`
+
+    Returns
+    -------
+    resources : list of evernote.edam.type.ttypes.Resource
+        Parts are named like "<file name> (1/3)"
+
+    """
+    parts = fit_image(bytes(resource.data.body), max_bytes, split=split)
+    file_name = resource.attributes.fileName if resource.attributes else None
+    if len(parts) == 1:
+        return [build_resource(parts[0], resource.mime, file_name)[0]]
+    return [build_resource(part, resource.mime, PART_NAME_FORMAT.format(file_name, i, len(parts)))[0]
+            for i, part in enumerate(parts, 1)]
+
+
+def preflight_note(tenant, gist, note_title, resources, text_blocks=None):
+    """Check the note of a gist against limits of the Evernote account before uploading it.
+
+    Rendered resources larger than allowed are re-encoded, split or downscaled,
+    and if the whole note is still too large, rendered resources are downscaled
+    evenly. Resources kept from the existing note are left as they are.
+    The upload must fit in the remaining allowance of the account, which is
+    only reduced once the upload succeeded, see `upload_gist`.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gist : dict
+
+    note_title : str
+
+    resources : list of evernote.edam.type.ttypes.Resource
+
+    text_blocks : list of (str, str), optional
+
+    Returns
+    -------
+    resources : list of evernote.edam.type.ttypes.Resource
+        Resources to upload instead of `resources`
+
+    Raises
+    ------
+    AssertionError
+        If Evernote would still reject the note, so that the gist is retried later
+        without wasting an API call
+
+    """
+    limits = tenant.account_limits
     note_body = format_note_body(gist)
 
-    # get hash of raw gist content and save gist info to database
-    gist_hash = get_gist_hash(github_user, gist['name'])
+    fitted = []
+    for resource in resources:
+        if resource.data.body is not None and resource.data.size > limits['resource_bytes']:
+            fitted += shrink_resource(resource, limits['resource_bytes'])
+        else:
+            fitted.append(resource)
 
-    # create new note / update existing note
-    if not note_exist:
-        note = create_note(note_title, note_body, [resource], parent_notebook=notebook)
-        db.save_gist(gist, note.guid, gist_hash)
+    note_content = build_note_content(note_body, fitted, text_blocks)
+    note_bytes = len(note_content) + sum(r.data.size for r in fitted)
+    new_bytes = sum(r.data.size for r in fitted if r.data.body is not None)
+    if note_bytes > limits['note_bytes'] and new_bytes:
+        ratio = max(0., limits['note_bytes'] - (note_bytes - new_bytes)) * SHRINK_MARGIN / new_bytes
+        if ratio > 0:
+            fitted = [shrink_resource(r, int(r.data.size * ratio), split=False)[0] if r.data.body is not None
+                      else r for r in fitted]
+            note_content = build_note_content(note_body, fitted, text_blocks)
+
+    if len(fitted) != len(resources) or any(a is not b for a, b in zip(fitted, resources)):
+        print("Gist {}: resources re-encoded from {} to {} bytes to fit Evernote limits".format(
+            gist['name'], sum(r.data.size for r in resources), sum(r.data.size for r in fitted)))
+
+    with _allowance_lock:
+        problems = check_note(build_note_title(note_title), note_content, fitted, limits)
+    assert not problems, 'Note of gist {} would be rejected by Evernote: {}'.format(
+        gist['name'], '; '.join(problems))
+    return fitted
+
+
+def upload_gist(tenant, gist, note_title, resources, note_guid=None, text_blocks=None):
+    """Create a new note for the gist, or update the existing one with `note_guid`.
+
+    Parameters
+    ----------
+    tenant : tenants.Tenant
+
+    gist : dict
+
+    note_title : str
+
+    resources : list of evernote.edam.type.ttypes.Resource
+
+    note_guid : str, optional
+        Guid of the note already synced with the gist
+
+    text_blocks : list of (str, str), optional
+        (file name, content) of files put into the note as text
+
+    Returns
+    -------
+    note : evernote.edam.type.ttypes.Note
+
+    """
+    gist_url = '/'.join((GIST_BASE_URL, gist['name']))
+    note_body = format_note_body(gist)
+
+    token = tenant.evernote_token
+
+    if not note_guid:
+        note = create_note(note_title, note_body, resources, parent_notebook=tenant.notebook,
+                           source_url=gist_url, token=token, text_blocks=text_blocks)
+        assert note is not None, 'Failed to create note for gist {}'.format(gist_url)
     else:
-        note = get_note(note_guid)
-        update_note(note, note_title, note_body, note_guid, [resource])
-        db.update_gist(gist, note_guid, gist_hash)
+        note = get_note(note_guid, token=token)
+        note = update_note(note, note_title, note_body, note_guid, resources, source_url=gist_url, token=token,
+                           text_blocks=text_blocks)
+        assert note is not None, 'Failed to update note for gist {}'.format(gist_url)
 
-    os.remove(image_path)
-    print("Finish creating note for gist {}".format(gist_url))
+    # keep the allowance checked by `preflight_note` up to date until it is read again
+    uploaded = (note.contentLength or 0) + sum(r.data.size for r in resources if r.data.body is not None)
+    with _allowance_lock:
+        tenant.account_limits['upload_allowance'] -= uploaded
     return note
 
 
@@ -171,14 +1861,22 @@ def format_note_body(gist):
 
     desc = gist['description']
     if desc:
-        blocks.append(desc)
+        blocks.append(escape(desc))
 
     gist_url = '/'.join((GIST_BASE_URL, gist['name']))
-    blocks.append('<a href="{}">Gist on Github</a>'.format(gist_url))
+    blocks.append('<a href="{}">{}</a>'.format(gist_url, GIST_LINK_TEXT))
     note_body = '<br/>'.join(blocks)
 
     return note_body
 
 
 if __name__ == '__main__':
-    app()
+    apply_deadlines()
+    # `python app.py` without any command runs a normal synchronization
+    if len(sys.argv) == 1:
+        app()
+    else:
+        fire.Fire({'sync': app, 'reconcile': reconcile, 'daemon': daemon,
+                   'coordinate': coordinate, 'work': work, 'tenants': sync_tenants,
+                   'plan': plan_sync, 'apply': apply_plan, 'status': status,
+                   'search': search_gists, 'index': rebuild_search_index, 'export': export_gists})
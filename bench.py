@@ -0,0 +1,210 @@
+import os
+import time
+import fire
+import random
+import shutil
+import hashlib
+import resource
+import tempfile
+import multiprocessing
+from PIL import Image, ImageDraw
+from web.util import encode_image, DRIVER_WIDTH, DRIVER_HEIGHT
+
+# total height in pixels of captures to simulate, from a short script to a long notebook
+PROFILES = {
+    'script': 1500,
+    'module': 8000,
+    'notebook': 40000,
+}
+STAGES = ['stitch', 'png_fast', 'png', 'png_max', 'md5', 'resource', 'encode_image']
+PLOT_EVERY = 3000  # pixels between plots in notebook profile
+
+
+def make_tiles(directory, total_height, width=DRIVER_WIDTH, tile_height=DRIVER_HEIGHT, plots=False, seed=0):
+    """Write synthetic screenshot tiles looking like code, like the ones taken by `capture_fullpage`
+
+    Parameters
+    ----------
+    directory : str
+
+    total_height : int
+        Height of the whole capture in pixels
+
+    width : int, optional
+
+    tile_height : int, optional
+
+    plots : bool, optional
+        Add noisy areas looking like plots of a notebook, which compress badly
+
+    seed : int, optional
+
+    Returns
+    -------
+    job : dict
+        Capture job to be passed to `web.util.encode_image`
+
+    """
+    rand = random.Random(seed)
+    screenshots = []
+    for part, top in enumerate(range(0, total_height, tile_height)):
+        height = min(tile_height, total_height - top)
+        tile = Image.new('RGB', (width, height), (255, 255, 255))
+        draw = ImageDraw.Draw(tile)
+
+        # lines of "words" in a few syntax highlighting colors
+        for y in range(8, height - 12, 20):
+            x = 40 + 16 * rand.randint(0, 6)
+            while x < width - 80 and rand.random() > 0.08:
+                word = rand.randint(2, 12) * 8
+                color = rand.choice([(36, 41, 46), (215, 58, 73), (111, 66, 193), (0, 92, 197), (3, 47, 98)])
+                draw.rectangle((x, y, x + word, y + 10), fill=color)
+                x += word + 8
+
+        if plots:
+            for plot_top in range(top - top % PLOT_EVERY + PLOT_EVERY // 2, top + height, PLOT_EVERY):
+                plot_height = min(400, top + height - plot_top)
+                if plot_top >= top and plot_height > 0:
+                    noise = Image.frombytes('L', (width // 2, plot_height), os.urandom(width // 2 * plot_height))
+                    tile.paste(noise.convert('RGB'), (width // 4, plot_top - top))
+
+        file_name = os.path.join(directory, 'tile_part_{}.png'.format(part))
+        tile.save(file_name)
+        screenshots.append({'file_name': file_name, 'offset': (0, top)})
+
+    return {'file': os.path.join(directory, 'capture.png'), 'screenshots': screenshots,
+            'size': (width, total_height)}
+
+
+def stitch(job):
+    """Concatenate tiles as `web.util.encode_image` does, without removing them"""
+    stitched_image = Image.new('RGB', job['size'])
+    for screenshot in job['screenshots']:
+        stitched_image.paste(Image.open(screenshot['file_name']), screenshot['offset'])
+    return stitched_image
+
+
+def run_stage(stage, profile, directory):
+    """Prepare inputs of `stage` and measure it in current process
+
+    Returns
+    -------
+    seconds : float
+
+    output_bytes : int
+
+    """
+    job = make_tiles(directory, PROFILES[profile], plots=profile == 'notebook')
+    png_file = os.path.join(directory, 'stitched.png')
+    image = None
+    if stage in ('png_fast', 'png', 'png_max', 'md5', 'resource'):
+        image = stitch(job)
+    if stage in ('md5', 'resource'):
+        image.save(png_file)
+        with open(png_file, 'rb') as f:
+            data = f.read()
+
+    start = time.time()
+    if stage == 'stitch':
+        image = stitch(job)
+        output_bytes = image.size[0] * image.size[1] * 3
+    elif stage in ('png_fast', 'png', 'png_max'):
+        options = {'png_fast': {'compress_level': 1},
+                   'png': {},
+                   'png_max': {'compress_level': 9, 'optimize': True}}[stage]
+        image.save(png_file, **options)
+        output_bytes = os.path.getsize(png_file)
+    elif stage == 'md5':
+        hashlib.md5(data).hexdigest()
+        output_bytes = len(data)
+    elif stage == 'resource':
+        from enote.util import create_resource
+        res, _ = create_resource(png_file)
+        output_bytes = res.data.size
+    else:
+        output_bytes = encode_image(job)['size']
+    return time.time() - start, output_bytes
+
+
+def _measure(stage, profile, conn):
+    """Run a stage in a child process and send back seconds, output bytes and peak memory"""
+    directory = tempfile.mkdtemp(prefix='gist-evernote-bench-')
+    try:
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        seconds, output_bytes = run_stage(stage, profile, directory)
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in KB on Linux
+        conn.send((seconds, output_bytes, (rss_peak - rss_start) / 1024.))
+    except Exception as e:
+        conn.send(e)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        conn.close()
+
+
+def measure(stage, profile):
+    """Measure `stage` on `profile` in a fresh process, so that peak memory is not shared with other stages
+
+    Parameters
+    ----------
+    stage : str
+        One of `STAGES`
+
+    profile : str
+        One of `PROFILES`
+
+    Returns
+    -------
+    seconds : float
+
+    output_bytes : int
+
+    peak_mb : float
+        Peak memory increase of the process running the stage, including its inputs
+
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_measure, args=(stage, profile, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def run(profiles=None, stages=None, repeat=3):
+    """Benchmark the image pipeline without a browser and print a table per profile.
+
+    Time is the best of `repeat` runs, peak memory and output bytes come from the same run.
+
+    Parameters
+    ----------
+    profiles : str or list of str, optional
+        Comma separated names of `PROFILES`, all by default
+
+    stages : str or list of str, optional
+        Comma separated names of `STAGES`, all by default
+
+    repeat : int, optional
+
+    """
+    profiles = profiles.split(',') if isinstance(profiles, str) else profiles or sorted(PROFILES, key=PROFILES.get)
+    stages = stages.split(',') if isinstance(stages, str) else stages or STAGES
+
+    for profile in profiles:
+        print("{} ({}x{} pixels)".format(profile, DRIVER_WIDTH, PROFILES[profile]))
+        print("{:<14}{:>10}{:>12}{:>14}".format('stage', 'ms', 'peak MB', 'output bytes'))
+        for stage in stages:
+            try:
+                results = [measure(stage, profile) for _ in range(repeat)]
+            except ImportError as e:
+                print("{:<14}  skipped: {}".format(stage, e))
+                continue
+            seconds, output_bytes, peak_mb = min(results)
+            print("{:<14}{:>10.1f}{:>12.1f}{:>14}".format(stage, seconds * 1e3, peak_mb, output_bytes))
+        print('')
+
+
+if __name__ == '__main__':
+    fire.Fire()
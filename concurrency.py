@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import threading
+import multiprocessing
+from contextlib import contextmanager
+CONCURRENCY_LOG = 'concurrency.jsonl'
+ADJUST_SECONDS = 30
+MAX_ERROR_RATE = 0.2
+MAX_CPU_LOAD = 0.9  # 1-minute load average per CPU
+MIN_FREE_BYTES = 512 * 1024 * 1024
+LATENCY_TOLERANCE = 1.5  # times the best mean latency observed
+DECREASE_FACTOR = 0.5
+WATCHDOG_INTERVAL = 1.0
+
+_watchdog = None  # see `get_watchdog`
+_watchdog_lock = threading.Lock()
+
+
+class DeadlineExceeded(Exception):
+    """Raised when work failed after running past its deadline, e.g. its driver was killed"""
+
+
+class AdaptiveLimit(object):
+    """Number of concurrent tasks of a stage adjusted from feedback, AIMD-style.
+
+    Tasks hold a slot while running. Every `interval` seconds the outcome
+    of the tasks finished meanwhile is evaluated: the limit is halved on
+    throttling, errors, host overload or growing latency, and increased by
+    one when all slots were busy and throughput did not drop. Every decision
+    is appended to `log_file` as a JSON line.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, e.g. "render"
+
+    max_limit : int
+        Upper bound of the limit, e.g. number of tabs of a driver pool
+
+    min_limit : int, optional
+
+    initial : int, optional
+        Default to half of `max_limit`
+
+    interval : float, optional
+        Seconds between two adjustments
+
+    is_throttle : callable, optional
+        Tell whether an exception raised by a task means being throttled,
+        e.g. `enote.util.is_rate_limited`
+
+    log_file : str, optional
+        Set to None to only print changes
+
+    """
+
+    def __init__(self, name, max_limit, min_limit=1, initial=None, interval=ADJUST_SECONDS, is_throttle=None,
+                 log_file=CONCURRENCY_LOG):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max(min_limit, max_limit)
+        self.limit = max(min_limit, min(self.max_limit, initial or self.max_limit // 2))
+        self.interval = interval
+        self.is_throttle = is_throttle
+        self.log_file = log_file
+        self.in_flight = 0
+        self._best_latency = None
+        self._last_throughput = None
+        self._cond = threading.Condition()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.time()
+        self._latencies = []
+        self._errors = 0
+        self._throttles = 0
+        self._saturated = self.in_flight >= self.limit
+
+    @contextmanager
+    def slot(self):
+        """Context manager holding a slot while a task runs, wait until one is free"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._saturated = True
+                self._cond.wait()
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self._saturated = True
+
+        start = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._latencies.append(time.time() - start)
+                if error is not None:
+                    if self.is_throttle and self.is_throttle(error):
+                        self._throttles += 1
+                    else:
+                        self._errors += 1
+                self._adjust()
+                self._cond.notify_all()
+
+    def _adjust(self):
+        """Evaluate the current window and change the limit, called holding the lock"""
+        elapsed = time.time() - self._window_start
+        if elapsed < self.interval or not self._latencies:
+            return
+
+        completed = len(self._latencies)
+        stats = {
+            'throughput': round(completed / elapsed, 3),
+            'latency': round(sum(self._latencies) / completed, 2),
+            'error_rate': round(float(self._errors) / completed, 3),
+            'throttle_rate': round(float(self._throttles) / completed, 3),
+            'cpu_load': get_cpu_load(),
+            'free_bytes': get_free_memory(),
+            'saturated': self._saturated,
+        }
+
+        if stats['throttle_rate'] > 0:
+            decision, reason = 'decrease', 'throttled'
+        elif stats['error_rate'] > MAX_ERROR_RATE:
+            decision, reason = 'decrease', 'errors'
+        elif stats['cpu_load'] is not None and stats['cpu_load'] > MAX_CPU_LOAD:
+            decision, reason = 'decrease', 'cpu'
+        elif stats['free_bytes'] is not None and stats['free_bytes'] < MIN_FREE_BYTES:
+            decision, reason = 'decrease', 'memory'
+        elif self._best_latency and stats['latency'] > LATENCY_TOLERANCE * self._best_latency and \
+                self._last_throughput and stats['throughput'] <= self._last_throughput:
+            decision, reason = 'decrease', 'latency'
+        elif self._saturated and (not self._last_throughput or stats['throughput'] >= 0.95 * self._last_throughput):
+            decision, reason = 'increase', 'saturated'
+        else:
+            decision, reason = 'hold', 'steady'
+
+        previous = self.limit
+        if decision == 'decrease':
+            self.limit = max(self.min_limit, int(self.limit * DECREASE_FACTOR))
+        elif decision == 'increase':
+            self.limit = min(self.max_limit, self.limit + 1)
+
+        if stats['latency'] and (self._best_latency is None or stats['latency'] < self._best_latency):
+            self._best_latency = stats['latency']
+        self._last_throughput = stats['throughput']
+        self._log(decision, reason, previous, stats)
+        self._reset_window()
+
+    def _log(self, decision, reason, previous, stats):
+        if self.limit != previous:
+            print("Concurrency of {} {}d from {} to {} ({})".format(self.name, decision, previous, self.limit, reason))
+        if not self.log_file:
+            return
+        record = dict(stats, time=round(time.time(), 1), stage=self.name, decision=decision, reason=reason,
+                      previous=previous, limit=self.limit, in_flight=self.in_flight)
+        with open(self.log_file, 'a') as fp:
+            fp.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class Watchdog(threading.Thread):
+    """Background thread cancelling work running past its deadline.
+
+    Work registers a deadline with `deadline`. Once it expires, the given
+    callback is called to unblock the work, e.g. by quitting a wedged
+    Chrome driver, so that the work fails and its gist can be retried.
+
+    Parameters
+    ----------
+    interval : float, optional
+        Seconds between two checks
+
+    """
+
+    def __init__(self, interval=WATCHDOG_INTERVAL):
+        super(Watchdog, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self._entries = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def deadline(self, stage, seconds, on_expire=None, label=''):
+        """Context manager running its block under a deadline
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. "capture"
+
+        seconds : float
+            Deadline of the block, no deadline if not set
+
+        on_expire : callable, optional
+            Called from the watchdog thread once the deadline expired
+
+        label : str, optional
+            Shown in messages, e.g. url of the gist
+
+        Raises
+        ------
+        DeadlineExceeded
+            If the block raised after its deadline expired
+
+        """
+        if not seconds:
+            yield
+            return
+        entry = {'stage': stage, 'label': label, 'seconds': seconds, 'expires': time.time() + seconds,
+                 'on_expire': on_expire, 'expired': False}
+        with self._lock:
+            self._entries.append(entry)
+        try:
+            yield
+        except Exception as e:
+            if entry['expired']:
+                raise DeadlineExceeded('{} of {} took longer than {} seconds: {!r}'.format(stage, label, seconds, e))
+            raise
+        finally:
+            with self._lock:
+                self._entries.remove(entry)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.time()
+            with self._lock:
+                expired = [e for e in self._entries if not e['expired'] and e['expires'] <= now]
+                for entry in expired:
+                    entry['expired'] = True
+            for entry in expired:
+                print("Deadline of {} seconds for {} of {} expired, cancelling.".format(
+                    entry['seconds'], entry['stage'], entry['label']))
+                if entry['on_expire']:
+                    try:
+                        entry['on_expire']()
+                    except Exception as e:
+                        print("Failed to cancel {} of {}: {!r}".format(entry['stage'], entry['label'], e))
+
+
+def get_watchdog():
+    """Return the watchdog shared by all threads, start it on first call
+
+    Returns
+    -------
+    watchdog : Watchdog
+
+    """
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None:
+            _watchdog = Watchdog()
+            _watchdog.start()
+        return _watchdog
+
+
+@contextmanager
+def limited(limit):
+    """Context manager holding a slot of `limit`, nothing happens if it is None"""
+    if limit is None:
+        yield
+        return
+    with limit.slot():
+        yield
+
+
+def get_cpu_load():
+    """Return 1-minute load average per CPU, None if not available"""
+    try:
+        return round(os.getloadavg()[0] / multiprocessing.cpu_count(), 2)
+    except (AttributeError, OSError, NotImplementedError):
+        return None
+
+
+def get_free_memory():
+    """Return bytes of memory available to new processes, None if not available, e.g. not on Linux"""
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return None
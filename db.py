@@ -1,10 +1,25 @@
 import os
+import copy
 import json
 import fire
-from datetime import datetime
+import functools
+import threading
+from datetime import datetime, timedelta
 DB_FILE = 'db.json'
 ENV_FILE = 'env.json'
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+RETRY_BASE_SECONDS = 60
+RETRY_MAX_SECONDS = 24 * 60 * 60
+RETRY_MAX_ATTEMPTS = 10
+
+
+def synchronized(method):
+    """Run `method` of Database while holding its lock"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class Database(object):
@@ -12,10 +27,22 @@ class Database(object):
 
     This class is independent of the actual implementation
     of the database, thus make it easier to change in the future.
+    Methods modifying the database are safe to be called from multiple threads.
+
+    Parameters
+    ----------
+    db_file : str, optional
+        Path of the file storing gist information
+    env_file : str, optional
+        Path of the file storing runtime information
+
     """
 
-    def __init__(self):
-        if not os.path.isfile(DB_FILE) or not os.path.isfile(ENV_FILE):
+    def __init__(self, db_file=DB_FILE, env_file=ENV_FILE):
+        self.db_file = db_file
+        self.env_file = env_file
+        self.lock = threading.RLock()
+        if not os.path.isfile(db_file) or not os.path.isfile(env_file):
             self.info = {"num_gists": 0}
             self.env = {
                 "cold_start": True,
@@ -57,6 +84,7 @@ class Database(object):
         """
         return datetime.strptime(self.env['sync_at'], DATE_FORMAT)
 
+    @synchronized
     def toggle_cold_start(self):
         """Toggle value of cold_start"""
         self.env['cold_start'] = not self.env.get('cold_start', True)
@@ -95,7 +123,186 @@ class Database(object):
         return self.info.get(gist_id, {}).get('note_guid', '')
 
 
-    def save_gist(self, gist, note_guid, hash):
+    def get_render_seconds(self, gist_id):
+        """Get seconds taken by the last render of all files of the gist with `gist_id`
+
+        Parameters
+        ----------
+        gist_id : str
+
+        Returns
+        -------
+        seconds : float
+            0 if the gist has never been rendered
+
+        """
+        return self.info.get(gist_id, {}).get('render_seconds', 0)
+
+    def get_file_hashes(self, gist_id):
+        """Get hash of each file of the gist with `gist_id` in last synchronization
+
+        Parameters
+        ----------
+        gist_id : str
+
+        Returns
+        -------
+        file_hashes : dict
+            File name -> hash, empty if the gist was synced as a single screenshot
+
+        """
+        return self.info.get(gist_id, {}).get('file_hashes', {})
+
+    def get_gist(self, gist_id):
+        """Get information of the gist saved in last synchronization
+
+        Parameters
+        ----------
+        gist_id : str
+
+        Returns
+        -------
+        gist : dict
+            Empty if no gist can be found in database by `gist_id`
+
+        """
+        return dict(self.info.get(gist_id, {}))
+
+    def has_gist(self, gist_id):
+        """Indicate whether the gist with `gist_id` is already in database.
+
+        Parameters
+        ----------
+        gist_id : str
+
+        Returns
+        -------
+        bool
+
+        """
+        return gist_id in self.info and gist_id != 'num_gists'
+
+    @synchronized
+    def get_gist_ids(self):
+        """Return ids of all gists in database.
+
+        Returns
+        -------
+        gist_ids : set of str
+
+        """
+        return set(k for k in self.info if k != 'num_gists')
+
+    @synchronized
+    def remove_gists(self, gist_ids):
+        """Remove given gists from database and compact the storage.
+
+        Gists are also removed from the retry queue, dead letters and pending checkpoint.
+
+        Parameters
+        ----------
+        gist_ids : iterable of str
+
+        """
+        gist_ids = set(gist_ids)
+        for gist_id in gist_ids:
+            self.info.pop(gist_id, None)
+            self.env.get('retry', {}).pop(gist_id, None)
+            self.env.get('dead', {}).pop(gist_id, None)
+        if 'pending' in self.env:
+            self.env['pending'] = [g for g in self.env['pending'] if g['id'] not in gist_ids]
+        self.info['num_gists'] = len(self.get_gist_ids())
+        self.sync_info('save')
+        self.sync_env('save')
+
+    @synchronized
+    def add_retry(self, gist, error):
+        """Put a gist failed to synchronize into the retry queue.
+
+        Each failure doubles the delay before the next attempt, starting from
+        `RETRY_BASE_SECONDS` and capped at `RETRY_MAX_SECONDS`. After
+        `RETRY_MAX_ATTEMPTS` failures the gist is given up: it leaves the
+        queue for the dead letters returned by `get_dead_gists`.
+
+        Parameters
+        ----------
+        gist : dict
+            A Gist acquired by Github GraphQL API
+        error : Exception
+            The error raised when synchronizing the gist
+
+        Returns
+        -------
+        attempts : int
+            Number of failed attempts so far
+
+        """
+        retries = self.env.setdefault('retry', {})
+        attempts = retries.get(gist['id'], {}).get('attempts', 0) + 1
+        if attempts >= RETRY_MAX_ATTEMPTS:
+            retries.pop(gist['id'], None)
+            self.env.setdefault('dead', {})[gist['id']] = {
+                'gist': dict((k, v) for k, v in gist.items() if k not in ('note_guid', 'hash')),
+                'attempts': attempts,
+                'error': repr(error),
+                'failed_at': datetime.strftime(datetime.utcnow(), DATE_FORMAT)}
+        else:
+            delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+            retry_at = datetime.utcnow() + timedelta(seconds=delay)
+            retries[gist['id']] = {
+                'gist': dict((k, v) for k, v in gist.items() if k not in ('note_guid', 'hash')),
+                'attempts': attempts,
+                'error': repr(error),
+                'retry_at': datetime.strftime(retry_at, DATE_FORMAT)}
+        self.sync_env('save')
+        return attempts
+
+    @synchronized
+    def remove_retry(self, gist_id):
+        """Remove the gist with `gist_id` from the retry queue and dead letters, e.g. once synced.
+
+        Parameters
+        ----------
+        gist_id : str
+
+        """
+        removed = self.env.get('retry', {}).pop(gist_id, None)
+        if self.env.get('dead', {}).pop(gist_id, None) or removed:
+            self.sync_env('save')
+
+    @synchronized
+    @synchronized
+    def get_retry_gists(self, due_only=True):
+        """Return copies of gists in the retry queue, earliest scheduled first.
+
+        Parameters
+        ----------
+        due_only : bool, optional
+            Only return gists whose backoff delay has passed
+
+        Returns
+        -------
+        gists : list of dict
+
+        """
+        now = datetime.strftime(datetime.utcnow(), DATE_FORMAT)
+        entries = sorted(self.env.get('retry', {}).values(), key=lambda e: e['retry_at'])
+        return [copy.deepcopy(e['gist']) for e in entries if not due_only or e['retry_at'] <= now]
+
+    @synchronized
+    def get_dead_gists(self):
+        """Return copies of gists given up after `RETRY_MAX_ATTEMPTS` failures, most recent first.
+
+        Returns
+        -------
+        entries : list of dict
+            {'gist': dict, 'attempts': int, 'error': str, 'failed_at': str}
+
+        """
+        return copy.deepcopy(sorted(self.env.get('dead', {}).values(), key=lambda e: e['failed_at'], reverse=True))
+
+    @synchronized
+    def save_gist(self, gist, note_guid, hash, sync_time=True):
         """Save information of a given gist into database.
 
         Parameters
@@ -110,6 +317,8 @@ class Database(object):
                 }
         note_guid : str
         hash : str
+        sync_time : bool, optional
+            Whether to move the last synchronization time to gist's `pushedAt`
         """
         gist['note_guid'] = note_guid
         gist['hash'] = hash
@@ -117,9 +326,11 @@ class Database(object):
         self.info[gist['id']] = gist
         self.info['num_gists'] = self.info.get('num_gists', 0) + 1
         self.sync_info('save')
-        self.update_sync_time(gist['pushedAt'])
+        if sync_time:
+            self.update_sync_time(gist['pushedAt'])
 
-    def update_gist(self, gist, note_guid, hash):
+    @synchronized
+    def update_gist(self, gist, note_guid, hash, sync_time=True):
         """Update information of a given gist into database.
 
         Parameters
@@ -134,18 +345,68 @@ class Database(object):
                 }
         note_guid : str
         hash : str
+        sync_time : bool, optional
+            Whether to move the last synchronization time to gist's `pushedAt`
 
         """
 
         gist['note_guid'] = note_guid
         gist['hash'] = hash
 
-        self.info[gist['id']] = gist
+        # keep metrics recorded in previous synchronization, a render time is only
+        # replaced by the one of another complete render
+        record = dict(self.info.get(gist['id'], {}))
+        record.update((k, v) for k, v in gist.items() if k != 'render_seconds' or v)
+        self.info[gist['id']] = record
         self.sync_info('save')
-        self.update_sync_time(gist['pushedAt'])
+        if sync_time:
+            self.update_sync_time(gist['pushedAt'])
 
+    @synchronized
+    def set_pending(self, gists):
+        """Checkpoint gists left unsynchronized when a run stopped at its budget.
+
+        Parameters
+        ----------
+        gists : list of dict
+
+        """
+        self.env['pending'] = [
+            dict((k, v) for k, v in g.items() if k not in ('note_guid', 'hash')) for g in gists]
+        self.sync_env('save')
+
+    @synchronized
+    def get_pending_gists(self):
+        """Return copies of gists checkpointed by `set_pending`.
+
+        Returns
+        -------
+        gists : list of dict
+
+        """
+        return copy.deepcopy(self.env.get('pending', []))
+
+    def get_notebook_guid(self, name):
+        """Return guid of the notebook named `name` saved by `set_notebook_guid`, None if unknown"""
+        return self.env.get('notebooks', {}).get(name)
+
+    @synchronized
+    def set_notebook_guid(self, name, guid):
+        """Remember guid of the notebook named `name`, so that it need not be looked up again
+
+        Parameters
+        ----------
+        name : str
+        guid : str
+
+        """
+        if self.env.get('notebooks', {}).get(name) != guid:
+            self.env.setdefault('notebooks', {})[name] = guid
+            self.sync_env('save')
+
+    @synchronized
     def update_sync_time(self, sync_date):
-        """Update last synchronization time
+        """Update last synchronization time, which never moves backwards
 
         Parameters
         ----------
@@ -154,9 +415,12 @@ class Database(object):
             which defined by global environment `DATE_FORMAT`.
 
         """
+        if sync_date <= self.env.get('sync_at', ''):
+            return
         self.env['sync_at'] = sync_date
         self.sync_env('save')
 
+    @synchronized
     def sync_env(self, mode):
         """Synchronize runtime information between current Database obj and permanent storage
 
@@ -171,14 +435,15 @@ class Database(object):
 
         """
         if mode == 'save':
-            with open(ENV_FILE, 'w') as fp:
+            with open(self.env_file, 'w') as fp:
                 json.dump(self.env, fp, indent=2)
         elif mode == 'load':
-            with open(ENV_FILE, "r") as fp:
+            with open(self.env_file, "r") as fp:
                 env = json.load(fp)
                 self.env = env
         return True
 
+    @synchronized
     def sync_info(self, mode):
         """Synchronize gist info between current Database obj and permanent storage
 
@@ -193,24 +458,34 @@ class Database(object):
 
         """
         if mode == 'save':
-            with open(DB_FILE, 'w') as fp:
+            with open(self.db_file, 'w') as fp:
                 json.dump(self.info, fp, indent=2)
         elif mode == 'load':
-            with open(DB_FILE, "r") as fp:
+            with open(self.db_file, "r") as fp:
                 info = json.load(fp)
                 self.info = info
         return True
 
 
-def get_db():
+def get_db(state_dir=None):
     """Get a database instance for storing gist information
 
+    Parameters
+    ----------
+    state_dir : str, optional
+        Directory to store the database files, e.g. one per account.
+        Default to current working directory.
+
     Returns
     -------
     db : Database instance
 
     """
-    return Database()
+    if not state_dir:
+        return Database()
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return Database(os.path.join(state_dir, DB_FILE), os.path.join(state_dir, ENV_FILE))
 
 
 if __name__ == '__main__':
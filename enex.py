@@ -0,0 +1,135 @@
+# encoding: utf-8
+from __future__ import unicode_literals
+import os
+import time
+import base64
+import threading
+from xml.sax.saxutils import escape
+from enote.util import clean_note_title, build_note_content
+ENEX_DIR = 'enex'
+ENEX_MAX_BYTES = 50 * 1024 * 1024
+ENEX_DATE_FORMAT = '%Y%m%dT%H%M%SZ'
+BASE64_CHUNK_SIZE = 48 * 1024  # multiple of 3 bytes, so that only the last line is padded
+
+HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<!DOCTYPE en-export SYSTEM "http://xml.evernote.com/pub/evernote-export3.dtd">\n'
+          '<en-export export-date="{}" application="gist-evernote" version="1.0">\n')
+FOOTER = '</en-export>\n'
+
+
+def _to_text(value):
+    """Decode UTF-8 bytes, e.g. file names of resources, to be formatted into the file"""
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+class EnexWriter(object):
+    """Write notes into `.enex` files to be imported into Evernote in bulk.
+
+    Notes are streamed to disk one by one and resources are base64 encoded
+    chunk by chunk, so that memory does not grow with the number of notes.
+    A new file is started when the current one would exceed `max_bytes`.
+    Notes can be written from multiple threads.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to write `<prefix>-001.enex`, `<prefix>-002.enex`...
+
+    max_bytes : int, optional
+        Approximate maximum size of each file, a single larger note gets a file on its own
+
+    prefix : str, optional
+
+    """
+
+    def __init__(self, directory=ENEX_DIR, max_bytes=ENEX_MAX_BYTES, prefix='gists'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.files = []
+        self.num_notes = 0
+        self._fp = None
+        self._size = 0
+        self._notes_in_file = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write_note(self, note_title, note_body, resources, source_url=None, text_blocks=None, updated=None):
+        """Append a note, arguments are the same as `enote.util.create_note`
+
+        Parameters
+        ----------
+        note_title : str
+
+        note_body : str
+
+        resources : list of evernote.edam.type.ttypes.Resource
+
+        source_url : str, optional
+
+        text_blocks : list of (str, str), optional
+
+        updated : float, optional
+            Timestamp saved as creation and update time of the note, default to now
+
+        """
+        date = time.strftime(ENEX_DATE_FORMAT, time.gmtime(updated or time.time()))
+        # the whole file is UTF-8, unlike titles sent to the API
+        content = build_note_content(note_body, resources, text_blocks).decode('utf-8')
+        head = ('<note><title>{}</title>\n<content><![CDATA[{}]]></content>\n'
+                '<created>{}</created><updated>{}</updated>\n').format(
+            escape(clean_note_title(note_title)), content.replace(']]>', ']]]]><![CDATA[>'), date, date)
+        if source_url:
+            head += '<note-attributes><source-url>{}</source-url></note-attributes>\n'.format(
+                escape(_to_text(source_url)))
+        head = head.encode('utf-8')
+        size = len(head) + sum(r.data.size * 4 // 3 + 512 for r in resources)
+
+        with self._lock:
+            if self._fp is None or (self._notes_in_file and self._size + size > self.max_bytes):
+                self._open_next()
+            self._fp.write(head)
+            for resource in resources:
+                self._write_resource(resource)
+            self._fp.write(b'</note>\n')
+            self._size += size
+            self._notes_in_file += 1
+            self.num_notes += 1
+
+    def _write_resource(self, resource):
+        self._fp.write(b'<resource><data encoding="base64">\n')
+        body = resource.data.body
+        for i in range(0, len(body), BASE64_CHUNK_SIZE):
+            self._fp.write(base64.b64encode(bytes(body[i:i + BASE64_CHUNK_SIZE])) + b'\n')
+        self._fp.write('</data><mime>{}</mime>'.format(resource.mime).encode('utf-8'))
+        if resource.attributes and resource.attributes.fileName:
+            self._fp.write('<resource-attributes><file-name>{}</file-name></resource-attributes>'.format(
+                escape(_to_text(resource.attributes.fileName))).encode('utf-8'))
+        self._fp.write(b'</resource>\n')
+
+    def _open_next(self):
+        self._close_current()
+        path = os.path.join(self.directory, '{}-{:03d}.enex'.format(self.prefix, len(self.files) + 1))
+        self._fp = open(path, 'wb')
+        self._fp.write(HEADER.format(time.strftime(ENEX_DATE_FORMAT, time.gmtime())).encode('utf-8'))
+        self._size = 0
+        self._notes_in_file = 0
+        self.files.append(path)
+
+    def _close_current(self):
+        if self._fp is not None:
+            self._fp.write(FOOTER.encode('utf-8'))
+            self._fp.close()
+            self._fp = None
+
+    def close(self):
+        """Finish the current file"""
+        with self._lock:
+            self._close_current()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -2,19 +2,35 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import re
 import fire
 import time
+import binascii
 import hashlib
 import tzlocal
+import threading
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape
 from evernote.api.client import EvernoteClient
 from evernote.edam.type import ttypes
+from evernote.edam.notestore import ttypes as NoteStoreTypes
 from evernote.edam.error import ttypes as Errors
-from evernote.edam.limits.constants import EDAM_NOTE_TITLE_LEN_MAX
+from xml.etree import ElementTree
+from evernote.edam.limits.constants import EDAM_NOTE_TITLE_LEN_MAX, EDAM_NOTE_CONTENT_LEN_MAX, \
+    EDAM_RESOURCE_SIZE_MAX_FREE, EDAM_RESOURCE_SIZE_MAX_PREMIUM, EDAM_NOTE_SIZE_MAX_FREE, \
+    EDAM_NOTE_SIZE_MAX_PREMIUM, EDAM_NOTE_RESOURCES_MAX
 from secret import EVERNOTE_PROD_TOKEN, EVERNOTE_SANDBOX_TOKEN
 
+TEXT_BLOCK_LINES = 500
+TEXT_TRUNCATED_NOTICE = "<div><i>Truncated, see the gist for full content.</i></div>"
+INVALID_XML_CHARS = re.compile('[^\x09\x0A\x0D\x20-\uD7FF\uE000-\uFFFD]')
+CONTROL_CHARS = re.compile('[\x00-\x1F\x7F-\x9F]')
 
-def get_evernote_auth_token(env="prod"):
+_note_stores = threading.local()  # thrift clients are not thread-safe, keep one per thread
+
+
+def get_evernote_auth_token(env="prod", token=None):
     """Return either a valid production / dev Evernote developer token.
 
     Parameters
@@ -23,15 +39,21 @@ def get_evernote_auth_token(env="prod"):
         Indicate which environment's token to be returned.
         Valid options: ["prod", "dev"]
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     token : str
 
     """
+    if token:
+        return token
     return EVERNOTE_PROD_TOKEN if env == 'prod' else EVERNOTE_SANDBOX_TOKEN
 
 
-def get_client(env="prod"):
+def get_client(env="prod", token=None):
     """Return a Evernote API client
 
     Parameters
@@ -40,16 +62,20 @@ def get_client(env="prod"):
         Indicate which environment's token to be returned.
         Valid options: ["prod", "dev"]
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     client : evernote.api.client.EvernoteClient
 
     """
     sandbox = False if env == 'prod' else True
-    return EvernoteClient(token=get_evernote_auth_token(env), sandbox=sandbox)
+    return EvernoteClient(token=get_evernote_auth_token(env, token), sandbox=sandbox)
 
 
-def get_note_store(env="prod"):
+def get_note_store(env="prod", token=None):
     """Return a NoteStore used to used to manipulate notes, notebooks in a user account.
 
     Parameters
@@ -58,20 +84,31 @@ def get_note_store(env="prod"):
         Indicate which environment's token to be returned.
         Valid options: ["prod", "dev"]
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     NoteStore
 
     Notes
     -----
+    The NoteStore is created once per thread and token and reused
+    afterward, since creating one costs a request to look up its url.
+
     Evernote documentation:
         https://dev.evernote.com/doc/start/python.php
 
     """
-    return get_client(env).get_note_store()
+    stores = _note_stores.__dict__
+    key = (env, token)
+    if key not in stores:
+        stores[key] = get_client(env, token).get_note_store()
+    return stores[key]
 
 
-def get_note(guid=None, env='prod'):
+def get_note(guid=None, env='prod', token=None):
     """Return a specific Note instance by guid.
 
     Parameters
@@ -82,35 +119,117 @@ def get_note(guid=None, env='prod'):
         Indicate which environment's token to be returned.
         Valid options: ["prod", "dev"]
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     evernote.edam.type.ttypes.Note
 
     """
-    auth_token = get_evernote_auth_token(env)
+    auth_token = get_evernote_auth_token(env, token)
 
 
     assert guid is not None, 'Guid is not available.'
-    return get_note_store().getNote(auth_token, guid, False, False, False , False)
+    return get_note_store(env, token).getNote(auth_token, guid, False, False, False , False)
+
+
+def get_note_content(guid=None, env='prod', token=None):
+    """Return the ENML content of a specific note by guid.
+
+    Parameters
+    ----------
+    guid : str
+
+    env : str
+        Indicate which environment's token to be returned.
+        Valid options: ["prod", "dev"]
+
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
+    Returns
+    -------
+    content : str
+
+    """
+    assert guid is not None, 'Guid is not available.'
+    auth_token = get_evernote_auth_token(env, token)
+    return get_note_store(env, token).getNoteContent(auth_token, guid)
+
 
+def get_notes_metadata(notebook_guid=None, page_size=100, env='prod', token=None):
+    """Return metadata of all notes in the notebook, fetched in bulk.
 
-def get_notebook(guid=None):
+    Only title, update time and attributes (e.g. `sourceURL`) are included,
+    so no note content or resource data is transferred.
+
+    Parameters
+    ----------
+    notebook_guid : str
+        Guid of the notebook to scan
+
+    page_size : int, optional
+        Number of notes to fetch in a single request
+
+    env : str
+        Indicate which environment's token to be returned.
+        Valid options: ["prod", "dev"]
+
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
+    Returns
+    -------
+    notes : list of evernote.edam.notestore.ttypes.NoteMetadata
+
+    Notes
+    -----
+    Evernote API documentation
+        https://dev.evernote.com/doc/reference/NoteStore.html#Fn_NoteStore_findNotesMetadata
+
+    """
+    assert notebook_guid is not None, 'Guid is not available.'
+    auth_token = get_evernote_auth_token(env, token)
+    note_store = get_note_store(env, token)
+
+    note_filter = NoteStoreTypes.NoteFilter(notebookGuid=notebook_guid)
+    result_spec = NoteStoreTypes.NotesMetadataResultSpec(
+        includeTitle=True, includeUpdated=True, includeAttributes=True)
+
+    notes = []
+    while True:
+        result = note_store.findNotesMetadata(auth_token, note_filter, len(notes), page_size, result_spec)
+        notes.extend(result.notes)
+        if not result.notes or len(notes) >= result.totalNotes:
+            break
+    return notes
+
+
+def get_notebook(guid=None, token=None):
     """Return a specific Notebook instance by guid.
 
     Parameters
     ----------
     guid : str
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     evernote.edam.type.ttypes.Notebook
 
     """
     assert guid is not None, 'Guid is not available.'
-    return get_note_store().getNotebook(guid)
+    return get_note_store(token=token).getNotebook(guid)
 
 
-def get_notebooks(env="prod"):
+def get_notebooks(env="prod", token=None):
     """Get all available Notebook instances in a user account.
 
     Parameters
@@ -119,12 +238,16 @@ def get_notebooks(env="prod"):
         Indicate which environment's token to be returned.
         Valid options: ["prod", "dev"]
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     Notebooks : list of evernote.edam.type.ttypes.Notebook
 
     """
-    client = get_client(env)
+    client = get_client(env, token)
 
     # get information about current user
     userStore = client.get_user_store()
@@ -132,14 +255,76 @@ def get_notebooks(env="prod"):
     print('Current user:', user.username)
 
     # get information about notes
-    noteStore = client.get_note_store()
+    noteStore = get_note_store(env, token)
     notebooks = noteStore.listNotebooks()
     # for n in notebooks:
     #     print(n.name, n.guid)
     return notebooks
 
 
-def create_notebook(name=None):
+def get_upload_allowance(env="prod", token=None):
+    """Return number of bytes the user can still upload in current accounting period.
+
+    Parameters
+    ----------
+    env : str
+        Indicate which environment's token to be returned.
+        Valid options: ["prod", "dev"]
+
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
+    Returns
+    -------
+    num_bytes : int
+
+    Notes
+    -----
+    Evernote Struct: Accounting
+        https://dev.evernote.com/doc/reference/Types.html#Struct_Accounting
+
+    """
+    accounting = get_client(env, token).get_user_store().getUser().accounting
+    return max(accounting.uploadLimit - (accounting.uploaded or 0), 0)
+
+
+def get_account_limits(env="prod", token=None):
+    """Return size limits of notes of the user, which depend on the account level.
+
+    Parameters
+    ----------
+    env : str
+        Indicate which environment's token to be returned.
+        Valid options: ["prod", "dev"]
+
+    token : str, optional
+        Evernote developer token used instead of the one of `env`
+
+    Returns
+    -------
+    limits : dict
+        {'resource_bytes': maximum size of a resource,
+         'note_bytes': maximum size of a note including its resources,
+         'upload_allowance': bytes the user can still upload in current accounting period}
+
+    Notes
+    -----
+    Evernote limits
+        https://dev.evernote.com/doc/reference/Limits.html
+
+    """
+    user = get_client(env, token).get_user_store().getUser()
+    premium = (user.privilege or 0) >= ttypes.PrivilegeLevel.PREMIUM
+    accounting = user.accounting
+    return {
+        'resource_bytes': EDAM_RESOURCE_SIZE_MAX_PREMIUM if premium else EDAM_RESOURCE_SIZE_MAX_FREE,
+        'note_bytes': EDAM_NOTE_SIZE_MAX_PREMIUM if premium else EDAM_NOTE_SIZE_MAX_FREE,
+        'upload_allowance': max(accounting.uploadLimit - (accounting.uploaded or 0), 0),
+    }
+
+
+def create_notebook(name=None, token=None):
     """Create a new notebook with given `name`.
 
     Parameters
@@ -147,6 +332,10 @@ def create_notebook(name=None):
     name : str
         Indicating the name of the notebook to be created
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
     Returns
     -------
     evernote.edam.type.ttypes.Notebook
@@ -155,10 +344,10 @@ def create_notebook(name=None):
     assert name is not None, 'Notebook name is not specified.'
     notebook = ttypes.Notebook()
     notebook.name = name
-    return get_note_store().createNotebook(notebook)
+    return get_note_store(token=token).createNotebook(notebook)
 
 
-def create_resource(file_path, mime='image/png'):
+def create_resource(file_path, mime='image/png', file_name=None, hexhash=None):
     """Create a Resource instance for attaching to evernote Note instance
 
     Parameters
@@ -169,6 +358,12 @@ def create_resource(file_path, mime='image/png'):
     mime : str, optional
         Valid MIME type indicating type of the file
 
+    file_name : str, optional
+        Name saved as resource attribute `fileName`, e.g. the gist file captured
+
+    hexhash : str, optional
+        MD5 sum of the file if already computed, e.g. by `web.util.encode_image`
+
     Returns
     -------
     evernote.edam.type.ttypes.Resource
@@ -188,10 +383,35 @@ def create_resource(file_path, mime='image/png'):
     with open(file_path, 'rb') as f:
         byte_str = f.read()
         file_data = bytearray(byte_str)
+    return build_resource(file_data, mime, file_name, hexhash)
 
-    md5 = hashlib.md5()
-    md5.update(file_data)
-    hexhash = md5.hexdigest()
+
+def build_resource(file_data, mime='image/png', file_name=None, hexhash=None):
+    """Create a Resource instance from data in memory, see `create_resource`
+
+    Parameters
+    ----------
+    file_data : bytearray
+
+    mime : str, optional
+
+    file_name : str, optional
+
+    hexhash : str, optional
+
+    Returns
+    -------
+    evernote.edam.type.ttypes.Resource
+
+    hexhash : str
+
+    """
+    if not isinstance(file_data, bytearray):
+        file_data = bytearray(file_data)
+    if hexhash is None:
+        md5 = hashlib.md5()
+        md5.update(file_data)
+        hexhash = md5.hexdigest()
     data = ttypes.Data()
 
     # build Resource's necessary data
@@ -203,10 +423,33 @@ def create_resource(file_path, mime='image/png'):
     resource = ttypes.Resource()
     resource.mime = mime
     resource.data = data
+    if file_name:
+        resource.attributes = ttypes.ResourceAttributes(fileName=file_name)
     return resource, hexhash
 
 
-def create_note(note_title, note_body, resources=[], parent_notebook=None, env="prod"):
+def get_resource_hexhash(resource):
+    """Return the MD5 sum of a resource as hex string
+
+    Parameters
+    ----------
+    resource : evernote.edam.type.ttypes.Resource
+        Created by `create_resource` or fetched from Evernote
+
+    Returns
+    -------
+    hexhash : str
+
+    """
+    hexhash = resource.data.bodyHash
+    # resources fetched from Evernote carry the binary MD5 sum
+    if len(hexhash) == 16:
+        hexhash = binascii.hexlify(hexhash)
+    return hexhash
+
+
+def create_note(note_title, note_body, resources=[], parent_notebook=None, source_url=None, env="prod",
+                token=None, text_blocks=None):
     """Create new Note with the given attachments in user's notebook
 
     Parameters
@@ -223,10 +466,20 @@ def create_note(note_title, note_body, resources=[], parent_notebook=None, env="
     parent_notebook : evernote.edam.type.ttypes.Notebook, optional
         Notebook instance to insert new note
 
+    source_url : str, optional
+        URL the note originates from, saved as note attribute `sourceURL`
+
     env : str
         Indicate which environment's token to be returned.
         Valid options: ["prod", "dev"]
 
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
+    text_blocks : list of (str, str), optional
+        (file name, raw text) put into the note as text after the attachments
+
     Returns
     -------
     evernote.edam.type.ttypes.Note
@@ -241,8 +494,8 @@ def create_note(note_title, note_body, resources=[], parent_notebook=None, env="
         https://dev.evernote.com/doc/reference/Types.html#Struct_Note
 
     """
-    auth_token = get_evernote_auth_token(env)
-    note_store = get_note_store(env)
+    auth_token = get_evernote_auth_token(env, token)
+    note_store = get_note_store(env, token)
 
     # create note object
     new_note = ttypes.Note()
@@ -252,12 +505,15 @@ def create_note(note_title, note_body, resources=[], parent_notebook=None, env="
 
     # build body of note
     new_note.resources = resources
-    new_note.content = build_note_content(note_body, resources)
+    new_note.content = build_note_content(note_body, resources, text_blocks)
 
     # parent_notebook is optional. if omitted, default notebook is used
     if parent_notebook and hasattr(parent_notebook, 'guid'):
         new_note.notebookGuid = parent_notebook.guid
 
+    if source_url:
+        new_note.attributes = ttypes.NoteAttributes(sourceURL=source_url)
+
     # attempt to create note in Evernote account
     try:
         note = note_store.createNote(auth_token, new_note)
@@ -273,7 +529,7 @@ def create_note(note_title, note_body, resources=[], parent_notebook=None, env="
     return note
 
 
-def update_note(note, note_title, note_body, note_guid, resources):
+def update_note(note, note_title, note_body, note_guid, resources, source_url=None, token=None, text_blocks=None):
     """Update existing note in Evernote identified by `note_guid`.
 
     Parameters
@@ -292,6 +548,16 @@ def update_note(note, note_title, note_body, note_guid, resources):
     resources : list of evernote.edam.type.ttypes.Resource
         List of attachments to combined with the note
 
+    source_url : str, optional
+        URL the note originates from, saved as note attribute `sourceURL`
+
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
+    text_blocks : list of (str, str), optional
+        (file name, raw text) put into the note as text after the attachments
+
     Returns
     -------
     evernote.edam.type.ttypes.Note
@@ -299,15 +565,19 @@ def update_note(note, note_title, note_body, note_guid, resources):
 
     """
 
-    auth_token = get_evernote_auth_token()
-    note_store = get_note_store()
+    auth_token = get_evernote_auth_token(token=token)
+    note_store = get_note_store(token=token)
 
     note.guid = note_guid
     note.title = build_note_title(note_title)
 
     # build body of note with new resources
     note.resources = resources
-    note.content = build_note_content(note_body, resources)
+    note.content = build_note_content(note_body, resources, text_blocks)
+
+    if source_url:
+        note.attributes = note.attributes or ttypes.NoteAttributes()
+        note.attributes.sourceURL = source_url
 
     # update `updated time` of the note in timezone-aware manner
     tz = tzlocal.get_localzone()
@@ -326,6 +596,118 @@ def update_note(note, note_title, note_body, note_guid, resources):
     return note
 
 
+def delete_notes(guids, expunge=False, batch_size=100, threads=8, env='prod', token=None):
+    """Remove notes identified by `guids` from user's account.
+
+    Parameters
+    ----------
+    guids : list of str
+        Guids of notes to be removed
+
+    expunge : bool, optional
+        Permanently remove the notes in batches of `batch_size`.
+        Otherwise the notes are only moved to the trash.
+
+    batch_size : int, optional
+        Number of notes to expunge in a single request, or to move to the trash at once
+
+    threads : int, optional
+        Number of notes moved to the trash concurrently, the API has no batch request for it
+
+    env : str
+        Indicate which environment's token to be returned.
+        Valid options: ["prod", "dev"]
+
+    token : str, optional
+        Evernote developer token used instead of the one of `env`,
+        e.g. when synchronizing multiple accounts
+
+    Returns
+    -------
+    num_removed : int
+
+    Notes
+    -----
+    Evernote API documentation
+        https://dev.evernote.com/doc/reference/NoteStore.html#Fn_NoteStore_expungeNotes
+
+    """
+    auth_token = get_evernote_auth_token(env, token)
+    note_store = get_note_store(env, token)
+    num_removed = 0
+
+    if expunge:
+        for i in range(0, len(guids), batch_size):
+            batch = guids[i:i + batch_size]
+            try:
+                note_store.expungeNotes(auth_token, batch)
+                num_removed += len(batch)
+            except Errors.EDAMNotFoundException:
+                # some notes were already removed by user, fall back to one by one
+                for guid in batch:
+                    num_removed += _remove_note(note_store.expungeNote, auth_token, guid)
+        return num_removed
+
+    def trash(guid):
+        # note stores are not shared between threads, see `get_note_store`
+        return _remove_note(get_note_store(env, token).deleteNote, auth_token, guid)
+
+    if not guids:
+        return num_removed
+    pool = ThreadPool(min(threads, batch_size, len(guids)))
+    try:
+        for i in range(0, len(guids), batch_size):
+            num_removed += sum(pool.map(trash, guids[i:i + batch_size]))
+    finally:
+        pool.close()
+    return num_removed
+
+
+def _remove_note(remove_func, auth_token, guid):
+    """Call `remove_func` on note `guid`, return 1 if removed else 0"""
+    try:
+        remove_func(auth_token, guid)
+    except Errors.EDAMNotFoundException:
+        print("EDAMNotFoundException: Note {} not found".format(guid))
+        return 0
+    return 1
+
+
+def is_rate_limited(error):
+    """Tell whether `error` raised by an Evernote API call means the rate limit was reached
+
+    Parameters
+    ----------
+    error : Exception
+
+    Returns
+    -------
+    bool
+
+    """
+    return isinstance(error, Errors.EDAMSystemException) and \
+        error.errorCode == Errors.EDAMErrorCode.RATE_LIMIT_REACHED
+
+
+def clean_note_title(note_title):
+    """Return the title as unicode without control characters, cut to Evernote's length limit
+
+    Parameters
+    ----------
+    note_title : str / unicode
+
+    Returns
+    -------
+    note_title : unicode
+
+    """
+    if isinstance(note_title, bytes):
+        note_title = note_title.decode('utf-8')
+    # trim by characters, a multi-byte character cut in half is not valid
+    note_title = CONTROL_CHARS.sub(' ', note_title).strip()
+    return note_title[:EDAM_NOTE_TITLE_LEN_MAX].rstrip()
+
+
 def build_note_title(note_title):
     """Return a formatted title with right encoding.
 
@@ -345,7 +727,7 @@ def build_note_title(note_title):
         https://dev.evernote.com/doc/reference/NoteStore.html#Fn_NoteStore_updateNote
 
     """
-    formatted_note_title = note_title.strip().replace('\n', ' ')
+    formatted_note_title = clean_note_title(note_title)
     for title_charset in 'US-ASCII', 'ISO-8859-1', 'UTF-8':
         try:
             formatted_note_title = formatted_note_title.encode(title_charset)
@@ -354,13 +736,107 @@ def build_note_title(note_title):
         else:
             break
 
-    # restrict the size of title in sure to be able to sync to evernote
-    formatted_note_title = formatted_note_title[:EDAM_NOTE_TITLE_LEN_MAX]
-
     return formatted_note_title
 
 
-def build_note_content(note_body, resources):
+def check_note(note_title, note_content, resources, limits):
+    """Check a prepared note against Evernote limits before uploading it.
+
+    Parameters
+    ----------
+    note_title : str
+        Title returned by `build_note_title`
+
+    note_content : str
+        ENML returned by `build_note_content`
+
+    resources : list of evernote.edam.type.ttypes.Resource
+
+    limits : dict
+        Returned by `get_account_limits`
+
+    Returns
+    -------
+    problems : list of str
+        Reasons Evernote would reject the note, empty if none
+
+    """
+    problems = []
+    if not note_title:
+        problems.append('title is empty')
+    if len(note_content) > EDAM_NOTE_CONTENT_LEN_MAX:
+        problems.append('content of {} bytes exceeds {}'.format(len(note_content), EDAM_NOTE_CONTENT_LEN_MAX))
+    try:
+        ElementTree.fromstring(note_content)
+    except ElementTree.ParseError as e:
+        problems.append('content is not well-formed: {}'.format(e))
+
+    if len(resources) > EDAM_NOTE_RESOURCES_MAX:
+        problems.append('{} resources exceed {}'.format(len(resources), EDAM_NOTE_RESOURCES_MAX))
+    for resource in resources:
+        if resource.data.size > limits['resource_bytes']:
+            problems.append('resource {} of {} bytes exceeds {}'.format(
+                resource.attributes.fileName if resource.attributes else '', resource.data.size,
+                limits['resource_bytes']))
+    note_bytes = len(note_content) + sum(r.data.size for r in resources)
+    if note_bytes > limits['note_bytes']:
+        problems.append('note of {} bytes exceeds {}'.format(note_bytes, limits['note_bytes']))
+
+    # resources kept from the existing note are not uploaded again
+    upload_bytes = len(note_content) + sum(r.data.size for r in resources if r.data.body is not None)
+    if upload_bytes > limits['upload_allowance']:
+        problems.append('upload of {} bytes exceeds remaining allowance of {}'.format(
+            upload_bytes, limits['upload_allowance']))
+    return problems
+
+
+def build_text_block(file_name, text, max_bytes):
+    """Return ENML of a file put into the note as text.
+
+    The text is split into `<pre>` blocks of `TEXT_BLOCK_LINES` lines so that
+    Evernote clients stay responsive, and cut to `max_bytes` with a notice.
+
+    Parameters
+    ----------
+    file_name : str
+
+    text : str
+
+    max_bytes : int
+        Maximum size of the returned ENML in UTF-8
+
+    Returns
+    -------
+    enml : str
+
+    """
+    block = "<div><br /><b>%s</b></div>" % escape(file_name)
+    if max_bytes <= len(block.encode('utf-8')) + len(TEXT_TRUNCATED_NOTICE):
+        return ''
+
+    lines = INVALID_XML_CHARS.sub('', text).splitlines()
+    size = len(block.encode('utf-8'))
+    for i in range(0, len(lines), TEXT_BLOCK_LINES):
+        chunk = "<pre>%s</pre>" % escape('\n'.join(lines[i:i + TEXT_BLOCK_LINES]))
+        chunk_size = len(chunk.encode('utf-8'))
+        if size + chunk_size > max_bytes - len(TEXT_TRUNCATED_NOTICE):
+            # keep as many whole lines of the last chunk as possible
+            remaining = max_bytes - len(TEXT_TRUNCATED_NOTICE) - size - len("<pre></pre>")
+            partial = []
+            for line in lines[i:i + TEXT_BLOCK_LINES]:
+                remaining -= len(escape(line).encode('utf-8')) + 1
+                if remaining < 0:
+                    break
+                partial.append(line)
+            if partial:
+                block += "<pre>%s</pre>" % escape('\n'.join(partial))
+            return block + TEXT_TRUNCATED_NOTICE
+        block += chunk
+        size += chunk_size
+    return block
+
+
+def build_note_content(note_body, resources, text_blocks=None):
     """Return notebook content with attachments written in Evernote Markup Language.
 
     Parameters
@@ -371,9 +847,14 @@ def build_note_content(note_body, resources):
     resources : list of evernote.edam.type.ttypes.Resource
         List of attachments to combined with the note
 
+    text_blocks : list of (str, str), optional
+        (file name, raw text) put after attachments in `<pre>` blocks.
+        Text is escaped and truncated to keep the note within Evernote's size limit.
+
     Returns
     -------
     note_content : str
+        Encoded in UTF-8 as declared by the XML declaration
 
     Notes
     -----
@@ -382,7 +863,9 @@ def build_note_content(note_body, resources):
 
 
     """
-    note_content = '<?xml version="1.0" encoding="UTF-8"?>'
+    if isinstance(note_body, bytes):
+        note_body = note_body.decode('utf-8')
+    note_content = u'<?xml version="1.0" encoding="UTF-8"?>'
     note_content += '<!DOCTYPE en-note SYSTEM "http://xml.evernote.com/pub/enml2.dtd">'
     note_content += "<en-note>%s" % note_body
 
@@ -391,20 +874,20 @@ def build_note_content(note_body, resources):
         note_content += "<br />" * 2
 
         for resource in resources:
-            hexhash = resource.data.bodyHash
+            hexhash = get_resource_hexhash(resource)
             note_content += "<br /><en-media type=\"%s\" hash=\"%s\" /><br />" % (resource.mime, hexhash)
-    note_content += "</en-note>"
 
-    # handling encoding
-    for title_charset in 'US-ASCII', 'ISO-8859-1', 'UTF-8':
-        try:
-            note_content = note_content.encode(title_charset)
-        except UnicodeError:
-            pass
-        else:
-            break
+    if text_blocks:
+        # leave room for closing tags and multi-byte characters
+        budget = EDAM_NOTE_CONTENT_LEN_MAX - len(note_content.encode('utf-8')) - 1024
+        for file_name, text in text_blocks:
+            block = build_text_block(file_name, text, budget)
+            note_content += block
+            budget -= len(block.encode('utf-8'))
+    note_content += "</en-note>"
 
-    return note_content
+    # unlike the title, content must match the encoding of its XML declaration
+    return note_content.encode('utf-8')
 
 
 if __name__ == '__main__':
@@ -1,10 +1,22 @@
+import re
 import fire
+import json
+import hashlib
 import requests
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from secret import GITHUB_AUTH_TOKEN
 
 GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+GITHUB_REST_URL = 'https://api.github.com'
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+MAX_FILES_PER_GIST = 100
+REST_PAGE_SIZE = 100
+REST_LIST_WORKERS = 8
+LISTINGS = ('graphql', 'rest')
+REQUEST_TIMEOUT = 60  # seconds to wait for Github to connect or send data
+
+session = requests.Session()  # keep connections to Github alive across requests
 
 
 def get_user_name(token=GITHUB_AUTH_TOKEN):
@@ -33,6 +45,9 @@ def query_graphql(payload, token=GITHUB_AUTH_TOKEN, url=GITHUB_GRAPHQL_URL):
         Valid GraphQL query string.
         e.g., "{\"query\":\"query {\\n  viewer {\\n    login\\n  }\\n}\"}"
 
+    token : str
+        String representing Github Developer Access Token
+
     Returns
     -------
     res : dict
@@ -43,12 +58,131 @@ def query_graphql(payload, token=GITHUB_AUTH_TOKEN, url=GITHUB_GRAPHQL_URL):
         'authorization': "Bearer {}".format(token)
     }
 
-    res = requests.request("POST", url, data=payload, headers=headers).json()
+    res = session.post(url, data=payload, headers=headers, timeout=REQUEST_TIMEOUT).json()
     assert res.get('data', False), 'No data available from Github: {}'.format(res)
     return res
 
 
-def get_gists(cursor=None, size=100):
+def poll_gists(since=None, etag=None, token=GITHUB_AUTH_TOKEN):
+    """Check whether any gist was updated after `since` with a conditional request.
+
+    Github answers 304 Not Modified if the listing still matches `etag`,
+    which does not count against the rate limit.
+
+    Parameters
+    ----------
+    since : str, optional
+        Only consider gists updated after this time, e.g. '2018-01-15T00:48:23Z'
+
+    etag : str, optional
+        ETag returned by the previous poll
+
+    token : str
+        String representing Github Developer Access Token
+
+    Returns
+    -------
+    changed : bool
+        Whether there is any gist updated after `since`
+
+    etag : str
+        ETag to be used in the next poll
+
+    Notes
+    -----
+    Github conditional requests
+        https://developer.github.com/v3/#conditional-requests
+
+    """
+    headers = {'authorization': "token {}".format(token)}
+    if etag:
+        headers['if-none-match'] = etag
+    params = {'per_page': 1}
+    if since:
+        params['since'] = since
+
+    res = session.get(GITHUB_REST_URL + '/gists', params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+    if res.status_code == requests.codes.not_modified:
+        return False, etag
+    assert res.status_code == requests.codes.ok, 'Problem occurred when polling gists: {}'.format(res.text)
+    return len(res.json()) > 0, res.headers.get('ETag')
+
+
+def get_gist_files(gist_name, token=GITHUB_AUTH_TOKEN):
+    """Return files of the gist along with the MD5 sum of their content.
+
+    Parameters
+    ----------
+    gist_name : str
+        Valid gist identifier appear in url
+
+    token : str
+        String representing Github Developer Access Token
+
+    Returns
+    -------
+    files : list of dict
+        Files sorted by name as shown on the gist page, each file is a dict of form:
+            {
+                "filename": "hello.py",
+                "language": "Python",
+                "size": 42,
+                "hash": "c0e14a771bac3b4944318b430efe2884",
+                "content": "print('hello')",
+                "truncated": False,
+                "raw_url": "https://gist.githubusercontent.com/..."
+            }
+
+    Notes
+    -----
+    Github Gists API
+        https://developer.github.com/v3/gists/#get-a-single-gist
+
+    """
+    headers = {'authorization': "token {}".format(token)}
+    res = session.get('{}/gists/{}'.format(GITHUB_REST_URL, gist_name), headers=headers, timeout=REQUEST_TIMEOUT)
+    assert res.status_code == requests.codes.ok, 'Problem occurred when requesting gist {}: {}'.format(
+        gist_name, res.text)
+
+    files = []
+    for f in res.json()['files'].values():
+        # content of files larger than 1MB is truncated, size tells changes beyond it
+        content = u'{}:{}'.format(f['size'], f.get('content') or u'').encode('utf-8')
+        files.append({
+            'filename': f['filename'],
+            'language': f.get('language'),
+            'size': f['size'],
+            'hash': hashlib.md5(content).hexdigest(),
+            'content': f.get('content') or u'',
+            'truncated': f.get('truncated', False),
+            'raw_url': f.get('raw_url')})
+    return sorted(files, key=lambda f: f['filename'].lower())
+
+
+def get_file_content(gist_file, token=GITHUB_AUTH_TOKEN):
+    """Return full content of a file returned by `get_gist_files`, fetch it if truncated
+
+    Parameters
+    ----------
+    gist_file : dict
+
+    token : str
+        String representing Github Developer Access Token
+
+    Returns
+    -------
+    content : str
+
+    """
+    if not gist_file['truncated']:
+        return gist_file['content']
+    res = session.get(gist_file['raw_url'], headers={'authorization': "token {}".format(token)},
+                      timeout=REQUEST_TIMEOUT)
+    assert res.status_code == requests.codes.ok, 'Problem occurred when requesting {}'.format(gist_file['raw_url'])
+    return res.text
+
+
+def get_gists(cursor=None, size=100, token=GITHUB_AUTH_TOKEN, with_files=False):
     """Return all gists (public & secret) and end_cursor for pagination
 
     Parameters
@@ -61,6 +195,13 @@ def get_gists(cursor=None, size=100):
         Specify how many gists to fetch in a HTTP request to Github.
         Default set to Node limit specified by Github GraphQL resource limit.
 
+    token : str
+        String representing Github Developer Access Token
+
+    with_files : bool, optional
+        Also list name, size and language of files in each gist as `files`, e.g.
+            [{"name": "hello.py", "size": 42, "language": {"name": "Python"}}]
+
     Returns
     -------
     gists : list of dict
@@ -87,15 +228,18 @@ def get_gists(cursor=None, size=100):
         https://developer.github.com/v4/guides/resource-limitations/
 
     """
-    first_payload = "{\"query\":\"query {viewer {gists(first:%d, privacy:ALL, orderBy: {field: UPDATED_AT, direction: DESC}) {totalCount edges { node { id description name pushedAt } cursor } pageInfo { endCursor hasNextPage } } } }\"}"
-    payload_template = "{\"query\":\"query {viewer {gists(first:%d, privacy:ALL, orderBy: {field: UPDATED_AT, direction: DESC}, after:\\\"%s\\\") {totalCount edges { node { id description name pushedAt } cursor } pageInfo { endCursor hasNextPage } } } }\"}"
+    first_payload = "{\"query\":\"query {viewer {gists(first:%d, privacy:ALL, orderBy: {field: UPDATED_AT, direction: DESC}) {totalCount edges { node { %s } cursor } pageInfo { endCursor hasNextPage } } } }\"}"
+    payload_template = "{\"query\":\"query {viewer {gists(first:%d, privacy:ALL, orderBy: {field: UPDATED_AT, direction: DESC}, after:\\\"%s\\\") {totalCount edges { node { %s } cursor } pageInfo { endCursor hasNextPage } } } }\"}"
+    fields = "id description name pushedAt"
+    if with_files:
+        fields += " files(limit:%d) { name size language { name } }" % MAX_FILES_PER_GIST
 
     if not cursor:
-        payload = first_payload % size
+        payload = first_payload % (size, fields)
     else:
-        payload = payload_template % (size, cursor)
+        payload = payload_template % (size, cursor, fields)
 
-    res = query_graphql(payload)
+    res = query_graphql(payload, token)
 
 
     # parse nested response for easier usage
@@ -108,19 +252,193 @@ def get_gists(cursor=None, size=100):
     return gists, total, end_cursor, has_next_page
 
 
-def get_number_of_gists():
+def get_gists_by_ids(ids=(), names=(), token=GITHUB_AUTH_TOKEN, with_files=False):
+    """Return given gists in one GraphQL request, without listing all gists
+
+    Parameters
+    ----------
+    ids : list of str, optional
+        GraphQL node ids of gists, i.e. `id` returned by `get_gists`
+
+    names : list of str, optional
+        Gist identifiers appear in url, i.e. `name` returned by `get_gists`
+
+    token : str
+        String representing Github Developer Access Token
+
+    with_files : bool, optional
+        Also list files of each gist, see `get_gists`
+
+    Returns
+    -------
+    gists : list of dict
+        Gists found in the same format as `get_gists`, gists not found are left out
+
+    """
+    fields = "id description name pushedAt"
+    if with_files:
+        fields += " files(limit:%d) { name size language { name } }" % MAX_FILES_PER_GIST
+
+    queries = []
+    if ids:
+        queries.append("nodes(ids: %s) { ... on Gist { %s } }" % (json.dumps(list(ids)), fields))
+    if names:
+        queries.append("viewer { %s }" % ' '.join(
+            "g%d: gist(name: %s) { %s }" % (i, json.dumps(name), fields) for i, name in enumerate(names)))
+    if not queries:
+        return []
+
+    res = query_graphql(json.dumps({'query': "query { %s }" % ' '.join(queries)}), token)
+    data = res['data']
+    gists = [g for g in data.get('nodes') or [] if g]
+    viewer = data.get('viewer') or {}
+    gists += [viewer['g%d' % i] for i in range(len(names)) if viewer.get('g%d' % i)]
+    return gists
+
+
+def get_gists_page(page, since=None, per_page=REST_PAGE_SIZE, token=GITHUB_AUTH_TOKEN, with_files=False):
+    """Return a page of gists listed by the REST API and number of the last page
+
+    Parameters
+    ----------
+    page : int
+        Page number, starting from 1
+
+    since : str, optional
+        Only list gists updated after this time, e.g. '2018-01-15T00:48:23Z'
+
+    per_page : int, optional
+
+    token : str
+        String representing Github Developer Access Token
+
+    with_files : bool, optional
+        Also list files of each gist, see `get_gists`
+
+    Returns
+    -------
+    gists : list of dict
+        Gists in the same format as `get_gists`
+
+    last_page : int
+
+    Notes
+    -----
+    Github Gists API
+        https://developer.github.com/v3/gists/#list-a-users-gists
+
+    """
+    headers = {'authorization': "token {}".format(token)}
+    params = {'page': page, 'per_page': per_page}
+    if since:
+        params['since'] = since
+
+    res = session.get(GITHUB_REST_URL + '/gists', params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+    assert res.status_code == requests.codes.ok, 'Problem occurred when listing gists: {}'.format(res.text)
+
+    last_page = page
+    if 'last' in res.links:
+        last_page = int(re.search(r'[?&]page=(\d+)', res.links['last']['url']).group(1))
+    return [normalize_rest_gist(g, with_files) for g in res.json()], last_page
+
+
+def normalize_rest_gist(gist, with_files=False):
+    """Convert a gist of the REST API into the format of `get_gists`
+
+    Parameters
+    ----------
+    gist : dict
+
+    with_files : bool, optional
+
+    Returns
+    -------
+    gist : dict
+
+    """
+    normalized = {
+        'id': gist['node_id'],
+        'name': gist['id'],
+        'description': gist['description'],
+        'pushedAt': gist['updated_at'],
+    }
+    if with_files:
+        files = sorted(gist['files'].values(), key=lambda f: f['filename'])[:MAX_FILES_PER_GIST]
+        normalized['files'] = [{'name': f['filename'], 'size': f.get('size'),
+                                'language': {'name': f['language']} if f.get('language') else None}
+                               for f in files]
+    return normalized
+
+
+def get_all_gists_rest(after_date=None, token=GITHUB_AUTH_TOKEN, with_files=False, workers=REST_LIST_WORKERS):
+    """Get all gists by fetching pages of the REST listing in parallel.
+
+    The first page tells the number of pages, the others are fetched by
+    `workers` threads at the same time instead of one after another.
+
+    Parameters
+    ----------
+    after_date : datetime.datetime, optional
+        UTC date, only list gists updated after it
+
+    token : str
+        String representing Github Developer Access Token
+
+    with_files : bool, optional
+        Also list files of each gist, see `get_gists`
+
+    workers : int, optional
+        Maximum number of pages fetched at the same time
+
+    Returns
+    -------
+    gists : list of dict
+        Gists in the same format as `get_gists`, most recently updated first.
+        `pushedAt` is the update time of the gist.
+
+    """
+    since = datetime.strftime(after_date, DATE_FORMAT) if after_date else None
+    gists, last_page = get_gists_page(1, since, token=token, with_files=with_files)
+    pages = [gists]
+    if last_page > 1:
+        pool = ThreadPool(min(workers, last_page - 1))
+        try:
+            pages += pool.map(lambda p: get_gists_page(p, since, token=token, with_files=with_files)[0],
+                              range(2, last_page + 1))
+        finally:
+            pool.close()
+            pool.join()
+
+    # gists updated while paging move across page boundaries, keep the latest version of each
+    latest = {}
+    for gist in (g for page in pages for g in page):
+        if gist['id'] not in latest or gist['pushedAt'] > latest[gist['id']]['pushedAt']:
+            latest[gist['id']] = gist
+    gists = sorted(latest.values(), key=lambda g: g['pushedAt'], reverse=True)
+    if after_date:
+        gists = [g for g in gists if datetime.strptime(g['pushedAt'], DATE_FORMAT) > after_date]
+    return gists
+
+
+def get_number_of_gists(token=GITHUB_AUTH_TOKEN):
     """Get total number of gists available in the user account
 
+    Parameters
+    ----------
+    token : str
+        String representing Github Developer Access Token
+
     Returns
     -------
     num_gists : int
     """
     payload = "{\"query\":\"query { viewer { gists(privacy:ALL) {totalCount}}}\"}"
-    res = query_graphql(payload)
+    res = query_graphql(payload, token)
     return res['data']['viewer']['gists']['totalCount']
 
 
-def get_all_gists(size=None, after_date=None, filter_on='pushedAt'):
+def get_all_gists(size=None, after_date=None, filter_on='pushedAt', token=GITHUB_AUTH_TOKEN, with_files=False,
+                  listing='graphql'):
     """Get number of `size` gists at once without pagination.
 
     A wrapper over `get_gists` func. Handle the pagination automatically.
@@ -139,6 +457,16 @@ def get_all_gists(size=None, after_date=None, filter_on='pushedAt'):
     filter_on : str
         Date field corresponding to Github API for Gist
 
+    token : str
+        String representing Github Developer Access Token
+
+    with_files : bool, optional
+        Also list files of each gist, see `get_gists`
+
+    listing : str, optional
+        "graphql" pages through GraphQL cursors one after another,
+        "rest" fetches pages of the REST listing in parallel, see `get_all_gists_rest`
+
     Returns
     -------
     gists : list of dict
@@ -156,14 +484,19 @@ def get_all_gists(size=None, after_date=None, filter_on='pushedAt'):
 
 
     """
+    assert listing in LISTINGS, 'Unknown gist listing {}, expected one of {}'.format(listing, LISTINGS)
+    if listing == 'rest':
+        gists = get_all_gists_rest(after_date=after_date, token=token, with_files=with_files)
+        return gists[:size] if size else gists
+
     if not size:
-        size = get_number_of_gists()
+        size = get_number_of_gists(token)
 
     end_cursor = None
     gists = []
 
     while True:
-        cur_gists, total, end_cursor, has_next_page = get_gists(end_cursor)
+        cur_gists, total, end_cursor, has_next_page = get_gists(end_cursor, token=token, with_files=with_files)
         for gist in cur_gists:
             pushed_date = datetime.strptime(gist[filter_on], DATE_FORMAT)
             if after_date and pushed_date <= after_date:
@@ -0,0 +1,311 @@
+import abc
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import fire
+JOBS_FILE = 'jobs.sqlite'
+LEASE_SECONDS = 300
+
+
+class JobQueue(object):
+    """Queue of render + upload jobs shared by a coordinator and many workers.
+
+    The coordinator puts jobs, workers lease them for a limited time, keep the
+    lease alive with heartbeats and ack or fail them when done. Leases not
+    renewed in time expire and the job can be leased by another worker.
+
+    This class only defines the interface, thus make it easy to plug in
+    a queue backend shared by multiple machines.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def put(self, job_id, payload):
+        """Enqueue a job, or replace the payload of a job waiting or failed.
+
+        Progress saved by previous lease holders is kept, e.g. guid of
+        a note already created, so that the note is not duplicated.
+
+        Parameters
+        ----------
+        job_id : str
+            Unique job identifier, e.g. the gist id
+        payload : dict
+            JSON serializable job description
+
+        Returns
+        -------
+        bool
+            False if the job is currently leased by a worker, or done and its
+            result not collected by `pop_finished` yet, and left untouched
+
+        """
+
+    @abc.abstractmethod
+    def lease(self, worker, lease_seconds=LEASE_SECONDS):
+        """Lease the oldest available job, including jobs whose lease expired.
+
+        Parameters
+        ----------
+        worker : str
+            Identifier of the leasing worker
+        lease_seconds : int, optional
+            Seconds before the lease expires without heartbeat
+
+        Returns
+        -------
+        job : dict
+            {'id': job_id, 'token': lease_token, 'payload': payload, 'attempts': int}
+            None if no job is available. Progress reported by the previous
+            lease holder is merged into the payload.
+
+        """
+
+    @abc.abstractmethod
+    def heartbeat(self, job, lease_seconds=LEASE_SECONDS, progress=None):
+        """Extend the lease of `job`, optionally saving progress for the next lease holder.
+
+        Parameters
+        ----------
+        job : dict
+            Job returned by `lease`
+        lease_seconds : int, optional
+        progress : dict, optional
+
+        Returns
+        -------
+        bool
+            False if the lease was lost
+
+        """
+
+    @abc.abstractmethod
+    def ack(self, job, result):
+        """Mark `job` as done with `result`.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost
+
+        """
+
+    @abc.abstractmethod
+    def fail(self, job, error):
+        """Mark `job` as failed with `error`.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost
+
+        """
+
+    @abc.abstractmethod
+    def pop_finished(self):
+        """Remove and return all done or failed jobs.
+
+        Returns
+        -------
+        jobs : list of dict
+            {'id': job_id, 'payload': payload, 'state': 'done' / 'failed',
+             'result': dict, 'error': str}
+
+        """
+
+    @abc.abstractmethod
+    def count(self):
+        """Return number of jobs by state.
+
+        Returns
+        -------
+        counts : dict
+
+        """
+
+
+class SQLiteJobQueue(JobQueue):
+    """Job queue stored in a local SQLite file.
+
+    Suitable for workers on the same machine or tests. A new connection is
+    opened for every operation, so the queue can be used from multiple
+    threads and processes.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file
+
+    """
+
+    def __init__(self, path=JOBS_FILE):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, payload TEXT, state TEXT, token TEXT, worker TEXT, "
+                "lease_until REAL, attempts INTEGER DEFAULT 0, progress TEXT, "
+                "result TEXT, error TEXT, queued_at REAL)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return _Transaction(conn)
+
+    def put(self, job_id, payload):
+        with self._connect() as conn:
+            row = conn.execute("SELECT state, lease_until FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row and row['state'] == 'leased' and row['lease_until'] > time.time():
+                return False
+            # replacing a done job would lose its result, e.g. guid of the note created
+            if row and row['state'] == 'done':
+                return False
+            if row:
+                # keep progress of an expired lease or a failed job
+                conn.execute(
+                    "UPDATE jobs SET payload = ?, state = 'queued', token = NULL, error = NULL WHERE id = ?",
+                    (json.dumps(payload), job_id))
+            else:
+                conn.execute(
+                    "INSERT INTO jobs (id, payload, state, attempts, queued_at) "
+                    "VALUES (?, ?, 'queued', 0, ?)", (job_id, json.dumps(payload), time.time()))
+        return True
+
+    def lease(self, worker, lease_seconds=LEASE_SECONDS):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE state = 'queued' OR (state = 'leased' AND lease_until < ?) "
+                "ORDER BY queued_at LIMIT 1", (now,)).fetchone()
+            if not row:
+                return None
+            token = uuid.uuid4().hex
+            conn.execute(
+                "UPDATE jobs SET state = 'leased', token = ?, worker = ?, lease_until = ?, "
+                "attempts = attempts + 1 WHERE id = ?", (token, worker, now + lease_seconds, row['id']))
+
+        payload = json.loads(row['payload'])
+        payload.update(json.loads(row['progress'] or '{}'))
+        return {'id': row['id'], 'token': token, 'payload': payload, 'attempts': row['attempts'] + 1}
+
+    def heartbeat(self, job, lease_seconds=LEASE_SECONDS, progress=None):
+        with self._connect() as conn:
+            if progress is not None:
+                cursor = conn.execute(
+                    "UPDATE jobs SET lease_until = ?, progress = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                    (time.time() + lease_seconds, json.dumps(progress), job['id'], job['token']))
+            else:
+                cursor = conn.execute(
+                    "UPDATE jobs SET lease_until = ? WHERE id = ? AND token = ? AND state = 'leased'",
+                    (time.time() + lease_seconds, job['id'], job['token']))
+        return cursor.rowcount == 1
+
+    def ack(self, job, result):
+        return self._finish(job, 'done', result=json.dumps(result))
+
+    def fail(self, job, error):
+        return self._finish(job, 'failed', error=repr(error))
+
+    def _finish(self, job, state, result=None, error=None):
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = ?, token = NULL "
+                "WHERE id = ? AND token = ? AND state = 'leased'",
+                (state, result, error, job['id'], job['token']))
+        return cursor.rowcount == 1
+
+    def pop_finished(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs WHERE state IN ('done', 'failed')").fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(row['id'],) for row in rows])
+        return [{'id': row['id'],
+                 'payload': json.loads(row['payload']),
+                 'state': row['state'],
+                 'result': json.loads(row['result'] or '{}'),
+                 'error': row['error']} for row in rows]
+
+    def count(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        return dict((row['state'], row['n']) for row in rows)
+
+
+class _Transaction(object):
+    """Run statements on `conn` in a single immediate transaction, then close it"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        # take the write lock up-front so that two workers never lease the same job
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        self.conn.close()
+
+
+class Heartbeat(threading.Thread):
+    """Background thread keeping the lease of a job alive while it is processed.
+
+    Parameters
+    ----------
+    queue : JobQueue
+    job : dict
+        Job returned by `JobQueue.lease`
+    lease_seconds : int, optional
+
+    """
+
+    def __init__(self, queue, job, lease_seconds=LEASE_SECONDS):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.queue = queue
+        self.job = job
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        # renew well before expiration to tolerate a slow queue backend
+        while not self._stopped.wait(self.lease_seconds / 3.0):
+            if not self.queue.heartbeat(self.job, self.lease_seconds):
+                self.lost = True
+                print("Lease of job {} was lost".format(self.job['id']))
+                return
+
+    def set_progress(self, progress):
+        """Save `progress` so that the next lease holder can resume from it"""
+        if not self.queue.heartbeat(self.job, self.lease_seconds, progress=progress):
+            self.lost = True
+
+    def stop(self):
+        self._stopped.set()
+
+
+def get_queue(url=JOBS_FILE):
+    """Get a job queue instance by `url`
+
+    Parameters
+    ----------
+    url : str
+        Location of the queue. A file path or "sqlite:///path/to/file"
+        for the SQLite backend.
+
+    Returns
+    -------
+    queue : JobQueue instance
+
+    """
+    if url.startswith('sqlite:///'):
+        return SQLiteJobQueue(url[len('sqlite:///'):])
+    if '://' in url:
+        raise ValueError('Unsupported job queue: {}'.format(url))
+    return SQLiteJobQueue(url)
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,238 @@
+import json
+import fire
+from datetime import datetime
+PLAN_FILE = 'plan.json'
+PLAN_VERSION = 1
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# cost model of gists never rendered, calibrated by metrics of past runs when available
+RENDER_SECONDS_PER_GIST = 6.0  # page load
+RENDER_SECONDS_PER_FILE = 1.5  # scrolling and capturing
+RENDER_SECONDS_PER_KB = 0.02
+RENDER_SECONDS_FACTOR = {  # by Github language, e.g. notebooks with outputs take long to load and capture
+    'Jupyter Notebook': 3.0,
+    'Markdown': 1.5,
+}
+UPLOAD_BYTES_PER_FILE = 20000
+UPLOAD_BYTES_PER_BYTE = {  # PNG bytes per byte of source by Github language
+    'Jupyter Notebook': 1.5,
+    'Markdown': 40,
+    'Text': 30,
+}
+DEFAULT_UPLOAD_BYTES_PER_BYTE = 60
+
+
+def classify_gists(db, gists):
+    """Classify gists listed on Github by comparing them with the database.
+
+    Parameters
+    ----------
+    db : db.Database
+
+    gists : list of dict
+        Complete listing of gists available in the Github account
+
+    Returns
+    -------
+    actions : dict
+        'new' / 'changed' / 'unchanged' -> list of gists,
+        'deleted' -> list of gists only found in database
+
+    """
+    actions = {'new': [], 'changed': [], 'unchanged': [], 'deleted': []}
+    listed_ids = set()
+    for gist in gists:
+        listed_ids.add(gist['id'])
+        saved = db.get_gist(gist['id'])
+        if not saved.get('note_guid'):
+            actions['new'].append(gist)
+        elif saved.get('pushedAt') != gist['pushedAt'] or not saved.get('hash'):
+            actions['changed'].append(gist)
+        else:
+            actions['unchanged'].append(gist)
+
+    # an empty listing is more likely a Github hiccup than deleting every gist
+    if gists:
+        for gist_id in db.get_gist_ids() - listed_ids:
+            actions['deleted'].append(db.get_gist(gist_id))
+    return actions
+
+
+def get_calibration(db):
+    """Fit render seconds and upload bytes per source byte from metrics of past runs.
+
+    Parameters
+    ----------
+    db : db.Database
+
+    Returns
+    -------
+    calibration : dict
+        {'seconds_per_byte': float, 'upload_per_byte': float}, None for
+        ratios without enough history
+
+    """
+    seconds = upload = source = 0
+    for gist_id in db.get_gist_ids():
+        saved = db.get_gist(gist_id)
+        if saved.get('source_bytes') and saved.get('render_seconds') and saved.get('upload_bytes'):
+            seconds += saved['render_seconds']
+            upload += saved['upload_bytes']
+            source += saved['source_bytes']
+
+    # a few gists tell little about the account
+    if source < 100000:
+        return {'seconds_per_byte': None, 'upload_per_byte': None}
+    return {'seconds_per_byte': float(seconds) / source, 'upload_per_byte': float(upload) / source}
+
+
+def estimate_cost(db, gist, calibration=None):
+    """Estimate seconds to render the gist and bytes to upload.
+
+    Metrics of the gist recorded in past runs are used if available,
+    otherwise the cost is estimated by size and language of its files.
+
+    Parameters
+    ----------
+    db : db.Database
+
+    gist : dict
+        Gist listed with files, see `github.util.get_gists`
+
+    calibration : dict, optional
+        Returned by `get_calibration`
+
+    Returns
+    -------
+    render_seconds : float
+
+    upload_bytes : int
+
+    """
+    saved = db.get_gist(gist['id'])
+    if saved.get('render_seconds') and saved.get('upload_bytes'):
+        return saved['render_seconds'], saved['upload_bytes']
+
+    calibration = calibration or {}
+    files = gist.get('files') or []
+    source_bytes = sum(f['size'] or 0 for f in files)
+
+    if calibration.get('seconds_per_byte'):
+        render_seconds = RENDER_SECONDS_PER_GIST + calibration['seconds_per_byte'] * source_bytes
+    else:
+        render_seconds = RENDER_SECONDS_PER_GIST + RENDER_SECONDS_PER_FILE * len(files)
+        for f in files:
+            language = (f.get('language') or {}).get('name')
+            render_seconds += RENDER_SECONDS_FACTOR.get(language, 1.0) * RENDER_SECONDS_PER_KB * (f['size'] or 0) / 1024.
+
+    if calibration.get('upload_per_byte'):
+        upload_bytes = calibration['upload_per_byte'] * source_bytes
+    else:
+        upload_bytes = 0
+        for f in files:
+            language = (f.get('language') or {}).get('name')
+            upload_bytes += UPLOAD_BYTES_PER_FILE + \
+                UPLOAD_BYTES_PER_BYTE.get(language, DEFAULT_UPLOAD_BYTES_PER_BYTE) * (f['size'] or 0)
+    return round(render_seconds, 1), int(upload_bytes)
+
+
+def make_plan(db, gists):
+    """Plan a synchronization from the listing and the database only.
+
+    Parameters
+    ----------
+    db : db.Database
+
+    gists : list of dict
+        Complete listing of gists with files, see `github.util.get_all_gists`
+
+    Returns
+    -------
+    plan : dict
+        {'version': int, 'created_at': str, 'summary': dict,
+         'items': [{'action': str, 'gist': dict, 'render_seconds': float, 'upload_bytes': int}]}
+
+    """
+    calibration = get_calibration(db)
+    items = []
+    for action, action_gists in sorted(classify_gists(db, gists).items()):
+        for gist in action_gists:
+            render_seconds, upload_bytes = 0, 0
+            if action in ('new', 'changed'):
+                render_seconds, upload_bytes = estimate_cost(db, gist, calibration)
+            items.append({'action': action, 'render_seconds': render_seconds, 'upload_bytes': upload_bytes,
+                          'gist': dict((k, v) for k, v in gist.items() if k != 'files')})
+
+    summary = {}
+    for item in items:
+        entry = summary.setdefault(item['action'], {'gists': 0, 'render_seconds': 0, 'upload_bytes': 0})
+        entry['gists'] += 1
+        entry['render_seconds'] += item['render_seconds']
+        entry['upload_bytes'] += item['upload_bytes']
+
+    return {'version': PLAN_VERSION,
+            'created_at': datetime.utcnow().strftime(DATE_FORMAT),
+            'summary': summary,
+            'items': items}
+
+
+def format_summary(plan):
+    """Return the summary of `plan` as readable lines
+
+    Parameters
+    ----------
+    plan : dict
+
+    Returns
+    -------
+    text : str
+
+    """
+    lines = []
+    total_seconds = total_bytes = 0
+    for action in ('new', 'changed', 'unchanged', 'deleted'):
+        entry = plan['summary'].get(action, {'gists': 0, 'render_seconds': 0, 'upload_bytes': 0})
+        lines.append("{:<10} {:>6} gists {:>8.0f} s {:>10.1f} MB".format(
+            action, entry['gists'], entry['render_seconds'], entry['upload_bytes'] / 1e6))
+        total_seconds += entry['render_seconds']
+        total_bytes += entry['upload_bytes']
+    lines.append("{:<10} {:>6}       {:>8.0f} s {:>10.1f} MB".format(
+        'total', '', total_seconds, total_bytes / 1e6))
+    return '\n'.join(lines)
+
+
+def save_plan(plan, path=PLAN_FILE):
+    """Save `plan` to `path` as JSON
+
+    Parameters
+    ----------
+    plan : dict
+        Returned by `make_plan`
+
+    path : str, optional
+
+    """
+    with open(path, 'w') as fp:
+        json.dump(plan, fp, indent=2)
+
+
+def load_plan(path=PLAN_FILE):
+    """Load a plan saved by `save_plan`
+
+    Parameters
+    ----------
+    path : str, optional
+
+    Returns
+    -------
+    plan : dict
+
+    """
+    with open(path, 'r') as fp:
+        plan = json.load(fp)
+    assert plan.get('version') == PLAN_VERSION, 'Unsupported plan version: {}'.format(plan.get('version'))
+    return plan
+
+
+if __name__ == '__main__':
+    fire.Fire()
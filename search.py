@@ -0,0 +1,172 @@
+import os
+import fire
+import sqlite3
+from contextlib import contextmanager
+INDEX_FILE = 'index.sqlite'
+GIST_BASE_URL = 'https://gist.github.com'
+NOTE_URL = 'https://www.evernote.com/Home.action#n={}'
+SNIPPET_TOKENS = 12
+
+
+class SearchIndex(object):
+    """Full-text index of file names, descriptions and content of synced gists.
+
+    Stored in a local SQLite file using FTS5, or FTS4 if the SQLite library
+    was built without FTS5. A new connection is opened for every operation,
+    so the index can be updated from multiple threads.
+
+    Parameters
+    ----------
+    path : str
+        Path of the SQLite file
+
+    """
+
+    def __init__(self, path=INDEX_FILE):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS gists ("
+                "gist_id TEXT PRIMARY KEY, name TEXT, description TEXT, note_guid TEXT)")
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'gist_files'").fetchone()
+            if row:
+                self.fts5 = 'fts5' in row[0].lower()
+                return
+            try:
+                conn.execute("CREATE VIRTUAL TABLE gist_files USING fts5("
+                             "gist_id UNINDEXED, file_name, description, content)")
+                self.fts5 = True
+            except sqlite3.OperationalError:
+                conn.execute("CREATE VIRTUAL TABLE gist_files USING fts4("
+                             "gist_id, file_name, description, content, notindexed=gist_id)")
+                self.fts5 = False
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def update_gist(self, gist, note_guid, files):
+        """Replace indexed content of the gist.
+
+        Parameters
+        ----------
+        gist : dict
+
+        note_guid : str
+
+        files : list of (str, str)
+            (file name, content) of each file in the gist
+
+        """
+        description = gist.get('description') or ''
+        with self._connect() as conn:
+            conn.execute("DELETE FROM gist_files WHERE gist_id = ?", (gist['id'],))
+            conn.execute("INSERT OR REPLACE INTO gists (gist_id, name, description, note_guid) VALUES (?, ?, ?, ?)",
+                         (gist['id'], gist['name'], description, note_guid))
+            conn.executemany(
+                "INSERT INTO gist_files (gist_id, file_name, description, content) VALUES (?, ?, ?, ?)",
+                [(gist['id'], file_name, description, content) for file_name, content in files])
+
+    def remove_gists(self, gist_ids):
+        """Remove given gists from the index
+
+        Parameters
+        ----------
+        gist_ids : iterable of str
+
+        """
+        rows = [(gist_id,) for gist_id in gist_ids]
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM gist_files WHERE gist_id = ?", rows)
+            conn.executemany("DELETE FROM gists WHERE gist_id = ?", rows)
+
+    def search(self, query, limit=10):
+        """Return gists matching `query`, best matches first.
+
+        Parameters
+        ----------
+        query : str
+            SQLite full-text query, e.g. 'pandas merge' or '"exact phrase"'.
+            Treated as plain words if it is not a valid full-text query.
+
+        limit : int, optional
+            Maximum number of gists
+
+        Returns
+        -------
+        results : list of dict
+            {'gist_id', 'name', 'description', 'file_name', 'snippet', 'gist_url', 'note_url'}
+
+        """
+        try:
+            rows = self._match(query)
+        except sqlite3.OperationalError:
+            words = ['"{}"'.format(w.replace('"', '""')) for w in query.split()]
+            rows = self._match(' '.join(words)) if words else []
+
+        # keep the best matching file of each gist
+        results, seen = [], set()
+        for gist_id, file_name, snippet in rows:
+            if gist_id in seen:
+                continue
+            seen.add(gist_id)
+            results.append({'gist_id': gist_id, 'file_name': file_name, 'snippet': snippet})
+            if len(results) >= limit:
+                break
+
+        with self._connect() as conn:
+            for result in results:
+                name, description, note_guid = conn.execute(
+                    "SELECT name, description, note_guid FROM gists WHERE gist_id = ?",
+                    (result['gist_id'],)).fetchone()
+                result.update({'name': name, 'description': description,
+                               'gist_url': '/'.join((GIST_BASE_URL, name)),
+                               'note_url': NOTE_URL.format(note_guid) if note_guid else None})
+        return results
+
+    def _match(self, query):
+        """Return (gist id, file name, snippet) of matching files ordered by relevance"""
+        with self._connect() as conn:
+            if self.fts5:
+                # file names weigh more than descriptions, and descriptions more than content
+                return conn.execute(
+                    "SELECT gist_id, file_name, snippet(gist_files, -1, '[', ']', '...', ?) FROM gist_files "
+                    "WHERE gist_files MATCH ? ORDER BY bm25(gist_files, 0, 5.0, 3.0, 1.0)",
+                    (SNIPPET_TOKENS, query)).fetchall()
+
+            # FTS4 has no ranking function, rank by number of matched terms
+            rows = conn.execute(
+                "SELECT gist_id, file_name, snippet(gist_files, '[', ']', '...', -1, ?), offsets(gist_files) "
+                "FROM gist_files WHERE gist_files MATCH ?", (SNIPPET_TOKENS, query)).fetchall()
+        rows.sort(key=lambda row: -len(row[3].split()))
+        return [row[:3] for row in rows]
+
+
+def get_index(state_dir=None):
+    """Get a search index instance stored next to the database
+
+    Parameters
+    ----------
+    state_dir : str, optional
+        Directory to store the index file, e.g. one per account.
+        Default to current working directory.
+
+    Returns
+    -------
+    index : SearchIndex instance
+
+    """
+    if not state_dir:
+        return SearchIndex()
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return SearchIndex(os.path.join(state_dir, INDEX_FILE))
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -2,3 +2,45 @@ GITHUB_AUTH_TOKEN = ""
 EVERNOTE_PROD_TOKEN = ""
 EVERNOTE_SANDBOX_TOKEN = ""
 NOTEBOOK_TO_SYNC = "gist-evernote"
+
+# "fitted" captures each gist file clipped to its content at a device scale
+# chosen by its language, "fullpage" captures the whole page as is
+CAPTURE_MODE = "fitted"
+
+# files put into notes as text instead of images, optionally with
+# an image of their first screenful
+TEXT_MODE_EXTENSIONS = [".log", ".csv", ".tsv", ".txt"]
+TEXT_MODE_MIN_BYTES = 200 * 1024
+TEXT_MODE_MIN_LINES = 2000
+TEXT_MODE_PREVIEW = True
+IMAGE_ONLY_LANGUAGES = ["Jupyter Notebook"]
+
+# Chrome profiles kept across runs so that Github's assets come from the
+# HTTP cache, set to None for a throwaway profile per driver
+CHROME_PROFILE_DIR = "chrome-profiles"
+CHROME_CACHE_BYTES = 200 * 1024 * 1024
+
+# render unchanged content to the same image bytes: animations disabled,
+# fonts pinned, timestamps frozen and volatile elements like avatars masked
+DETERMINISTIC_CAPTURE = True
+
+# adjust number of gists rendered / uploaded at the same time from throughput,
+# errors and host load, up to the number of tabs / MAX_CONCURRENT_UPLOADS
+ADAPTIVE_CONCURRENCY = True
+MAX_CONCURRENT_UPLOADS = 4
+
+# how gists are listed: "graphql" pages one after another,
+# "rest" fetches pages in parallel, faster for large accounts
+GIST_LISTING = "graphql"
+
+# seconds each stage of a gist may take before it is cancelled and retried later:
+# Github requests of listing / hashing, loading the gist page, capturing its files,
+# encoding an image and each Evernote API call
+DEADLINES = {
+    'listing': 60,
+    'hash': 60,
+    'page_load': 30,
+    'capture': 180,
+    'encode': 300,
+    'upload': 180,
+}
@@ -0,0 +1,123 @@
+import os
+import json
+import fire
+from db import get_db
+from search import get_index
+from settings import NOTEBOOK_TO_SYNC
+TENANTS_FILE = 'tenants.json'
+TENANTS_DIR = 'tenants'
+
+
+class Tenant(object):
+    """A Github account synchronized to a notebook of an Evernote account.
+
+    Hold the credentials and the isolated synchronization state of the account,
+    so that multiple accounts can be synchronized in one process.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the tenant, e.g. the Github login
+
+    github_token : str
+        Github Personal Access Token
+
+    evernote_token : str
+        Evernote developer token
+
+    notebook : str, optional
+        Name of the Evernote notebook to put gists
+
+    state_dir : str, optional
+        Directory to store the database and search index of the tenant.
+        Default to current working directory.
+
+    """
+
+    def __init__(self, name, github_token, evernote_token, notebook=NOTEBOOK_TO_SYNC, state_dir=None):
+        self.name = name
+        self.github_token = github_token
+        self.evernote_token = evernote_token
+        self.notebook_name = notebook
+        self.db = get_db(state_dir)
+        self.index = get_index(state_dir)
+        self.notebook = None  # set once the notebook is found or created
+        self._github_user = None
+        self._account_limits = None
+
+    @property
+    def github_user(self):
+        """Login of the Github account, used for fetching gist content"""
+        if self._github_user is None:
+            from github.util import get_user_name
+            self._github_user = get_user_name(self.github_token)
+        return self._github_user
+
+    @property
+    def account_limits(self):
+        """Size limits of notes and remaining upload allowance of the Evernote account"""
+        if self._account_limits is None:
+            from enote.util import get_account_limits
+            self._account_limits = get_account_limits(token=self.evernote_token)
+        return self._account_limits
+
+    def refresh_account_limits(self):
+        """Read `account_limits` again on next use, e.g. in each synchronization cycle"""
+        self._account_limits = None
+
+    def __repr__(self):
+        return 'Tenant({})'.format(self.name)
+
+
+def get_default_tenant():
+    """Get the tenant configured by `settings.py` and stored in current directory
+
+    Returns
+    -------
+    tenant : Tenant
+
+    """
+    from github.util import GITHUB_AUTH_TOKEN
+    from enote.util import get_evernote_auth_token
+    return Tenant('default', GITHUB_AUTH_TOKEN, get_evernote_auth_token(), NOTEBOOK_TO_SYNC)
+
+
+def load_tenants(config=TENANTS_FILE):
+    """Load tenants from a JSON config file.
+
+    The file contains a list of accounts like:
+        [
+            {
+                "name": "alice",
+                "github_token": "...",
+                "evernote_token": "...",
+                "notebook": "gist-evernote"
+            }
+        ]
+    The state of each tenant is stored under `TENANTS_DIR/<name>` unless
+    `state_dir` is given.
+
+    Parameters
+    ----------
+    config : str
+        Path of the config file
+
+    Returns
+    -------
+    tenants : list of Tenant
+
+    """
+    with open(config, 'r') as fp:
+        accounts = json.load(fp)
+
+    names = [a['name'] for a in accounts]
+    assert len(names) == len(set(names)), 'Tenant names are not unique: {}'.format(names)
+
+    return [Tenant(a['name'], a['github_token'], a['evernote_token'],
+                   notebook=a.get('notebook', NOTEBOOK_TO_SYNC),
+                   state_dir=a.get('state_dir', os.path.join(TENANTS_DIR, a['name'])))
+            for a in accounts]
+
+
+if __name__ == '__main__':
+    fire.Fire()
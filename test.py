@@ -0,0 +1,612 @@
+# encoding: utf-8
+import os
+import sys
+import json
+import imp
+import time
+import sqlite3
+import hashlib
+import base64
+import shutil
+import tempfile
+import unittest
+import threading
+import multiprocessing
+from io import BytesIO
+from datetime import datetime
+from xml.etree import ElementTree
+from PIL import Image
+from evernote.edam.type import ttypes
+from evernote.edam.limits.constants import EDAM_NOTE_RESOURCES_MAX
+
+import concurrency
+from concurrency import AdaptiveLimit
+from db import Database
+from jobs import SQLiteJobQueue
+import github.util
+from github.util import normalize_rest_gist, get_all_gists_rest
+from search import SearchIndex
+from plan import classify_gists, estimate_cost, RENDER_SECONDS_PER_GIST, UPLOAD_BYTES_PER_FILE
+from enex import EnexWriter
+from enote.util import build_resource, build_text_block, TEXT_BLOCK_LINES, TEXT_TRUNCATED_NOTICE
+import web.util
+from web.util import lock_profile, canonical_chunks, match_gist_hash, generate_hexhash, fit_image, HASH_SCHEME
+from app import preflight_note, group_resource_parts
+
+
+class TestSQLiteJobQueue(unittest.TestCase):
+    """ Job queue shared by coordinator and workers, without network access """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = SQLiteJobQueue(os.path.join(self.directory, 'jobs.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_lease(self):
+        ''' Jobs are leased once, oldest first '''
+        self.assertTrue(self.queue.put('a', {'n': 1}))
+        self.assertTrue(self.queue.put('b', {'n': 2}))
+        job = self.queue.lease('worker-1')
+        self.assertEqual(job['id'], 'a')
+        self.assertEqual(job['payload'], {'n': 1})
+        self.assertEqual(job['attempts'], 1)
+        self.assertEqual(self.queue.lease('worker-2')['id'], 'b')
+        self.assertIsNone(self.queue.lease('worker-3'))
+
+    def test_put_leased_job_is_refused(self):
+        ''' A job leased by a live worker is left untouched '''
+        self.queue.put('a', {'n': 1})
+        self.queue.lease('worker-1')
+        self.assertFalse(self.queue.put('a', {'n': 2}))
+
+    def test_heartbeat_and_ack(self):
+        ''' Progress is kept with the lease, results are popped once '''
+        self.queue.put('a', {'n': 1})
+        job = self.queue.lease('worker-1')
+        self.assertTrue(self.queue.heartbeat(job, progress={'note_guid': 'guid'}))
+        self.assertTrue(self.queue.ack(job, {'note_guid': 'guid'}))
+        self.assertFalse(self.queue.heartbeat(job))
+        self.assertEqual(self.queue.count(), {'done': 1})
+
+        finished = self.queue.pop_finished()
+        self.assertEqual(len(finished), 1)
+        self.assertEqual(finished[0]['state'], 'done')
+        self.assertEqual(finished[0]['result'], {'note_guid': 'guid'})
+        self.assertEqual(self.queue.pop_finished(), [])
+
+    def test_expired_lease_resumes_progress(self):
+        ''' Another worker takes over an expired lease with the saved progress '''
+        self.queue.put('a', {'n': 1})
+        job = self.queue.lease('worker-1', lease_seconds=0.1)
+        self.queue.heartbeat(job, lease_seconds=0.1, progress={'note_guid': 'guid'})
+        time.sleep(0.2)
+
+        retaken = self.queue.lease('worker-2')
+        self.assertEqual(retaken['id'], 'a')
+        self.assertEqual(retaken['attempts'], 2)
+        self.assertEqual(retaken['payload']['note_guid'], 'guid')
+        self.assertFalse(self.queue.ack(job, {}))
+        self.assertTrue(self.queue.ack(retaken, {}))
+
+    def test_put_done_job_keeps_result(self):
+        ''' Putting a job acked but not collected yet does not lose its result '''
+        self.queue.put('a', {'n': 1})
+        job = self.queue.lease('worker-1')
+        self.queue.ack(job, {'note_guid': 'guid'})
+        self.assertFalse(self.queue.put('a', {'n': 2}))
+        self.assertIsNone(self.queue.lease('worker-2'))
+        self.assertEqual(self.queue.pop_finished()[0]['result'], {'note_guid': 'guid'})
+
+    def test_put_failed_job_keeps_progress(self):
+        ''' A failed job is queued again with the guid of the note already created '''
+        self.queue.put('a', {'n': 1})
+        job = self.queue.lease('worker-1')
+        self.queue.heartbeat(job, progress={'note_guid': 'guid'})
+        self.queue.fail(job, ValueError('boom'))
+        self.assertTrue(self.queue.put('a', {'n': 2}))
+
+        job = self.queue.lease('worker-2')
+        self.assertEqual(job['payload'], {'n': 2, 'note_guid': 'guid'})
+
+
+class TestEnexWriter(unittest.TestCase):
+    """ Export of notes to .enex files, without network access """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_non_ascii_note_is_parsed_back(self):
+        ''' Non-ASCII title, body, text and file name survive a round trip as UTF-8 '''
+        data = b'\x89PNG\r\n\x1a\n' + os.urandom(100000)
+        resource, hexhash = build_resource(data, file_name=u'café.png')
+        with EnexWriter(self.directory) as writer:
+            writer.write_note(u'Café ü 中文', u'naïve <a href="https://gist.github.com/x">Gist on Github</a>',
+                              [resource], source_url='https://gist.github.com/x',
+                              text_blocks=[(u'notes.md', u'crème brûlée ]]> 中文')])
+
+        self.assertEqual(len(writer.files), 1)
+        note = ElementTree.parse(writer.files[0]).getroot().find('note')
+        self.assertEqual(note.find('title').text, u'Café ü 中文')
+
+        content = note.find('content').text
+        self.assertIn(u'naïve', content)
+        self.assertIn(u'crème brûlée ]]&gt; 中文', content)
+        self.assertIn(hexhash, content)
+        ElementTree.fromstring(content.encode('utf-8'))
+
+        resource = note.find('resource')
+        self.assertEqual(base64.b64decode(''.join(resource.find('data').text.split())), data)
+        self.assertEqual(resource.find('resource-attributes/file-name').text, u'café.png')
+
+
+def _lock_profile_when_set(profile_root, start, profiles):
+    start.wait()
+    profiles.put(lock_profile(profile_root))
+
+
+class TestLockProfile(unittest.TestCase):
+    """ Chrome profiles locked by concurrent processes """
+
+    def test_concurrent_locks_get_distinct_profiles(self):
+        ''' Processes racing for profiles, one of them left stale, never share one '''
+        for _ in range(20):
+            profile_root = tempfile.mkdtemp()
+            try:
+                os.makedirs(os.path.join(profile_root, '0'))
+                with open(os.path.join(profile_root, '0.lock'), 'w') as fp:
+                    fp.write('999999999')  # no such process
+                start, profiles = multiprocessing.Event(), multiprocessing.Queue()
+                processes = [multiprocessing.Process(target=_lock_profile_when_set,
+                                                     args=(profile_root, start, profiles)) for _ in range(4)]
+                for process in processes:
+                    process.start()
+                start.set()
+                locked = [profiles.get(timeout=30) for _ in processes]
+                for process in processes:
+                    process.join()
+                self.assertEqual(len(set(locked)), len(processes))
+            finally:
+                shutil.rmtree(profile_root)
+
+
+class TestTextBlock(unittest.TestCase):
+    """ Files put into notes as text """
+
+    def test_blocks_of_lines(self):
+        ''' Text is escaped and split into blocks of `TEXT_BLOCK_LINES` lines '''
+        text = u'\n'.join(u'if a < b: print("café")' for _ in range(TEXT_BLOCK_LINES + 1))
+        enml = build_text_block(u'a.py', text, 10 ** 6)
+        self.assertEqual(enml.count(u'<pre>'), 2)
+        self.assertNotIn(TEXT_TRUNCATED_NOTICE, enml)
+        root = ElementTree.fromstring((u'<div>' + enml + u'</div>').encode('utf-8'))
+        self.assertEqual(u'\n'.join(pre.text for pre in root.iter('pre')), text)
+
+    def test_truncated_to_max_bytes(self):
+        ''' Text too large is cut at a whole line with a notice, within `max_bytes` in UTF-8 '''
+        text = u'\n'.join(u'中文 line {}'.format(i) for i in range(2000))
+        enml = build_text_block(u'notes.txt', text, 5000)
+        self.assertLessEqual(len(enml.encode('utf-8')), 5000)
+        self.assertTrue(enml.endswith(TEXT_TRUNCATED_NOTICE))
+        kept = ElementTree.fromstring((u'<div>' + enml + u'</div>').encode('utf-8')).find('pre').text
+        self.assertTrue(text.startswith(kept + u'\n'))
+
+    def test_invalid_xml_chars_removed(self):
+        ''' Control characters not allowed in XML are dropped '''
+        enml = build_text_block(u'a.txt', u'bell\x07 ok', 1000)
+        self.assertIn(u'<pre>bell ok</pre>', enml)
+
+    def test_no_room(self):
+        ''' Nothing is returned when not even the notice fits '''
+        self.assertEqual(build_text_block(u'a.txt', u'text', 10), '')
+
+
+class FakeResponse(object):
+    """ Raw gist streamed in the given chunks """
+    status_code = 200
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size):
+        return iter(self.chunks)
+
+
+class TestGistHash(unittest.TestCase):
+    """ Content hash of raw gists, without network access """
+
+    def setUp(self):
+        self.session = web.util.session
+
+    def tearDown(self):
+        web.util.session = self.session
+
+    def serve(self, chunks):
+        web.util.session = type('FakeSession', (object,), {'get': lambda _, url, **kwargs: FakeResponse(chunks)})()
+
+    def test_crlf_split_across_chunks(self):
+        ''' A CR ending a chunk and the LF starting the next one make a single LF '''
+        self.assertEqual(b''.join(canonical_chunks([b'a\r', b'\nb\r', b'\r\nc'])), b'a\nb\n\nc')
+
+    def test_trailing_cr(self):
+        ''' A CR ending the last chunk is a line ending too '''
+        self.assertEqual(b''.join(canonical_chunks([b'a\r\n', b'b\r'])), b'a\nb\n')
+        self.assertEqual(b''.join(canonical_chunks([b'a', b'\r', b''])), b'a\n')
+
+    def test_line_endings_do_not_change_hash(self):
+        ''' CRLF, CR and LF contents hash the same however they are chunked '''
+        self.serve([b'line 1\nline 2\n'])
+        _, lf_hash = match_gist_hash('user', 'gist')
+        self.serve([b'line 1\r', b'\nline 2\r'])
+        matched, crlf_hash = match_gist_hash('user', 'gist', lf_hash)
+        self.assertTrue(matched)
+        self.assertEqual(crlf_hash, lf_hash)
+        self.assertTrue(lf_hash.startswith(HASH_SCHEME + ':'))
+
+    def test_legacy_md5_migrates(self):
+        ''' An MD5 sum saved by older versions is matched and replaced by a hash in the current scheme '''
+        body = b'{"print": "hello"}'
+        self.serve([body[:5], body[5:]])
+        matched, new_hash = match_gist_hash('user', 'gist', generate_hexhash({u'print': u'hello'}))
+        self.assertTrue(matched)
+        self.assertTrue(new_hash.startswith(HASH_SCHEME + ':'))
+
+        self.assertEqual(match_gist_hash('user', 'gist', new_hash), (True, new_hash))
+        self.assertFalse(match_gist_hash('user', 'gist', generate_hexhash({u'print': u'bye'}))[0])
+
+    def test_sha256_without_blake2b(self):
+        ''' Python 2 without pyblake2 falls back to SHA-256 '''
+        saved = hashlib.__dict__.pop('blake2b', None), sys.modules.get('pyblake2')
+        sys.modules['pyblake2'] = None  # import fails
+        try:
+            util = imp.load_source('web_util_without_blake2b', web.util.__file__.replace('.pyc', '.py'))
+        finally:
+            if saved[0] is not None:
+                hashlib.blake2b = saved[0]
+            if saved[1] is None:
+                del sys.modules['pyblake2']
+            else:
+                sys.modules['pyblake2'] = saved[1]
+        self.assertEqual(util.HASH_SCHEME, 'sha256')
+        self.assertNotIn('blake2b', util.HASH_SCHEMES)
+
+        util.session = type('FakeSession', (object,), {'get': lambda _, url, **kwargs: FakeResponse([b'a\r\n'])})()
+        self.assertEqual(util.get_gist_hash('user', 'gist'), 'sha256:' + hashlib.sha256(b'a\n').hexdigest())
+
+
+def make_gist(gist_id, pushed_at='2018-01-15T00:48:23Z', files=()):
+    return {'id': gist_id, 'name': gist_id, 'description': '', 'pushedAt': pushed_at, 'files': list(files)}
+
+
+class TestPlan(unittest.TestCase):
+    """ Dry-run planning from the listing and the database only """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.directory, 'db.json'), os.path.join(self.directory, 'env.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_classify_gists(self):
+        ''' Listed gists are new, changed or unchanged, gists only in database are deleted '''
+        self.db.save_gist(make_gist('same'), 'guid-1', 'sha256:1', sync_time=False)
+        self.db.save_gist(make_gist('pushed'), 'guid-2', 'sha256:2', sync_time=False)
+        self.db.save_gist(make_gist('gone'), 'guid-3', 'sha256:3', sync_time=False)
+        actions = classify_gists(self.db, [make_gist('same'), make_gist('pushed', '2019-01-01T00:00:00Z'),
+                                           make_gist('fresh')])
+        self.assertEqual(dict((k, [g['id'] for g in v]) for k, v in actions.items()),
+                         {'new': ['fresh'], 'changed': ['pushed'], 'unchanged': ['same'], 'deleted': ['gone']})
+
+    def test_empty_listing_deletes_nothing(self):
+        ''' An empty listing is not taken as every gist being deleted '''
+        self.db.save_gist(make_gist('a'), 'guid', 'sha256:1', sync_time=False)
+        self.assertEqual(classify_gists(self.db, [])['deleted'], [])
+
+    def test_estimate_cost(self):
+        ''' Metrics of past runs are preferred, calibration over the default model '''
+        files = [{'size': 1024, 'language': {'name': 'Python'}}, {'size': 2048, 'language': None}]
+        render_seconds, upload_bytes = estimate_cost(self.db, make_gist('a', files=files))
+        self.assertGreater(render_seconds, RENDER_SECONDS_PER_GIST)
+        self.assertGreater(upload_bytes, 2 * UPLOAD_BYTES_PER_FILE)
+
+        calibration = {'seconds_per_byte': 0.001, 'upload_per_byte': 10.}
+        self.assertEqual(estimate_cost(self.db, make_gist('a', files=files), calibration),
+                         (round(RENDER_SECONDS_PER_GIST + 3.072, 1), 30720))
+
+        gist = make_gist('a', files=files)
+        gist.update({'render_seconds': 12.5, 'upload_bytes': 4000})
+        self.db.save_gist(gist, 'guid', 'sha256:1', sync_time=False)
+        self.assertEqual(estimate_cost(self.db, make_gist('a', files=files), calibration), (12.5, 4000))
+
+
+class TestDatabase(unittest.TestCase):
+    """ Gists and queues of gists kept in the database """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = Database(os.path.join(self.directory, 'db.json'), os.path.join(self.directory, 'env.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_returned_gists_are_copies(self):
+        ''' Changing a returned gist, e.g. while syncing it in a thread, leaves the queues untouched '''
+        self.db.add_retry(make_gist('a'), ValueError('boom'))
+        self.db.get_retry_gists(due_only=False)[0]['render_seconds'] = 0
+        self.assertNotIn('render_seconds', self.db.get_retry_gists(due_only=False)[0])
+
+        self.db.set_pending([make_gist('b')])
+        self.db.get_pending_gists()[0]['description'] = 'changed'
+        self.assertEqual(self.db.get_pending_gists()[0]['description'], '')
+
+    def test_render_seconds_kept_from_complete_renders(self):
+        ''' Syncs without a complete render do not replace the render time recorded before '''
+        gist = make_gist('a')
+        gist['render_seconds'] = 12.5
+        self.db.save_gist(gist, 'guid', 'sha256:1', sync_time=False)
+        self.db.update_gist(make_gist('a'), 'guid', 'sha256:2', sync_time=False)
+        self.assertEqual(self.db.get_render_seconds('a'), 12.5)
+        self.db.update_gist(dict(make_gist('a'), render_seconds=0), 'guid', 'sha256:3', sync_time=False)
+        self.assertEqual(self.db.get_render_seconds('a'), 12.5)
+        self.db.update_gist(dict(make_gist('a'), render_seconds=8.0), 'guid', 'sha256:4', sync_time=False)
+        self.assertEqual(self.db.get_render_seconds('a'), 8.0)
+
+
+class TestSearchIndex(unittest.TestCase):
+    """ Full-text index of synced gists, with FTS5 or FTS4 """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'index.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fill(self, index):
+        index.update_gist(make_gist('a'), 'guid-a', [(u'pandas_merge.py', u'import numpy'),
+                                                     (u'readme.md', u'how to merge with pandas')])
+        index.update_gist(make_gist('b'), None, [(u'notes.txt', u'pandas is slow to merge wide frames')])
+        index.update_gist(make_gist('c'), 'guid-c', [(u'c.py', u'print("nothing")')])
+
+    def check_search(self, index):
+        self.fill(index)
+        results = index.search(u'pandas merge')
+        self.assertEqual([r['gist_id'] for r in results], ['a', 'b'])
+        self.assertEqual(results[0]['note_url'], 'https://www.evernote.com/Home.action#n=guid-a')
+        self.assertIsNone(results[1]['note_url'])
+        self.assertEqual(results[1]['gist_url'], 'https://gist.github.com/b')
+        self.assertIn(u'[pandas]', results[1]['snippet'])
+
+        index.update_gist(make_gist('b'), None, [(u'notes.txt', u'polars')])
+        index.remove_gists(['a'])
+        self.assertEqual(index.search(u'pandas'), [])
+
+    def test_fts5(self):
+        ''' File names rank first, one result per gist, invalid queries fall back to words '''
+        index = SearchIndex(self.path)
+        self.assertTrue(index.fts5)
+        self.check_search(index)
+        # not a valid full-text query, searched as plain words
+        self.assertEqual([r['gist_id'] for r in index.search(u'nothing")')], ['c'])
+
+    def test_fts4_fallback(self):
+        ''' An index created without FTS5 is searched with FTS4, ranked by matched terms '''
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE VIRTUAL TABLE gist_files USING fts4("
+                     "gist_id, file_name, description, content, notindexed=gist_id)")
+        conn.close()
+        index = SearchIndex(self.path)
+        self.assertFalse(index.fts5)
+        self.check_search(index)
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+    """ AIMD concurrency limit, evaluated after every task and regardless of the host load """
+
+    def setUp(self):
+        self.host = concurrency.get_cpu_load, concurrency.get_free_memory
+        concurrency.get_cpu_load = concurrency.get_free_memory = lambda: None
+        self.directory = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.directory, 'concurrency.jsonl')
+
+    def tearDown(self):
+        concurrency.get_cpu_load, concurrency.get_free_memory = self.host
+        shutil.rmtree(self.directory)
+
+    def fail_task(self, limit, error):
+        try:
+            with limit.slot():
+                raise error
+        except type(error):
+            pass
+
+    def test_increase_when_saturated(self):
+        ''' The limit grows by one when all slots were busy, up to `max_limit` '''
+        limit = AdaptiveLimit('render', 3, initial=2, interval=0, log_file=self.log_file)
+        with limit.slot():
+            with limit.slot():
+                pass
+            self.assertEqual(limit.limit, 3)
+            with limit.slot():
+                with limit.slot():
+                    pass
+            self.assertEqual(limit.limit, 3)
+
+        with open(self.log_file) as fp:
+            record = json.loads(fp.readline())
+        self.assertEqual((record['decision'], record['reason'], record['previous'], record['limit']),
+                         ('increase', 'saturated', 2, 3))
+
+    def test_decrease_on_throttle_and_errors(self):
+        ''' The limit is halved on throttling or errors, down to `min_limit` '''
+        limit = AdaptiveLimit('upload', 8, min_limit=2, initial=8, interval=0, log_file=None,
+                              is_throttle=lambda e: isinstance(e, IOError))
+        self.fail_task(limit, IOError('rate limit'))
+        self.assertEqual(limit.limit, 4)
+        self.fail_task(limit, ValueError('boom'))
+        self.assertEqual(limit.limit, 2)
+        self.fail_task(limit, IOError('rate limit'))
+        self.assertEqual(limit.limit, 2)
+
+    def test_decrease_on_host_load(self):
+        ''' The limit is halved when the host is overloaded '''
+        concurrency.get_cpu_load = lambda: concurrency.MAX_CPU_LOAD + 1
+        limit = AdaptiveLimit('render', 8, initial=4, interval=0, log_file=None)
+        with limit.slot():
+            pass
+        self.assertEqual(limit.limit, 2)
+
+    def test_slot_waits(self):
+        ''' No more tasks than the limit run at once '''
+        limit = AdaptiveLimit('render', 1, interval=3600, log_file=None)
+        entered = threading.Event()
+
+        def task():
+            with limit.slot():
+                entered.set()
+
+        with limit.slot():
+            thread = threading.Thread(target=task)
+            thread.start()
+            self.assertFalse(entered.wait(0.2))
+        self.assertTrue(entered.wait(5))
+        thread.join()
+
+
+def rest_gist(name, updated_at, files=()):
+    return {'id': name, 'node_id': 'node-' + name, 'description': None, 'updated_at': updated_at,
+            'files': dict((f['filename'], f) for f in files)}
+
+
+class FakePages(object):
+    """ REST listing of gists served page by page """
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def get(self, url, params=None, **kwargs):
+        page = params['page']
+        last = 'https://api.github.com/gists?page={}&per_page=100'.format(len(self.pages))
+        return type('FakePage', (object,), {
+            'status_code': 200, 'text': '', 'links': {'last': {'url': last}},
+            'json': lambda _: self.pages[page - 1]})()
+
+
+class TestRestListing(unittest.TestCase):
+    """ Gists listed by parallel pages of the REST API, without network access """
+
+    def setUp(self):
+        self.session = github.util.session
+
+    def tearDown(self):
+        github.util.session = self.session
+
+    def test_normalize_rest_gist(self):
+        ''' REST gists take the format of the GraphQL listing, files sorted by name '''
+        gist = rest_gist('abc', '2018-01-15T00:48:23Z', [
+            {'filename': 'b.md', 'size': 20, 'language': 'Markdown'},
+            {'filename': 'a.txt', 'size': 10, 'language': None}])
+        self.assertEqual(normalize_rest_gist(gist), {
+            'id': 'node-abc', 'name': 'abc', 'description': None, 'pushedAt': '2018-01-15T00:48:23Z'})
+        self.assertEqual(normalize_rest_gist(gist, with_files=True)['files'], [
+            {'name': 'a.txt', 'size': 10, 'language': None},
+            {'name': 'b.md', 'size': 20, 'language': {'name': 'Markdown'}}])
+
+    def test_gists_moved_across_pages_are_deduplicated(self):
+        ''' A gist updated while paging is listed once, with its latest update time '''
+        github.util.session = FakePages([
+            [rest_gist('a', '2018-03-01T00:00:00Z'), rest_gist('b', '2018-02-01T00:00:00Z')],
+            [rest_gist('b', '2018-04-01T00:00:00Z'), rest_gist('c', '2018-01-01T00:00:00Z')],
+            [rest_gist('a', '2018-03-01T00:00:00Z'), rest_gist('d', '2017-12-01T00:00:00Z')],
+        ])
+        gists = get_all_gists_rest(token='token', workers=2)
+        self.assertEqual([(g['name'], g['pushedAt']) for g in gists], [
+            ('b', '2018-04-01T00:00:00Z'), ('a', '2018-03-01T00:00:00Z'),
+            ('c', '2018-01-01T00:00:00Z'), ('d', '2017-12-01T00:00:00Z')])
+
+        gists = get_all_gists_rest(after_date=datetime(2018, 1, 1), token='token')
+        self.assertEqual([g['name'] for g in gists], ['b', 'a'])
+
+
+def noise_png(width, height):
+    buf = BytesIO()
+    Image.frombytes('L', (width, height), os.urandom(width * height)).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+class TestPreflight(unittest.TestCase):
+    """ Notes fitted to Evernote limits before uploading, without network access """
+
+    def setUp(self):
+        self.gist = make_gist('abc')
+        self.tenant = type('FakeTenant', (object,), {'account_limits': {
+            'resource_bytes': 10 ** 6, 'note_bytes': 10 ** 7, 'upload_allowance': 10 ** 8}})()
+
+    def test_fit_image_splits_from_top_to_bottom(self):
+        ''' An image too large is split at full width into parts within the limit, or downscaled '''
+        data = noise_png(200, 1000)
+        parts = fit_image(data, 80000)
+        self.assertGreater(len(parts), 1)
+        images = [Image.open(BytesIO(part)) for part in parts]
+        self.assertTrue(all(len(part) <= 80000 for part in parts))
+        self.assertEqual(set(image.size[0] for image in images), {200})
+        self.assertEqual(sum(image.size[1] for image in images), 1000)
+
+        downscaled, = fit_image(data, 80000, split=False)
+        self.assertLessEqual(len(downscaled), 80000)
+        self.assertLess(Image.open(BytesIO(downscaled)).size[1], 1000)
+
+        small = noise_png(10, 10)
+        self.assertEqual(len(fit_image(small, 80000)), 1)
+
+    def test_resource_split_into_named_parts(self):
+        ''' A resource larger than allowed is split into parts grouped back by file name '''
+        self.tenant.account_limits['resource_bytes'] = 80000
+        resource, _ = build_resource(noise_png(200, 1000), file_name=u'big.py')
+        small, _ = build_resource(noise_png(10, 10), file_name=u'small.py')
+        fitted = preflight_note(self.tenant, self.gist, u'title', [resource, small])
+
+        names = [r.attributes.fileName for r in fitted]
+        self.assertEqual(names[-1], u'small.py')
+        self.assertEqual(names[0], u'big.py (1/{})'.format(len(fitted) - 1))
+        self.assertTrue(all(r.data.size <= 80000 for r in fitted))
+
+        parts = group_resource_parts(fitted)
+        self.assertEqual(parts[u'big.py'], fitted[:-1])
+        self.assertEqual(parts[u'small.py'], [small])
+        # a file missing a part is rendered again
+        self.assertNotIn(u'big.py', group_resource_parts(fitted[1:]))
+
+    def test_note_size_budget(self):
+        ''' Rendered resources are downscaled evenly to fit the note, kept resources are left as they are '''
+        kept = ttypes.Resource(mime='image/png', data=ttypes.Data(size=100000, bodyHash='0' * 32),
+                               attributes=ttypes.ResourceAttributes(fileName=u'kept.py'))
+        rendered = [build_resource(noise_png(200, 500), file_name=u'{}.py'.format(i))[0] for i in range(2)]
+        self.tenant.account_limits['note_bytes'] = 250000
+        fitted = preflight_note(self.tenant, self.gist, u'title', [kept] + rendered)
+        self.assertIs(fitted[0], kept)
+        self.assertEqual([r.attributes.fileName for r in fitted[1:]], [u'0.py', u'1.py'])
+        self.assertLessEqual(sum(r.data.size for r in fitted), 250000)
+
+        self.tenant.account_limits['note_bytes'] = 90000
+        self.assertRaises(AssertionError, preflight_note, self.tenant, self.gist, u'title', [kept] + rendered)
+
+    def test_resource_count_and_allowance(self):
+        ''' Notes with too many resources or beyond the upload allowance are refused '''
+        data = noise_png(2, 2)
+        resources = [build_resource(data, file_name=u'{}.py'.format(i))[0] for i in range(EDAM_NOTE_RESOURCES_MAX)]
+        self.assertEqual(len(preflight_note(self.tenant, self.gist, u'title', resources)), EDAM_NOTE_RESOURCES_MAX)
+        resources.append(build_resource(data, file_name=u'extra.py')[0])
+        self.assertRaises(AssertionError, preflight_note, self.tenant, self.gist, u'title', resources)
+
+        self.tenant.account_limits['upload_allowance'] = 100
+        self.assertRaises(AssertionError, preflight_note, self.tenant, self.gist, u'title', resources[:1])
+
+
+if __name__ == '__main__':
+    unittest.main()
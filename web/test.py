@@ -29,6 +29,17 @@ class Test(unittest.TestCase):
         time.sleep(5)
         util.fullpage_screenshot(self.driver, "test.png")
 
+    def test_stabilized_captures_are_identical(self):
+        ''' Capture the same gist twice and compare image hashes '''
+        url = "https://gist.github.com/leemengtaiwan/e393d881222885f59ef09a14117159c8"
+        hexhashes = []
+        for i in range(2):
+            self.driver.get(url)
+            time.sleep(5)
+            util.stabilize_page(self.driver)
+            hexhashes.append(util.encode_image(util.capture_fullpage(self.driver, "test_{}.png".format(i)))['hexhash'])
+        self.assertEqual(hexhashes[0], hexhashes[1])
+
 
 if __name__ == "__main__":
     unittest.main(argv=[sys.argv[0]])
\ No newline at end of file
@@ -1,13 +1,69 @@
+import io
 import os
-import re
+import json
+import math
+import errno
+import shutil
 import time
+import uuid
 import fire
 import hashlib
 import requests
+import threading
+import multiprocessing
+from contextlib import contextmanager
 from PIL import Image
 
 GIST_BASE_URL = 'https://gist.github.com'
 DRIVER_WIDTH, DRIVER_HEIGHT = 1200, 1373
+CAPTURE_MARGIN = 8  # pixels kept around the captured element
+PAGE_LOAD_SECONDS = 30
+REQUEST_TIMEOUT = 60  # seconds to wait for Github to connect or send data
+PROFILE_MAX_AGE_DAYS = 7
+PROFILE_STAMP = 'gist-evernote-created'
+LOCK_BREAK_SECONDS = 60  # a lock breaker left longer than that was killed while breaking
+STABILIZE_SECONDS = 10
+
+# page styles and elements changing between two loads of the same gist, see `stabilize_page`
+STABLE_STYLE = """
+*, *::before, *::after {
+    animation: none !important; transition: none !important; caret-color: transparent !important;
+}
+::-webkit-scrollbar { display: none; }
+body { font-family: "DejaVu Sans", Arial, sans-serif !important; }
+pre, code, tt, .blob-code, .blob-code-inner, .blob-num { font-family: "DejaVu Sans Mono", monospace !important; }
+"""
+VOLATILE_SELECTORS = ['.avatar', '.avatar-user', '.social-count', '.Counter', '.flash', '.js-notification-shelf']
+
+# device scale factor by Github language of the file, prose stays readable
+# at lower resolution while plots of notebooks need more pixels
+DEFAULT_DEVICE_SCALE = 1.0
+DEVICE_SCALES = {
+    'Markdown': 0.75,
+    'Text': 0.75,
+    'reStructuredText': 0.75,
+    'Jupyter Notebook': 1.5,
+}
+
+# content hash schemes, hashes are saved as "<scheme>:<hex digest>" to allow changing the scheme
+# without invalidating saved hashes. Hashes without prefix are MD5 sums of `generate_hexhash`.
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+HASH_SCHEMES = {'sha256': hashlib.sha256}
+if blake2b is not None:
+    HASH_SCHEMES['blake2b'] = lambda: blake2b(digest_size=20)
+HASH_SCHEME = 'blake2b' if blake2b is not None else 'sha256'
+LEGACY_HASH_SCHEME = 'md5'
+HASH_CHUNK_SIZE = 64 * 1024
+
+session = requests.Session()  # keep connections to Github alive across requests
+_encode_pool = None  # see `get_encode_pool`
+_encode_pool_lock = threading.Lock()
 
 def generate_hexhash(content):
     """Generate string representation of MD5 sum of given data
@@ -30,7 +86,7 @@ def generate_hexhash(content):
 
 
 def get_gist_hash(github_user, gist_name):
-    """Acquire the raw content of the given `gist_name` and return string repr of the MD5 sum.
+    """Acquire the raw content of the given `gist_name` and return its hash in current `HASH_SCHEME`.
 
     Parameters
     ----------
@@ -43,22 +99,97 @@ def get_gist_hash(github_user, gist_name):
     Returns
     -------
     hash: str
+        e.g. "blake2b:9f86d081884c7d659a2feaa0c55ad015a3bf4f1b"
 
     """
-    # TODO update example for gist_name
+    return match_gist_hash(github_user, gist_name)[1]
+
+
+def match_gist_hash(github_user, gist_name, prev_hash=None):
+    """Check whether the raw content of the gist still matches `prev_hash`.
+
+    The content is streamed into the digest chunk by chunk with line endings
+    normalized to LF. `prev_hash` in another scheme is computed in the same
+    pass, so that hashes saved in an older scheme can be compared and replaced
+    without rendering the gist again.
+
+    Parameters
+    ----------
+    github_user : str
+        String representing valid Github account. e.g. "leemengtaiwan"
+
+    gist_name : str
+        Valid gist identifier appear in url
+
+    prev_hash : str, optional
+        Hash saved in last synchronization in any scheme, including
+        MD5 sums without scheme prefix saved by older versions
+
+    Returns
+    -------
+    matched : bool
+        Whether `prev_hash` matches current content
+
+    hash : str
+        Hash of current content in `HASH_SCHEME`
+
+    """
+    prev_scheme = None
+    if prev_hash:
+        prev_scheme = prev_hash.split(':', 1)[0] if ':' in prev_hash else LEGACY_HASH_SCHEME
+    digests = {HASH_SCHEME: HASH_SCHEMES[HASH_SCHEME]()}
+    if prev_scheme in HASH_SCHEMES:
+        digests.setdefault(prev_scheme, HASH_SCHEMES[prev_scheme]())
+    body = [] if prev_scheme == LEGACY_HASH_SCHEME else None
 
     gist_raw_url = '/'.join((GIST_BASE_URL, github_user, gist_name, 'raw'))
-    res = requests.request(
-        method='GET',
-        url=gist_raw_url
-    )
+    res = session.get(gist_raw_url, stream=True, timeout=REQUEST_TIMEOUT)
     assert res.status_code == requests.codes.ok, "Problem occurred when requesting raw gist."
-    try:
-        data = res.json()
-    except ValueError:
-        data = res.content
+    def raw_chunks():
+        for chunk in res.iter_content(HASH_CHUNK_SIZE):
+            # older scheme hashed the content as is
+            if body is not None:
+                body.append(chunk)
+            yield chunk
+
+    for chunk in canonical_chunks(raw_chunks()):
+        for digest in digests.values():
+            digest.update(chunk)
 
-    return generate_hexhash(data)
+    hashes = dict((scheme, '{}:{}'.format(scheme, d.hexdigest())) for scheme, d in digests.items())
+    if body is not None:
+        body = b''.join(body)
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = body
+        hashes[LEGACY_HASH_SCHEME] = generate_hexhash(data)
+
+    return prev_hash is not None and hashes.get(prev_scheme) == prev_hash, hashes[HASH_SCHEME]
+
+
+def canonical_chunks(chunks):
+    """Normalize CRLF and CR line endings in a stream of bytes to LF
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+
+    Returns
+    -------
+    generator of bytes
+
+    """
+    carry = b''
+    for chunk in chunks:
+        chunk = carry + chunk
+        # a CR at the end may be followed by LF in the next chunk
+        carry = b'\r' if chunk.endswith(b'\r') else b''
+        if carry:
+            chunk = chunk[:-1]
+        yield chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    if carry:
+        yield b'\n'
 
 
 def fullpage_screenshot(driver, file):
@@ -75,13 +206,34 @@ def fullpage_screenshot(driver, file):
     -------
     bool
 
+    """
+    encode_image(capture_fullpage(driver, file))
+    return True
+
+
+def capture_fullpage(driver, file):
+    """Take multiple screenshots of already-opened webpage, leave concatenating to `encode_image`
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+        The current active web driver staying in the page to take screenshots
+    file : str
+        The file path to save concatenated image
+
+    Returns
+    -------
+    job : dict
+        Partial images and their offsets to be passed to `encode_image`
+
     Notes
     -----
     Generate Fullpage Screenshot in Chrome
         http://seleniumpythonqa.blogspot.jp/2015/08/generate-full-page-screenshot-in-chrome.html
 
     """
-    image_id = re.findall(r'/([0-9a-zA-Z]+).', file)[0]
+    # keep partial images next to `file` so that concurrent captures never collide
+    image_id = os.path.splitext(file)[0]
 
 
     print("Starting chrome full page screenshot workaround ...")
@@ -142,23 +294,364 @@ def fullpage_screenshot(driver, file):
         part = part + 1
         previous = rectangle
 
-    # concatenate all partial images
+    return {'file': file, 'screenshots': screenshots, 'size': (total_width, total_height)}
+
+
+def encode_image(job):
+    """Concatenate partial images of a capture job, save it as PNG and compute its MD5 sum
+
+    Decoding, concatenating and PNG encoding are CPU bound, so this function
+    is suitable to run in a process of `get_encode_pool` while the web driver
+    moves on. Only file names cross the process boundary, not pixels.
+
+    Parameters
+    ----------
+    job : dict
+        Job returned by `capture_fullpage` or `capture_fitted`
+
+    Returns
+    -------
+    result : dict
+        {'file': file, 'hexhash': MD5 sum of the PNG file, 'size': bytes of the PNG file}
+
+    """
+    total_width, total_height = job['size']
     print(total_width, total_height)
     stitched_image = Image.new('RGB', (total_width, total_height))
 
-    for screenshot in screenshots:
+    for screenshot in job['screenshots']:
         file_name, offset = screenshot['file_name'], screenshot['offset']
         print("Adding to stitched image with offset ({0}, {1})".format(offset[0], offset[1]))
         image = Image.open(file_name)
         stitched_image.paste(image, offset)
         os.remove(file_name)
 
-    stitched_image.save(file)
+    if job.get('box'):
+        stitched_image = stitched_image.crop(job['box'])
+    if job.get('resize'):
+        stitched_image = stitched_image.resize(job['resize'], Image.LANCZOS)
+
+    stitched_image.save(job['file'])
     print("Finishing chrome full page screenshot workaround...")
-    return True
 
+    md5 = hashlib.md5()
+    with open(job['file'], 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return {'file': job['file'], 'hexhash': md5.hexdigest(), 'size': os.path.getsize(job['file'])}
 
-def create_chrome_driver(mode="headless", width=DRIVER_WIDTH, height=DRIVER_HEIGHT):
+
+def fit_image(data, max_bytes, split=True):
+    """Re-encode PNG `data` into images of at most `max_bytes` each, e.g. to fit Evernote limits.
+
+    Less destructive ways are tried first: lossless optimization, reducing
+    to 256 colors, which screenshots of code hardly suffer from, splitting
+    into parts from top to bottom at full resolution, and then downscaling.
+
+    Parameters
+    ----------
+    data : bytes
+        PNG file content
+
+    max_bytes : int
+
+    split : bool, optional
+        Whether the image may be split into several parts
+
+    Returns
+    -------
+    parts : list of bytes
+        PNG file content of each part, from top to bottom
+
+    """
+    def encode(img):
+        buf = io.BytesIO()
+        img.save(buf, 'PNG', optimize=True)
+        return buf.getvalue()
+
+    image = Image.open(io.BytesIO(bytes(data)))
+    image.load()
+    encoded = encode(image)
+    if len(encoded) <= max_bytes:
+        return [encoded]
+
+    image = image.convert('RGB').quantize(256)
+    encoded = encode(image)
+    if len(encoded) <= max_bytes:
+        return [encoded]
+
+    width, height = image.size
+    if split:
+        # one more part than needed on average, content is not evenly spread
+        step = int(math.ceil(height / (math.ceil(len(encoded) / float(max_bytes)) + 1)))
+        parts = [encode(image.crop((0, top, width, min(height, top + step)))) for top in range(0, height, step)]
+        if all(len(p) <= max_bytes for p in parts):
+            return parts
+
+    scale = math.sqrt(max_bytes / float(len(encoded)))
+    while len(encoded) > max_bytes and scale > 0.05:
+        scale *= 0.9
+        size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        encoded = encode(image.convert('RGB').resize(size, Image.LANCZOS).quantize(256))
+    assert len(encoded) <= max_bytes, 'Cannot fit image of {} bytes into {} bytes'.format(len(data), max_bytes)
+    return [encoded]
+
+
+def get_encode_pool(processes=None):
+    """Return the process pool shared by all threads for `encode_image`, create it on first call
+
+    Parameters
+    ----------
+    processes : int, optional
+        Number of processes. Default to number of CPUs minus one for the browsers.
+
+    Returns
+    -------
+    pool : multiprocessing.Pool
+
+    """
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is None:
+            _encode_pool = multiprocessing.Pool(processes or max(1, multiprocessing.cpu_count() - 1))
+        return _encode_pool
+
+
+def reset_encode_pool(pool):
+    """Terminate `pool` if it is still the one of `get_encode_pool`, the next call creates a new one
+
+    Called when an encoding does not finish in time, its process may be stuck
+    and would otherwise hold a slot of the pool forever.
+
+    Parameters
+    ----------
+    pool : multiprocessing.Pool
+        The pool the encoding was submitted to, left alone if already replaced
+
+    """
+    global _encode_pool
+    with _encode_pool_lock:
+        if _encode_pool is not pool:
+            return
+        _encode_pool = None
+    pool.terminate()
+
+
+def get_gist_file_names(driver):
+    """Return names of files shown on the opened gist page in order
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+        The web driver staying in the gist page
+
+    Returns
+    -------
+    file_names : list of str
+
+    """
+    return driver.execute_script(
+        "return Array.prototype.map.call(document.querySelectorAll('.file .gist-blob-name'),"
+        " function (e) { return e.textContent.trim(); });")
+
+
+def isolate_gist_file(driver, file_name):
+    """Hide all files of the opened gist page except `file_name`, so that it can be captured alone
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+        The web driver staying in the gist page
+
+    file_name : str
+
+    Returns
+    -------
+    bool
+        False if no file named `file_name` is on the page.
+        Otherwise the file can be selected by `.gist-evernote-capture`.
+
+    """
+    return driver.execute_script("""
+        var target = arguments[0], found = false;
+        Array.prototype.forEach.call(document.querySelectorAll('.file'), function (f) {
+            var name = f.querySelector('.gist-blob-name');
+            var match = name !== null && name.textContent.trim() === target;
+            f.style.display = match ? '' : 'none';
+            f.classList.toggle('gist-evernote-capture', match);
+            found = found || match;
+        });
+        window.scrollTo(0, 0);
+        return found;
+    """, file_name)
+
+
+def capture_fitted(driver, file, selector, scale=DEFAULT_DEVICE_SCALE):
+    """Capture only the element matching `selector`, leave clipping and concatenating to `encode_image`
+
+    The window is narrowed to the element before capturing, so that empty
+    margins of the page are neither captured nor stitched, and the result is
+    clipped to the bounding box of the element.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+        The current active web driver staying in the page to take screenshots
+
+    file : str
+        The file path to save the captured image
+
+    selector : str
+        CSS selector of the content element
+
+    scale : float, optional
+        Device scale factor, i.e. image pixels per CSS pixel.
+        Chrome renders at this scale if the driver supports DevTools commands,
+        otherwise the captured image is only downscaled to it, as upscaling
+        would add pixels and upload bytes without any detail.
+
+    Returns
+    -------
+    job : dict
+        Partial images, clip box and size to be passed to `encode_image`
+
+    """
+    measure = """
+        var r = document.querySelector(arguments[0]).getBoundingClientRect();
+        return {left: r.left + window.pageXOffset, top: r.top + window.pageYOffset,
+                width: r.width, height: r.height, ratio: window.devicePixelRatio,
+                chrome: window.outerWidth - window.innerWidth};
+    """
+    window_size = driver.get_window_size()
+    rect = driver.execute_script(measure, selector)
+    driver.set_window_size(int(rect['width'] + 2 * CAPTURE_MARGIN + rect['chrome']) + 1, window_size['height'])
+
+    # let Chrome render at the target scale instead of resizing afterward
+    emulated = hasattr(driver, 'execute_cdp_cmd')
+    if emulated:
+        driver.execute_cdp_cmd('Emulation.setDeviceMetricsOverride', {
+            'width': 0, 'height': 0, 'deviceScaleFactor': scale, 'mobile': False})
+    try:
+        # layout changes with the window, measure again
+        rect = driver.execute_script(measure, selector)
+        job = capture_fullpage(driver, file)
+    finally:
+        if emulated:
+            driver.execute_cdp_cmd('Emulation.clearDeviceMetricsOverride', {})
+        driver.set_window_size(window_size['width'], window_size['height'])
+
+    ratio = rect['ratio']
+    if not emulated:
+        scale = min(scale, ratio)
+    width, height = job['size']
+    box = (max(0, int((rect['left'] - CAPTURE_MARGIN) * ratio)),
+           max(0, int((rect['top'] - CAPTURE_MARGIN) * ratio)),
+           min(width, int((rect['left'] + rect['width'] + CAPTURE_MARGIN) * ratio)),
+           min(height, int((rect['top'] + rect['height'] + CAPTURE_MARGIN) * ratio)))
+    job['box'] = box
+    if abs(scale - ratio) > 1e-3:
+        job['resize'] = (max(1, int((box[2] - box[0]) * scale / ratio)),
+                         max(1, int((box[3] - box[1]) * scale / ratio)))
+    return job
+
+
+def capture_preview(driver, file, selector):
+    """Capture the first screenful of the element matching `selector`, leave clipping to `encode_image`
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+        The current active web driver staying in the page to take screenshots
+
+    file : str
+        The file path to save the captured image
+
+    selector : str
+        CSS selector of the content element
+
+    Returns
+    -------
+    job : dict
+        The screenshot and clip box to be passed to `encode_image`
+
+    """
+    rect = driver.execute_script("""
+        var e = document.querySelector(arguments[0]);
+        e.scrollIntoView(true);
+        var r = e.getBoundingClientRect();
+        return {left: r.left, top: r.top, width: r.width, height: r.height,
+                ratio: window.devicePixelRatio, viewport: window.innerHeight};
+    """, selector)
+    tile = '{}_preview.png'.format(os.path.splitext(file)[0])
+    driver.get_screenshot_as_file(tile)
+    width, height = Image.open(tile).size
+
+    ratio = rect['ratio']
+    box = (max(0, int(rect['left'] * ratio)),
+           max(0, int(rect['top'] * ratio)),
+           min(width, int((rect['left'] + rect['width']) * ratio)),
+           min(height, int(min(rect['top'] + rect['height'], rect['viewport']) * ratio)))
+    return {'file': file, 'screenshots': [{'file_name': tile, 'offset': (0, 0)}],
+            'size': (width, height), 'box': box}
+
+
+def stabilize_page(driver):
+    """Make the opened page render the same pixels on every load of unchanged content
+
+    Animations, transitions and the caret are disabled, fonts are pinned,
+    relative timestamps like "updated 3 minutes ago" are frozen to their date,
+    volatile elements like avatars and star counts are masked, and the
+    function waits until web fonts are loaded.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+        The web driver staying in the page to capture
+
+    """
+    from selenium.common.exceptions import TimeoutException
+    driver.execute_script("""
+        var style = document.getElementById('gist-evernote-stable');
+        if (style === null) {
+            style = document.createElement('style');
+            style.id = 'gist-evernote-stable';
+            style.textContent = arguments[0];
+            document.head.appendChild(style);
+        }
+        Array.prototype.forEach.call(
+            document.querySelectorAll('relative-time, time-ago, local-time, time[datetime]'), function (e) {
+                var frozen = document.createElement('span');
+                frozen.textContent = (e.getAttribute('datetime') || '').slice(0, 10);
+                e.parentNode.replaceChild(frozen, e);
+            });
+        Array.prototype.forEach.call(document.querySelectorAll(arguments[1]), function (e) {
+            e.style.visibility = 'hidden';
+        });
+        if (document.getAnimations) {
+            document.getAnimations().forEach(function (a) { a.cancel(); });
+        }
+        if (document.activeElement && document.activeElement.blur) {
+            document.activeElement.blur();
+        }
+        window.getSelection().removeAllRanges();
+    """, STABLE_STYLE, ', '.join(VOLATILE_SELECTORS))
+
+    # wait for fonts and two frames, so that layout settled before capturing
+    driver.set_script_timeout(STABILIZE_SECONDS)
+    try:
+        driver.execute_async_script("""
+            var done = arguments[arguments.length - 1];
+            var fonts = document.fonts ? document.fonts.ready : Promise.resolve();
+            fonts.then(function () {
+                requestAnimationFrame(function () { requestAnimationFrame(function () { done(true); }); });
+            });
+        """)
+    except TimeoutException:
+        print("Take longer than {} seconds to stabilize page.".format(STABILIZE_SECONDS))
+
+
+def create_chrome_driver(mode="headless", width=DRIVER_WIDTH, height=DRIVER_HEIGHT, profile_dir=None,
+                         cache_bytes=None, deterministic=False, page_load_seconds=PAGE_LOAD_SECONDS):
     """Create a headless/visible Chrome driver.
 
     Parameters
@@ -173,6 +666,22 @@ def create_chrome_driver(mode="headless", width=DRIVER_WIDTH, height=DRIVER_HEIG
     height : int, optional
         Height of the web driver window
 
+    profile_dir : str, optional
+        User data directory kept across runs, so that Github's CSS, scripts and
+        fonts are loaded from the HTTP cache. A throwaway profile by default.
+        Must not be used by another Chrome, see `lock_profile`.
+
+    cache_bytes : int, optional
+        Maximum size of the HTTP cache
+
+    deterministic : bool, optional
+        Render text and colors the same way on every machine, e.g. without
+        subpixel antialiasing, use with `stabilize_page` to capture the
+        same pixels for the same content
+
+    page_load_seconds : int, optional
+        Raise TimeoutException if loading a page takes longer
+
     Returns
     -------
     driver
@@ -183,11 +692,375 @@ def create_chrome_driver(mode="headless", width=DRIVER_WIDTH, height=DRIVER_HEIG
         options.add_argument("headless")
     else:
         pass
+    if profile_dir:
+        options.add_argument("user-data-dir={}".format(os.path.abspath(profile_dir)))
+    if cache_bytes:
+        options.add_argument("disk-cache-size={}".format(int(cache_bytes)))
+    if deterministic:
+        for argument in ("font-render-hinting=none", "disable-lcd-text", "disable-font-subpixel-positioning",
+                         "force-color-profile=srgb", "hide-scrollbars", "force-prefers-reduced-motion"):
+            options.add_argument(argument)
     driver = webdriver.Chrome(chrome_options=options)
+    driver.set_page_load_timeout(page_load_seconds)
     driver.get('https://github.com/')
     driver.set_window_size(width, height)
     return driver
 
 
+def lock_profile(profile_root, max_age_days=PROFILE_MAX_AGE_DAYS):
+    """Lock a Chrome profile directory under `profile_root` not used by any other driver.
+
+    Profiles are numbered slots `profile_root/0`, `profile_root/1`, ... reused
+    across runs, so each driver of a pool keeps its own warm HTTP cache.
+    A new slot starts from a copy of the cache of slot 0. A profile older than
+    `max_age_days` is removed and started afresh, so that the cache never
+    serves long outdated assets nor grows stale entries forever.
+
+    Parameters
+    ----------
+    profile_root : str
+
+    max_age_days : float, optional
+
+    Returns
+    -------
+    profile_dir : str
+        Pass it to `create_chrome_driver`, and to `unlock_profile` once the driver quit
+
+    """
+    if not os.path.isdir(profile_root):
+        os.makedirs(profile_root)
+
+    slot = 0
+    while True:
+        profile_dir = os.path.join(profile_root, str(slot))
+        lock_file = profile_dir + '.lock'
+        try:
+            _create_lock(lock_file)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not _break_stale_lock(lock_file):
+                slot += 1
+            continue
+        break
+
+    # bust the whole cache once it gets old
+    stamp_file = os.path.join(profile_dir, PROFILE_STAMP)
+    if os.path.isdir(profile_dir) and _profile_age_days(stamp_file) > max_age_days:
+        print("Chrome profile {} expired, start afresh".format(profile_dir))
+        shutil.rmtree(profile_dir, ignore_errors=True)
+
+    if not os.path.isdir(profile_dir):
+        seed_cache = os.path.join(profile_root, '0', 'Default', 'Cache')
+        if slot > 0 and os.path.isdir(seed_cache) and \
+                _profile_age_days(os.path.join(profile_root, '0', PROFILE_STAMP)) <= max_age_days:
+            try:
+                shutil.copytree(seed_cache, os.path.join(profile_dir, 'Default', 'Cache'))
+            except shutil.Error:
+                # cache files changed while copying, Chrome drops broken entries
+                pass
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        with open(stamp_file, 'w') as fp:
+            fp.write(str(time.time()))
+    return profile_dir
+
+
+def unlock_profile(profile_dir):
+    """Release a profile directory locked by `lock_profile`"""
+    try:
+        os.remove(profile_dir + '.lock')
+    except OSError:
+        pass
+
+
+def _create_lock(lock_file):
+    """Create `lock_file` holding the pid of current process, raise OSError with EEXIST if it exists
+
+    The pid is written to a temporary file linked to the lock name, so that
+    the lock is never seen empty, which would be taken for a stale lock.
+    """
+    tmp_file = '{}.{}.{}'.format(lock_file, os.getpid(), uuid.uuid4().hex)
+    with open(tmp_file, 'w') as fp:
+        fp.write(str(os.getpid()))
+    try:
+        os.link(tmp_file, lock_file)
+    finally:
+        os.remove(tmp_file)
+
+
+def _break_stale_lock(lock_file):
+    """Remove `lock_file` if the process holding it is gone, return whether it was removed
+
+    Breaking is guarded by another lock and staleness is checked again
+    under it, so that a lock just taken by someone else is never removed.
+    """
+    breaker = lock_file + '.break'
+    try:
+        fd = os.open(breaker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        try:
+            if time.time() - os.path.getmtime(breaker) > LOCK_BREAK_SECONDS:
+                os.remove(breaker)
+        except OSError:
+            pass
+        return False
+    os.close(fd)
+    try:
+        if not _is_stale_lock(lock_file):
+            return False
+        try:
+            os.remove(lock_file)
+        except OSError:
+            pass
+        return True
+    finally:
+        os.remove(breaker)
+
+
+def _is_stale_lock(lock_file):
+    """Whether the process holding `lock_file` is gone"""
+    try:
+        with open(lock_file, 'r') as fp:
+            pid = int(fp.read().strip() or 0)
+        if pid <= 0:
+            return True
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError) as e:
+        return getattr(e, 'errno', None) != errno.EPERM
+    return False
+
+
+def _profile_age_days(stamp_file):
+    """Days since the profile of `stamp_file` was created"""
+    try:
+        with open(stamp_file, 'r') as fp:
+            created = float(fp.read().strip())
+    except (IOError, ValueError):
+        return float('inf')
+    return (time.time() - created) / 86400.
+
+
+class Tab(object):
+    """A tab of a Chrome driver, used like the driver itself.
+
+    Tabs of the same driver share a lock: every command switches to its own
+    tab first, so that threads using different tabs do not interfere.
+    `get` does not hold the driver while the page loads, so that pages of
+    several tabs load at the same time.
+
+    Parameters
+    ----------
+    driver : selenium.webdriver
+
+    handle : str
+        Window handle of the tab
+
+    lock : threading.RLock
+        Lock shared by tabs of `driver`, hold it to run a sequence of
+        commands exclusively, e.g. resizing the window and capturing
+
+    page_load_seconds : int, optional
+        Default timeout of `get`
+
+    """
+
+    def __init__(self, driver, handle, lock, page_load_seconds=PAGE_LOAD_SECONDS):
+        self.driver = driver
+        self.handle = handle
+        self.lock = lock
+        self.page_load_seconds = page_load_seconds
+
+    def _switch(self):
+        if getattr(self.driver, '_gist_evernote_handle', None) != self.handle:
+            self.driver.switch_to.window(self.handle)
+            self.driver._gist_evernote_handle = self.handle
+
+    def __getattr__(self, name):
+        with self.lock:
+            self._switch()
+            attr = getattr(self.driver, name)
+        if not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            with self.lock:
+                self._switch()
+                return attr(*args, **kwargs)
+        return command
+
+    def get(self, url, timeout=None):
+        """Load `url` in this tab, leave the driver to other tabs while waiting
+
+        Raise TimeoutException like a driver if the page is not loaded within
+        `timeout` seconds, `page_load_seconds` by default.
+        """
+        from selenium.common.exceptions import WebDriverException, TimeoutException
+        timeout = timeout or self.page_load_seconds
+        with self.lock:
+            self._switch()
+            # mark the current document to tell when the new one is ready
+            self.driver.execute_script(
+                "document.documentElement.setAttribute('data-gist-evernote-stale', '');"
+                "window.location.href = arguments[0];", url)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(.1)
+            try:
+                with self.lock:
+                    self._switch()
+                    ready = self.driver.execute_script(
+                        "return !document.documentElement.hasAttribute('data-gist-evernote-stale')"
+                        " && document.readyState === 'complete';")
+            except WebDriverException:
+                # document is being replaced
+                continue
+            if ready:
+                return
+        raise TimeoutException("Take longer than {} seconds to load {}.".format(timeout, url))
+
+
+@contextmanager
+def exclusive(driver):
+    """Context manager holding the browser of `driver` for a sequence of commands
+
+    Other tabs of the same browser wait meanwhile, nothing happens for a plain driver.
+    """
+    lock = getattr(driver, 'lock', None) if isinstance(driver, Tab) else None
+    if lock is None:
+        yield
+        return
+    with lock:
+        yield
+
+
+class DriverPool(object):
+    """Chrome drivers shared by worker threads.
+
+    At most `size` drivers are created, each on first demand. Each driver
+    opens `tabs` tabs, and a tab is lent to one thread at a time and kept
+    warm for later use when returned. More tabs let page loads overlap
+    at the cost of far less memory than more drivers.
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of Chrome drivers
+
+    tabs : int, optional
+        Number of tabs of each driver
+
+    profile_root : str, optional
+        Directory of Chrome profiles kept across runs, each driver locks
+        its own profile under it. Throwaway profiles by default.
+
+    driver_kwargs : dict
+        Keyword arguments passed to `create_chrome_driver`
+
+    """
+
+    def __init__(self, size=1, tabs=1, profile_root=None, **driver_kwargs):
+        self.size = size
+        self.tabs = tabs
+        self.profile_root = profile_root
+        self.driver_kwargs = driver_kwargs
+        self._profiles = {}  # driver -> locked profile directory
+        self._idle = []
+        self._num_drivers = 0
+        self._all = []
+        self._cond = threading.Condition()
+
+    @property
+    def capacity(self):
+        """Number of threads able to render at the same time"""
+        return self.size * self.tabs
+
+    def acquire(self):
+        """Borrow a tab, wait until one is returned if all are in use"""
+        with self._cond:
+            while not self._idle and self._num_drivers >= self.size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._num_drivers += 1
+
+        profile_dir = None
+        try:
+            if self.profile_root:
+                profile_dir = lock_profile(self.profile_root)
+            driver = create_chrome_driver(profile_dir=profile_dir, **self.driver_kwargs)
+            for _ in range(self.tabs - 1):
+                driver.execute_script("window.open('about:blank');")
+            lock = threading.RLock()
+            page_load_seconds = self.driver_kwargs.get('page_load_seconds', PAGE_LOAD_SECONDS)
+            tabs = [Tab(driver, handle, lock, page_load_seconds) for handle in driver.window_handles]
+        except Exception:
+            if profile_dir:
+                unlock_profile(profile_dir)
+            self._discard_driver(None)
+            raise
+        with self._cond:
+            self._profiles[driver] = profile_dir
+            self._all.append(driver)
+            self._idle.extend(tabs[1:])
+            self._cond.notify_all()
+        return tabs[0]
+
+    def release(self, tab):
+        """Return a borrowed tab to the pool"""
+        with self._cond:
+            # the driver may be discarded by a thread using another tab
+            if tab.driver in self._all:
+                self._idle.append(tab)
+            self._cond.notify()
+
+    def discard(self, tab):
+        """Quit the driver of a borrowed tab, e.g. a crashed one, so that a new one will be created"""
+        self._discard_driver(tab.driver)
+
+    def _discard_driver(self, driver):
+        with self._cond:
+            if driver is None or driver in self._all:
+                self._num_drivers -= 1
+            if driver in self._all:
+                self._all.remove(driver)
+            self._idle = [t for t in self._idle if t.driver is not driver]
+            self._cond.notify_all()
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+            self._unlock_profile_of(driver)
+
+    def _unlock_profile_of(self, driver):
+        with self._cond:
+            profile_dir = self._profiles.pop(driver, None)
+        if profile_dir:
+            unlock_profile(profile_dir)
+
+    @contextmanager
+    def driver(self):
+        """Context manager borrowing a tab and returning it afterward"""
+        tab = self.acquire()
+        try:
+            yield tab
+        finally:
+            self.release(tab)
+
+    def quit(self):
+        """Quit all drivers created by the pool"""
+        with self._cond:
+            drivers, self._all, self._idle = self._all, [], []
+            self._num_drivers = 0
+        for driver in drivers:
+            driver.quit()
+            self._unlock_profile_of(driver)
+
+
 if __name__ == '__main__':
     fire.Fire()
\ No newline at end of file